@@ -0,0 +1,238 @@
+"""
+benchmark_portal.py
+
+Runs the Portal side of the publish, stage and release workflows
+against a FakePortal (see fake_portal.py) and reports the round trips,
+bytes and wall time for each stage.
+
+The publish, stage and release stages call the real functions in
+publish_service.py, stage_basemap_services.py and release_basemap_services.py.
+arcpy, arcgis and watermark are swapped for stand-ins that do nothing,
+so it doesn't need them and runs fine on a Linux box, and what gets
+measured is just the Portal traffic.
+
+    python benchmark_portal.py [latency in seconds, default 0.05]
+"""
+import os, sys
+import time
+import types
+import shutil
+import zipfile
+import tempfile
+import functools
+from unittest import mock
+from config import Config
+import portal
+from portal import PortalContent, PortalSession, finalize_items
+from fake_portal import FakePortal
+
+# The services table from ReleaseBasemapServices.execute
+SERVICES = [
+    ("Vector Tiles STAGED", "Vector Tiles"),
+    ("Vector Tile Labels STAGED", "Vector Tile Labels"),
+    ("Unlabeled Vector Tiles STAGED", "Unlabeled Vector Tiles"),
+]
+
+# Enough clutter that searches for a type need several pages.
+FILLER_ITEMS = 250
+
+
+def seed(fake: FakePortal) -> None:
+    """ Fill the fake portal with something like what's on ours. """
+    for title in Config.STAGING_GROUP_LIST + ['Emergency Management', 'Public Works', 'Assessment and Taxation']:
+        fake.addGroup(title)
+    fake.addFolder('Basemaps')
+    fake.addFolder('Public Works')
+    for n in range(FILLER_ITEMS):
+        fake.addItem(title='Map %d' % n, name='Map_%d' % n, type=PortalContent.MapImageLayer)
+    for (staged_title, target_title) in SERVICES:
+        name = target_title.replace(' ', '_')
+        fake.addItem(title=target_title, name=name, type=PortalContent.VectorTileService, protected=True)
+        fake.addItem(title=staged_title, name=name + '_20231018_1200', type=PortalContent.VectorTileService)
+    fake.addItem(title='Roads', name='Roads', type=PortalContent.MapImageLayer)
+    fake.addItem(title='Roads', name='Roads', type=PortalContent.FeatureService)
+    return
+
+
+def release_lookups_per_row(pc: PortalContent) -> None:
+    """ release_basemap_services.py before findMany: two searches per row. """
+    for (staged_title, target_title) in SERVICES:
+        pc.getServiceItem(staged_title)
+        pc.getServiceItem(target_title)
+    return
+
+
+def release_lookups_batched(pc: PortalContent) -> None:
+    """ release_basemap_services.py: one findMany for the whole table. """
+    pc.findMany([(title, None) for row in SERVICES for title in row])
+    return
+
+
+def group_lookups(pc: PortalContent) -> None:
+    """ The group validation at the start of every stage, release and publish. """
+    pc.getGroups(Config.STAGING_GROUP_LIST)
+    pc.getGroups(Config.RELEASE_GROUP_LIST)
+    return
+
+
+def list_map_services(pc: PortalContent) -> None:
+    """ findItems(type=MapImageLayer), which takes several pages. """
+    pc.findItems(type=pc.MapImageLayer)
+    return
+
+
+class StandIn(types.ModuleType):
+    """ Stands in for arcpy and arcgis: anything you ask it for is another StandIn, calling one does nothing. """
+
+    def __init__(self, name: str, **attributes) -> None:
+        super().__init__(name)
+        self.__dict__.update(attributes)
+        return
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        value = StandIn(self.__name__ + '.' + name)
+        setattr(self, name, value)
+        return value
+
+    def __call__(self, *args, **kwargs):
+        return StandIn(self.__name__ + '()')
+
+
+def load_scripts(workdir: str, thumbnail: str) -> tuple:
+    """
+    Import the real stage, release and publish scripts with arcpy, arcgis and
+    watermark replaced by stand-ins, so everything but the Portal calls is skipped.
+    Returns the three modules.
+    """
+    def mark(image, outname, caption='', textmark=''):
+        shutil.copyfile(thumbnail, outname)
+        return outname
+
+    def upload_service_definition(*args, **kwargs):
+        return StandIn('result', status=4, messageCount=0, outputCount=0)
+
+    arcpy = StandIn('arcpy', AddMessage=print, AddError=print, GetMessages=lambda: '')
+    arcpy.env.workspace = workdir
+    arcpy.server.UploadServiceDefinition = upload_service_definition
+    arcpy.cim.GetJSONForCIMObject = lambda *args: '{}'
+    sys.modules['arcpy'] = arcpy
+    sys.modules['arcgis'] = StandIn('arcgis')
+    sys.modules['arcgis.gis'] = sys.modules['arcgis'].gis
+    sys.modules['watermark'] = StandIn('watermark', mark=mark)
+
+    # The scripts check that their thumbnails are there when they're imported.
+    with mock.patch('os.path.exists', return_value=True):
+        import stage_basemap_services
+        import release_basemap_services
+        import publish_service
+
+    # These are set in __main__ normally.
+    stage_basemap_services.PACKAGE_THUMBNAIL = stage_basemap_services.COUNTY_THUMBNAIL = thumbnail
+    stage_basemap_services.datestamp = time.strftime("%Y%m%d %H%M")
+    stage_basemap_services.signature = time.strftime("%m/%d/%y %H:%M") + " BM"
+    release_basemap_services.DEPRECATED_THUMBNAIL = thumbnail
+    release_basemap_services.WORKSPACE = workdir
+    return (stage_basemap_services, release_basemap_services, publish_service)
+
+
+def publish_from_sd(pc: PortalContent, publish_service, thumbnail: str, max_workers: int) -> None:
+    """ PublishFromSD for Roads, a MIL with feature layers. The upload itself is skipped. """
+    mapd = {'title': 'Roads', 'name': 'Roads', 'pkgname': 'Roads', 'folder': 'Public Works', 'makeFeatures': True}
+    roads = StandIn('map', listLayers=lambda: [])
+    with mock.patch.object(publish_service, 'finalize_items', functools.partial(finalize_items, max_workers=max_workers)):
+        publish_service.PublishFromSD(pc.gis, roads, mapd, 'Roads.sd', thumbnail, 'Roads', 'benchmark')
+    return
+
+
+def stage_package(pc: PortalContent, stage_basemap_services, pkgfile: str, skipped: bool = False) -> None:
+    """ What StageBasemapServices does with each package once it's built. """
+    staging_groups = pc.getGroups(Config.STAGING_GROUP_LIST)
+    item = {'pkgname': os.path.splitext(os.path.basename(pkgfile))[0], 'pkgfile': pkgfile,
+            'description': 'Staged by the benchmark.'}
+    timings = stage_basemap_services.publish_package(pc.gis, item, staging_groups)
+    if skipped != (timings is None):
+        raise Exception("It should have been %s." % ("skipped" if skipped else "staged"))
+    return
+
+
+def release_services(pc: PortalContent, release_basemap_services) -> None:
+    """ ReleaseBasemapServices.execute, all three services. """
+    params = [StandIn('param', value=value) for value in ('BM', time.strftime("%Y%m%d %H%M"), 'benchmark')]
+    release_basemap_services.ReleaseBasemapServices().execute(params, None)
+    return
+
+
+def run(latency: float) -> list:
+    """ Run every workflow, return a list of (stage, requests, bytes in, bytes out, seconds) """
+    workdir = tempfile.mkdtemp()
+    # Keep the benchmark's token and groups away from the real ones.
+    Config.TOKEN_CACHE_FILE = os.path.join(workdir, 'token.json')
+    Config.GROUP_CACHE_FILE = os.path.join(workdir, 'groups.json')
+
+    thumbnail = os.path.join(workdir, 'benchmark_thumbnail.png')
+    with open(thumbnail, 'wb') as fp:
+        fp.write(os.urandom(50 * 1024))
+    pkgfile = os.path.join(workdir, 'Benchmark_Tiles.vtpk')
+    with zipfile.ZipFile(pkgfile, 'w', zipfile.ZIP_STORED) as zf:
+        zf.writestr('p12/tile/L00/R0000C0000.bundle', os.urandom(4 * 1024 * 1024))
+        zf.writestr('p12/root.json', '{}')
+
+    Config.SCRATCH_WORKSPACE = workdir
+    (stage_basemap_services, release_basemap_services, publish_service) = load_scripts(workdir, thumbnail)
+
+    report = []
+    with FakePortal(latency=latency) as fake:
+        seed(fake)
+        session = PortalSession(fake.url, fake.username, fake.password)
+        # The scripts call get_session().gis, this makes that our session's RestGIS.
+        session._gis = session.rest
+        portal._session = session
+
+        def stage(label, function, cached=False):
+            """ Run one workflow with a cold (or warm) cache and record what it cost. """
+            if not cached:
+                PortalContent._cache.clear()
+                PortalContent._groups.clear()
+            pc = PortalContent(session.rest)
+            since = len(fake.log)
+            t0 = time.perf_counter()
+            function(pc)
+            seconds = time.perf_counter() - t0
+            stats = fake.stats(since)
+            report.append((label, stats['requests'], stats['bytes_in'], stats['bytes_out'], seconds))
+            if stats['errors']:
+                print("WARNING: %d requests failed in \"%s\"." % (stats['errors'], label))
+            return
+
+        stage("login (token)", lambda pc: session.token)
+        stage("list map services (paged)", list_map_services)
+        stage("release lookups, per row", release_lookups_per_row)
+        stage("release lookups, findMany", release_lookups_batched)
+        stage("release lookups, cached", release_lookups_per_row, cached=True)
+        if os.path.exists(Config.GROUP_CACHE_FILE):
+            os.unlink(Config.GROUP_CACHE_FILE)
+        stage("group lookups, cold", group_lookups)
+        stage("group lookups, from disk", group_lookups)
+        stage("publish from SD, serial", lambda pc: publish_from_sd(pc, publish_service, thumbnail, max_workers=1))
+        stage("publish from SD, pooled", lambda pc: publish_from_sd(pc, publish_service, thumbnail, Config.FINALIZE_WORKERS))
+        stage("stage tile package", lambda pc: stage_package(pc, stage_basemap_services, pkgfile))
+        stage("stage it again, unchanged", lambda pc: stage_package(pc, stage_basemap_services, pkgfile, skipped=True))
+        stage("release tile services", lambda pc: release_services(pc, release_basemap_services))
+
+    return report
+
+
+def show(report: list, latency: float) -> None:
+    print()
+    print("Latency %.3fs per request" % latency)
+    print("%-30s %8s %12s %12s %9s" % ("stage", "requests", "bytes in", "bytes out", "seconds"))
+    for (label, requests, bytes_in, bytes_out, seconds) in report:
+        print("%-30s %8d %12d %12d %9.3f" % (label, requests, bytes_in, bytes_out, seconds))
+    return
+
+
+if __name__ == "__main__":
+    latency = float(sys.argv[1]) if len(sys.argv) > 1 else 0.05
+    show(run(latency), latency)
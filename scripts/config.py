@@ -1,4 +1,5 @@
 import os
+import tempfile
 from xml.sax.handler import feature_namespace_prefixes
 
 # In PRODUCTION conda sets up the environment,
@@ -43,7 +44,51 @@ class Config(object):
 
     SCRATCH_WORKSPACE = "C:\TEMP"
     if not os.path.exists(SCRATCH_WORKSPACE):
-        SCRATCH_WORKSPACE = os.environ["TEMP"]
+        # Off Windows (eg running the benchmarks on Linux) there might not be a TEMP.
+        SCRATCH_WORKSPACE = os.environ.get("TEMP") or tempfile.gettempdir()
+
+    # How many seconds PortalContent can reuse a search result. Set to 0 to always ask Portal.
+    PORTAL_CACHE_TTL = int(os.environ.get('PORTAL_CACHE_TTL') or 300)
+
+    # The group title -> id map is kept here and refreshed after GROUP_CACHE_TTL seconds.
+    GROUP_CACHE_FILE = os.environ.get('GROUP_CACHE_FILE') or os.path.join(SCRATCH_WORKSPACE, "portal_groups.json")
+    GROUP_CACHE_TTL = int(os.environ.get('GROUP_CACHE_TTL') or 24*60*60)
+
+    # Portal tokens are saved here so that the next script can skip logging in.
+    TOKEN_CACHE_FILE = os.environ.get('TOKEN_CACHE_FILE') or os.path.join(SCRATCH_WORKSPACE, "portal_token.json")
+    TOKEN_EXPIRATION = int(os.environ.get('TOKEN_EXPIRATION') or 120) # minutes
+    # Packages bigger than this get uploaded in parts, see multipart_upload.py.
+    MULTIPART_THRESHOLD = int(os.environ.get('MULTIPART_THRESHOLD_MB') or 100) * 1024 * 1024
+    UPLOAD_PART_SIZE = int(os.environ.get('UPLOAD_PART_SIZE_MB') or 20) * 1024 * 1024
+    UPLOAD_WORKERS = 4 # parts sent at the same time
+    UPLOAD_RETRIES = 3 # tries for each part
+
+    # How many keep-alive connections to Portal each session can hold open.
+    HTTP_POOL_SIZE = 8
+    # How many Portal updates can be running at once after a publish.
+    FINALIZE_WORKERS = 4
+
+    # How many vector tile packages can build at once (0 = as many as the cores and memory allow)
+    BUILD_WORKERS = int(os.environ.get('BUILD_WORKERS') or 0)
+    # About how much memory one CreateVectorTilePackage run needs, in GB.
+    BUILD_WORKER_MEMORY_GB = float(os.environ.get('BUILD_WORKER_MEMORY_GB') or 4)
+    # How many built packages can wait in line to be uploaded.
+    PIPELINE_QUEUE_SIZE = 2
+    # Every package build gets a line here, estimate_tiles.py uses them to guess how long the next one takes.
+    BUILD_HISTORY_FILE = os.environ.get('BUILD_HISTORY_FILE') or os.path.join(SCRATCH_WORKSPACE, "build_history.jsonl")
+    # A tile index from tile_index.py makes build_tile_package use the INDEXED tile structure, unset means FLAT.
+    TILE_INDEX = os.environ.get('TILE_INDEX')
+    # tile_index.py doesn't split tiles smaller than this vector tile level.
+    TILE_INDEX_MAX_LEVEL = 16
+    # The editor tracking field, republish_raster_tiles.py and incremental_refresh.py look for edits with it.
+    EDITED_FIELD = "last_edited_date"
+    # The stage scripts print an estimate for each map before the builds start, see estimate_tiles.py.
+    # "quick" starts from the map's last build, "full" reads every feature, "off" skips it.
+    ESTIMATE_BUILDS = (os.environ.get('ESTIMATE_BUILDS') or 'quick').lower()
+
+    # Set PORTAL_TRACE to log every Portal call, see portal_trace.py.
+    PORTAL_TRACE = bool(os.environ.get('PORTAL_TRACE'))
+    TRACE_DIR = os.environ.get('TRACE_DIR') or os.path.join(SCRATCH_WORKSPACE, "portal_traces")
 
     PORTAL_PROFILE = os.environ.get('PORTAL_PROFILE')
     PORTAL_USER = os.environ.get('PORTAL_USER')
@@ -59,9 +104,14 @@ The data is maintained by Clatsop County to support its governmental activities.
 Clatsop County is not responsible for any map errors, possible misuse, or misinterpretation."""
 
     # Scales https://www.esri.com/arcgis-blog/products/product/mapping/web-map-zoom-levels-updated/
-    MIN_COUNTY_ZOOM = 1155581.108577  # LOD  9
-    MIN_TAXLOT_ZOOM =  144447.638572  # LOD 12
-    MAX_ZOOM        =      70.5310735 # LOD 23
+    # These are raster LODs in Web Mercator, see tiling.py. (A .vtpk numbers them one less.)
+    MIN_COUNTY_LOD = 9
+    MIN_TAXLOT_LOD = 12
+    MAX_LOD = 23
+    LOD0_SCALE = 591657527.591555
+    MIN_COUNTY_ZOOM = LOD0_SCALE / 2**MIN_COUNTY_LOD # 1155581.108577
+    MIN_TAXLOT_ZOOM = LOD0_SCALE / 2**MIN_TAXLOT_LOD #  144447.638572
+    MAX_ZOOM        = LOD0_SCALE / 2**MAX_LOD        #      70.5310735
 
     pass
 
@@ -74,10 +124,11 @@ if __name__ == "__main__":
     assert Config.PORTAL_USER
     assert Config.PORTAL_PASSWORD
     
-    from arcgis.gis import GIS
+    from portal import get_session
     # This works but so what, we have to store the PASSWORD to log in via arcpy too.
 #    gis = GIS(url=Config.PORTAL_URL, profile=Config.PORTAL_PROFILE)
-    gis = GIS(url=Config.PORTAL_URL, username=Config.PORTAL_USER, password=Config.PORTAL_PASSWORD)
+    # Checking the login doesn't need arcgis, so use the quick one.
+    gis = get_session().rest
     print(gis.properties.user.fullName)
 
     assert os.path.exists(Config.SERVER_AGS)
@@ -0,0 +1,356 @@
+"""
+estimate_tiles.py
+
+Guesses how big a vector tile package will be, and how long
+CreateVectorTilePackage will take, before we start it.
+
+It reads the features in each layer of the map (in Web Mercator) and
+works out which tiles they land in at one fairly detailed level (HISTOGRAM_LEVEL).
+That histogram gives, for every level between the map's min and max scales,
+
+    * how many tiles will have something in them, only counting the
+      layers that are visible at that level's scale,
+    * how many vertices the tool has to chew through, and the most in any one tile.
+
+Levels coarser than the histogram are exact (the histogram just gets
+added up into bigger tiles). For finer levels, a tile with a line or
+a polygon's edge in it turns into about 2 tiles per level, and a tile
+inside a polygon turns into 4.
+
+That reads every feature, which takes a while for the big maps. The quick
+estimate skips it and starts from the tiles counted in the map's last
+build instead, when there is one at the same scales. That's what the stage
+scripts do unless ESTIMATE_BUILDS is "full" (or "off").
+
+Time and size come from tiles multiplied by seconds (and bytes) per tile,
+learned from earlier builds. build_tile_package records every build in
+Config.BUILD_HISTORY_FILE, with how many builds were running at the same
+time, since builds sharing the machine each take longer. Seconds per tile
+come from builds that ran with as many workers as this one will if there
+are any. Until there is some history the defaults below are used and the
+estimate says "uncalibrated".
+
+    python estimate_tiles.py [quick]   estimates for the vector tile maps in basemap.aprx
+"""
+import os, sys
+import json
+import time
+import statistics
+from datetime import datetime
+import numpy as np
+from config import Config
+import tiling
+
+# Vector tile level to build the histogram at, about 1.2 km tiles.
+HISTOGRAM_LEVEL = 15
+
+# Used until there are builds in the history.
+DEFAULT_SECONDS_PER_TILE = 0.01
+DEFAULT_BYTES_PER_TILE = 2000
+
+
+def _keys(x, y, level: int) -> np.ndarray:
+    """ Tile keys (row * 2**level + col) of points. """
+    n = 2 ** level
+    width = float(tiling.tile_widths(level))
+    rows = np.clip(np.floor((tiling.ORIGIN_Y - y) / width).astype(np.int64), 0, n - 1)
+    cols = np.clip(np.floor((x - tiling.ORIGIN_X) / width).astype(np.int64), 0, n - 1)
+    return rows * n + cols
+
+
+def layer_histogram(layer: dict, level: int = HISTOGRAM_LEVEL) -> dict:
+    """
+    Where one layer's features are at 'level'.
+    'layer' has "kind" (point, line or polygon) and "features", a list of
+    features, each a list of parts (rings or paths) of (x, y) points.
+    Returns the tile keys of the edges ("edge"), of tiles only inside
+    polygons ("inside"), and one key per vertex ("vertices").
+    """
+    n = 2 ** level
+    empty = np.zeros(0, dtype=np.int64)
+    parts = [np.asarray(part, dtype=float).reshape(-1, 2) for feature in layer['features'] for part in feature]
+    if not parts:
+        return {'edge': empty, 'inside': empty, 'vertices': empty}
+    points = np.concatenate(parts)
+    vertices = _keys(points[:, 0], points[:, 1], level)
+    if layer['kind'] == 'point':
+        return {'edge': np.unique(vertices), 'inside': empty, 'vertices': vertices}
+
+    edges = tiling.ring_edges(parts, closed=layer['kind'] == 'polygon')
+    (rows, cols) = tiling.edge_tiles(edges, level)
+    edge = np.unique(rows * n + cols)
+    inside = empty
+    if layer['kind'] == 'polygon':
+        # Each polygon separately, they can overlap, and even-odd would punch holes.
+        keys = [rows * n + cols for (rows, cols) in (tiling.polygon_tiles(feature, level) for feature in layer['features'])]
+        if keys:
+            inside = np.setdiff1d(np.concatenate(keys), edge)
+    return {'edge': edge, 'inside': inside, 'vertices': vertices}
+
+
+def visible(layer: dict, scale: float) -> bool:
+    """ Does the layer draw at this scale? 0 means no limit, like in Pro. """
+    if layer.get('min_scale') and scale > layer['min_scale'] * 1.0001:
+        return False
+    if layer.get('max_scale') and scale < layer['max_scale'] * 0.9999:
+        return False
+    return True
+
+
+def estimate_levels(layers: list, levels, histogram_level: int = HISTOGRAM_LEVEL) -> list:
+    """ The estimate for each vector tile level, see above. Returns a list of dicts. """
+    hists = [layer_histogram(layer, histogram_level) for layer in layers]
+    results = []
+    for level in levels:
+        scale = float(tiling.lod_scales(level, tiling.VECTOR_TILE_SIZE))
+        shown = [h for (layer, h) in zip(layers, hists) if visible(layer, scale)]
+        row = {'level': level, 'scale': scale, 'tiles': 0, 'vertices': 0, 'max_tile_vertices': None}
+        if not shown:
+            results.append(row)
+            continue
+        vertices = np.concatenate([h['vertices'] for h in shown])
+        edge = np.unique(np.concatenate([h['edge'] for h in shown]))
+        inside = np.setdiff1d(np.concatenate([h['inside'] for h in shown]), edge)
+        row['vertices'] = len(vertices)
+
+        k = histogram_level - level
+        if k >= 0:
+            # Add the histogram up into bigger tiles, that's exact.
+            n = 2 ** histogram_level
+            def coarse(keys):
+                return ((keys // n) >> k) * (2 ** level) + ((keys % n) >> k)
+            row['tiles'] = len(np.unique(coarse(np.concatenate([edge, inside]))))
+            if len(vertices):
+                row['max_tile_vertices'] = int(np.unique(coarse(vertices), return_counts=True)[1].max())
+        else:
+            # Finer than the histogram, lines double and areas quadruple with each level.
+            row['tiles'] = len(edge) * 2 ** -k + len(inside) * 4 ** -k
+        results.append(row)
+    return results
+
+
+def read_history(mapname: str = None) -> list:
+    """ Earlier builds, for this map if we have any, otherwise for all maps. """
+    builds = []
+    try:
+        with open(Config.BUILD_HISTORY_FILE) as fp:
+            builds = [json.loads(line) for line in fp if line.strip()]
+    except (OSError, ValueError):
+        pass
+    builds = [b for b in builds if b.get('seconds')]
+    mine = [b for b in builds if b.get('map') == mapname]
+    return mine or builds
+
+
+def record_build(mapname: str, pkgfile: str, seconds: float, estimate: dict = None, workers: int = 1,
+                 min_scale: float = None, max_scale: float = None) -> None:
+    """
+    Remember how a build went, so the next estimates get better.
+    'workers' is how many builds were running at the same time.
+    """
+    import vtpk
+    try:
+        levels = vtpk.count_tiles(pkgfile)
+        tiles = sum(levels.values())
+    except Exception as e:
+        print("Could not count the tiles in %s." % pkgfile, e)
+        (levels, tiles) = ({}, None)
+    entry = {
+        'map': mapname,
+        'built': datetime.now().isoformat(),
+        'seconds': round(seconds, 1),
+        'workers': workers,
+        'bytes': os.path.getsize(pkgfile),
+        'tiles': tiles,
+        'level_tiles': {str(level): n for (level, n) in sorted(levels.items())},
+        'min_scale': min_scale,
+        'max_scale': max_scale,
+        'estimated_tiles': estimate.get('tiles') if estimate and not estimate.get('quick') else None,
+        'vertices': estimate.get('vertices') if estimate else None,
+    }
+    with open(Config.BUILD_HISTORY_FILE, 'a') as fp:
+        fp.write(json.dumps(entry) + '\n')
+    return
+
+
+def project(estimate: dict, mapname: str = None, workers: int = 1) -> dict:
+    """
+    Add a build time and package size to an estimate, from the build history.
+    'workers' is how many builds will run at the same time as this one.
+    """
+    # A quick estimate's tiles are real ones from a build, so use the rates per real tile.
+    per = 'tiles' if estimate.get('quick') else 'estimated_tiles'
+    history = [b for b in read_history(mapname) if b.get(per)]
+    # Builds from before the history kept "workers" are left out unless there's nothing else.
+    alike = [b for b in history if b.get('workers') == workers]
+    if history:
+        # Per tile, so any steady bias in the tile estimate cancels out.
+        timed = alike or history
+        seconds_per_tile = statistics.median(b['seconds'] / b[per] for b in timed)
+        bytes_per_tile = statistics.median(b['bytes'] / b[per] for b in history)
+    else:
+        (seconds_per_tile, bytes_per_tile) = (DEFAULT_SECONDS_PER_TILE, DEFAULT_BYTES_PER_TILE)
+    estimate['seconds'] = estimate['tiles'] * seconds_per_tile
+    estimate['bytes'] = estimate['tiles'] * bytes_per_tile
+    estimate['workers'] = workers
+    estimate['calibrated'] = len(alike) if alike else len(history)
+    estimate['workers_matched'] = bool(alike)
+    return estimate
+
+
+def last_build(mapname: str, min_scale: float, max_scale: float) -> dict:
+    """ The most recent build of this map at these scales that has its tiles counted, or None. """
+    for b in reversed(read_history(mapname)):
+        if (b.get('map') == mapname and b.get('level_tiles') and b.get('min_scale') and b.get('max_scale')
+                and abs(b['min_scale'] / min_scale - 1) < 1e-4 and abs(b['max_scale'] / max_scale - 1) < 1e-4):
+            return b
+    return None
+
+
+def read_layers(map) -> list:
+    """ The features of every feature layer in a map, in Web Mercator, ready for estimate_levels. """
+    import arcpy # Here, so the arithmetic above can be used without it.
+    web_mercator = arcpy.SpatialReference(3857)
+    layers = []
+    for layer in map.listLayers():
+        if not layer.isFeatureLayer or not layer.visible:
+            continue
+        shape_type = arcpy.Describe(layer).shapeType.lower()
+        kind = {'polyline': 'line', 'polygon': 'polygon'}.get(shape_type, 'point')
+        features = []
+        with arcpy.da.SearchCursor(layer, ['SHAPE@'], spatial_reference=web_mercator) as cursor:
+            for (shape,) in cursor:
+                if shape is None:
+                    continue
+                if kind == 'point':
+                    features.append([[(p.X, p.Y) for p in (shape.getPart() if shape.isMultipart else [shape.firstPoint])]])
+                else:
+                    features.append(tiling.rings_from_geometry(shape))
+        layers.append({'name': layer.longName, 'kind': kind, 'features': features,
+                       'min_scale': layer.minThreshold, 'max_scale': layer.maxThreshold})
+    return layers
+
+
+def quick_estimate(mapname: str, min_scale: float, max_scale: float) -> dict:
+    """ The tiles from the map's last build, without reading any features. None if it hasn't been built. """
+    b = last_build(mapname, min_scale, max_scale)
+    if not b:
+        return None
+    rows = [{'level': int(level), 'scale': float(tiling.lod_scales(int(level), tiling.VECTOR_TILE_SIZE)),
+             'tiles': n, 'vertices': None, 'max_tile_vertices': None}
+            for (level, n) in sorted(b['level_tiles'].items(), key=lambda item: int(item[0]))]
+    return {'map': mapname, 'levels': rows, 'tiles': b['tiles'], 'vertices': b.get('vertices'),
+            'quick': b['built'], 'estimate_seconds': 0.0}
+
+
+def estimate(map, min_scale: float = Config.MIN_COUNTY_ZOOM, max_scale: float = Config.MAX_ZOOM,
+             workers: int = 1, quick: bool = False) -> dict:
+    """
+    Estimate the tiles, vertices, build time and size for a map from an aprx.
+    'workers' is how many builds will be running at once.
+    quick=True starts from the last build if there is one, see quick_estimate.
+    """
+    t0 = time.perf_counter()
+    result = quick_estimate(map.name, min_scale, max_scale) if quick else None
+    if not result:
+        levels = tiling.lod_range(min_scale, max_scale, tiling.VECTOR_TILE_SIZE)
+        rows = estimate_levels(read_layers(map), levels)
+        result = {
+            'map': map.name,
+            'levels': rows,
+            'tiles': int(sum(r['tiles'] for r in rows)),
+            'vertices': int(sum(r['vertices'] for r in rows)),
+            'estimate_seconds': round(time.perf_counter() - t0, 1),
+        }
+    return project(result, map.name, workers)
+
+
+def duration(seconds: float) -> str:
+    """ 5400 => "1h 30m" """
+    if seconds < 60:
+        return "%ds" % seconds
+    (hours, minutes) = divmod(int(seconds) // 60, 60)
+    return "%dh %02dm" % (hours, minutes) if hours else "%dm" % minutes
+
+
+def summary(est: dict) -> str:
+    """ One line for the stage scripts. """
+    notes = []
+    if est.get('quick'):
+        notes.append("tiles from the build on %s" % est['quick'][:10])
+    if not est['calibrated']:
+        notes.append("uncalibrated")
+    elif not est.get('workers_matched'):
+        notes.append("no earlier builds with %d at a time" % est.get('workers', 1))
+    vertices = "%d vertices, " % est['vertices'] if est.get('vertices') else ""
+    return "%d tiles, %sabout %s to build and %.0f MB%s" % (
+        est['tiles'], vertices, duration(est['seconds']), est['bytes'] / 1024**2,
+        " (%s)" % ", ".join(notes) if notes else "")
+
+
+def show(est: dict) -> None:
+    print(est['map'])
+    print("%5s %14s %12s %12s %12s" % ("level", "scale", "tiles", "vertices", "most/tile"))
+    for r in est['levels']:
+        vertices = "%12d" % r['vertices'] if r['vertices'] is not None else "%12s" % "-"
+        most = "%12d" % r['max_tile_vertices'] if r['max_tile_vertices'] is not None else "%12s" % "-"
+        print("%5d %14.2f %12d %s %s" % (r['level'], r['scale'], r['tiles'], vertices, most))
+    print(summary(est))
+    return
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'test':
+        # A made up county: a coastline, some roads and a lake, no arcpy needed.
+        rng = np.random.default_rng(1)
+        x0, y0 = -13800000, 5750000
+        roads = [[np.column_stack([x0 + np.cumsum(rng.normal(0, 200, 300)), y0 + np.cumsum(rng.normal(0, 200, 300))])]
+                 for i in range(50)]
+        lake = [[[(x0, y0), (x0 + 5000, y0), (x0 + 5000, y0 + 3000), (x0, y0 + 3000), (x0, y0)]]]
+        layers = [
+            {'name': 'Roads', 'kind': 'line', 'features': roads, 'min_scale': 0, 'max_scale': 0},
+            {'name': 'Lakes', 'kind': 'polygon', 'features': lake, 'min_scale': 600000, 'max_scale': 0},
+        ]
+        levels = tiling.lod_range(Config.MIN_COUNTY_ZOOM, Config.MAX_ZOOM, tiling.VECTOR_TILE_SIZE)
+        t0 = time.perf_counter()
+        rows = estimate_levels(layers, levels)
+        est = project({'map': 'test', 'levels': rows, 'tiles': sum(r['tiles'] for r in rows),
+                       'vertices': sum(r['vertices'] for r in rows)})
+        show(est)
+        print("Estimated in %.3fs" % (time.perf_counter() - t0))
+        # Coarse levels are exact, so compare one with listing the tiles directly.
+        level = 12
+        direct = set()
+        for feature in roads:
+            (r, c) = tiling.edge_tiles(tiling.ring_edges(feature, closed=False), level)
+            direct |= set(zip(r.tolist(), c.tolist()))
+        lake_tiles = set(zip(*(a.tolist() for a in tiling.polygon_tiles(lake[0], level))))
+        assert rows[level - levels.start]['tiles'] == len(direct | lake_tiles)
+        assert rows[0]['tiles'] <= rows[-1]['tiles']
+
+        # The quick estimate uses the last build, and times from builds with the same number of workers.
+        import tempfile
+        Config.BUILD_HISTORY_FILE = os.path.join(tempfile.mkdtemp(), 'history.jsonl')
+        assert quick_estimate('test', Config.MIN_COUNTY_ZOOM, Config.MAX_ZOOM) is None
+        with open(Config.BUILD_HISTORY_FILE, 'w') as fp:
+            for (seconds, workers) in ((100, 1), (300, 4)):
+                fp.write(json.dumps({'map': 'test', 'built': '2024-01-02T03:04:05', 'seconds': seconds,
+                                     'workers': workers, 'bytes': 1000, 'tiles': 1000, 'level_tiles': {'12': 1000},
+                                     'min_scale': Config.MIN_COUNTY_ZOOM, 'max_scale': Config.MAX_ZOOM,
+                                     'estimated_tiles': None, 'vertices': None}) + '\n')
+        quick = project(quick_estimate('test', Config.MIN_COUNTY_ZOOM, Config.MAX_ZOOM), 'test', workers=4)
+        assert quick['tiles'] == 1000 and round(quick['seconds']) == 300 and quick['workers_matched']
+        assert not project(dict(quick), 'test', workers=2)['workers_matched']
+        show(quick)
+        print("Unit tests passed.")
+        exit(0)
+
+    import arcpy
+    aprx = arcpy.mp.ArcGISProject(Config.BASEMAP_APRX)
+    for mapname in (Config.COMBINED_MAP, Config.LABEL_MAP, Config.FEATURE_MAP):
+        maps = aprx.listMaps(mapname)
+        if len(maps) != 1:
+            print("Map \"%s\" not found." % mapname)
+            continue
+        show(estimate(maps[0], quick='quick' in sys.argv[1:]))
+        print()
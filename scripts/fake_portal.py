@@ -0,0 +1,466 @@
+"""
+fake_portal.py
+
+A local stand-in for the parts of the Portal sharing REST API that
+PortalContent, PublishFromSD, upload_tile_package, stage_tile_service
+and replace_service use, so that we can measure those workflows
+without touching the real Portal at delta.co.clatsop.or.us.
+
+It runs an HTTP server on a thread in this process and keeps everything in memory.
+Every request is logged (path, bytes in and out, status, time) and can be
+delayed by "latency" seconds so it acts more like a real network.
+
+    with FakePortal(latency=0.05) as fake:
+        session = PortalSession(fake.url, fake.username, fake.password)
+        pc = PortalContent(session.rest)
+        ...
+        print(fake.stats())
+
+This is for benchmarking and testing; it's not trying to be a complete Portal.
+"""
+import re
+import json
+import time
+import uuid
+import threading
+import email.parser
+import email.policy
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class FakePortalError(Exception):
+    def __init__(self, code: int, message: str) -> None:
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+def parse_filter(q: str):
+    """
+    Turn a search 'filter' like '(title:"A" AND type:"B") OR (title:"C")'
+    into a function that takes an item dict and returns True if it matches.
+    Matching is exact except that case does not matter, like Portal.
+    """
+    tokens = re.findall(r'\w+:"[^"]*"|\(|\)|\bAND\b|\bOR\b', q or '')
+    pos = 0
+
+    def peek():
+        return tokens[pos] if pos < len(tokens) else None
+
+    def parse_or():
+        nonlocal pos
+        terms = [parse_and()]
+        while peek() == 'OR':
+            pos += 1
+            terms.append(parse_and())
+        return lambda item: any(t(item) for t in terms)
+
+    def parse_and():
+        nonlocal pos
+        terms = [parse_atom()]
+        while peek() == 'AND':
+            pos += 1
+            terms.append(parse_atom())
+        return lambda item: all(t(item) for t in terms)
+
+    def parse_atom():
+        nonlocal pos
+        token = peek()
+        pos += 1
+        if token == '(':
+            inner = parse_or()
+            pos += 1 # Skip the ')'
+            return inner
+        (field, value) = token.split(':', 1)
+        value = value.strip('"').casefold()
+        return lambda item: str(item.get(field) or '').casefold() == value
+
+    if not tokens:
+        return lambda item: True
+    return parse_or()
+
+
+class FakePortal(object):
+
+    # Portal won't return more than this many results per page.
+    MAX_PAGE_SIZE = 100
+
+    # What a package turns into when it's published.
+    PUBLISHED_TYPES = {
+        'vectortilepackage': 'Vector Tile Service',
+        'tilepackage': 'Map Service',
+        'serviceDefinition': 'Map Service',
+    }
+
+    def __init__(self, latency: float = 0.0, username: str = 'tester', password: str = 'secret') -> None:
+        self.latency = latency
+        self.username = username
+        self.password = password
+        self.orgid = '0123456789ABCDEF'
+        self.url = None
+
+        self.items = {}
+        self.groups = {}
+        self.folders = {}
+        self.comments = []
+        self.parts = {}  # Multipart uploads in progress, itemid -> {partNum: bytes}
+        self.data = {}   # Uploaded files, itemid -> bytes
+        self.tokens = set()
+        self.log = []
+
+        self._lock = threading.RLock()
+        self._server = None
+        self._thread = None
+        return
+
+    # ---- Setting up ----
+
+    def start(self) -> 'FakePortal':
+        portal = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, so that pooled sessions get to reuse connections.
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                portal._respond(self, 'GET')
+
+            def do_POST(self):
+                portal._respond(self, 'POST')
+
+            def log_message(self, format, *args):
+                return # Be quiet.
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self.url = 'http://127.0.0.1:%d/portal' % self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        return
+
+    def __enter__(self) -> 'FakePortal':
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+        return
+
+    def addItem(self, **fields) -> dict:
+        """ Put an item in the fake portal. Returns the item dict. """
+        with self._lock:
+            item = {
+                'id': uuid.uuid4().hex,
+                'owner': self.username,
+                'title': '',
+                'name': None,
+                'type': 'File',
+                'snippet': '',
+                'description': '',
+                'accessInformation': None,
+                'licenseInfo': None,
+                'tags': [],
+                'contentStatus': '',
+                'protected': False,
+                'size': 0,
+                'access': 'private',
+                'ownerFolder': None,
+                'created': int(time.time() * 1000),
+                'modified': int(time.time() * 1000),
+            }
+            item.update(fields)
+            self.items[item['id']] = item
+            return item
+
+    def addGroup(self, title: str) -> str:
+        with self._lock:
+            id = uuid.uuid4().hex
+            self.groups[id] = {'id': id, 'title': title, 'owner': self.username}
+            return id
+
+    def addFolder(self, title: str) -> str:
+        with self._lock:
+            id = uuid.uuid4().hex
+            self.folders[id] = {'id': id, 'title': title, 'username': self.username}
+            return id
+
+    # ---- Measuring ----
+
+    def stats(self, since: int = 0) -> dict:
+        """ Totals for the requests logged since log entry number 'since'. """
+        with self._lock:
+            entries = self.log[since:]
+        return {
+            'requests': len(entries),
+            'bytes_in': sum(e['bytes_in'] for e in entries),
+            'bytes_out': sum(e['bytes_out'] for e in entries),
+            'errors': sum(1 for e in entries if e['error']),
+        }
+
+    # ---- HTTP plumbing ----
+
+    def _readRequest(self, handler, method: str) -> tuple:
+        """ Return (path, params, files, bytes read) """
+        parsed = urlparse(handler.path)
+        params = {k: v[0] for (k, v) in parse_qs(parsed.query, keep_blank_values=True).items()}
+        files = {}
+        body = b''
+        if method == 'POST':
+            length = int(handler.headers.get('Content-Length') or 0)
+            body = handler.rfile.read(length)
+            ctype = handler.headers.get('Content-Type', '')
+            if ctype.startswith('multipart/form-data'):
+                msg = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+                    b'Content-Type: ' + ctype.encode() + b'\r\n\r\n' + body)
+                for part in msg.iter_parts():
+                    name = part.get_param('name', header='content-disposition')
+                    payload = part.get_payload(decode=True)
+                    if part.get_filename():
+                        files[name] = (part.get_filename(), payload)
+                    else:
+                        params[name] = payload.decode('utf-8')
+            else:
+                params.update({k: v[0] for (k, v) in parse_qs(body.decode('utf-8'), keep_blank_values=True).items()})
+        return (parsed.path, params, files, len(handler.path) + len(body))
+
+    def _respond(self, handler, method: str) -> None:
+        t0 = time.perf_counter()
+        (path, params, files, bytes_in) = self._readRequest(handler, method)
+        if self.latency:
+            time.sleep(self.latency)
+
+        error = None
+        try:
+            result = self.handle(method, path, params, files)
+        except FakePortalError as e:
+            error = e
+            result = {'error': {'code': e.code, 'message': e.message, 'details': []}}
+        body = json.dumps(result).encode('utf-8')
+
+        # Portal sends errors back with a 200 status, so we do too.
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+        with self._lock:
+            self.log.append({
+                'method': method,
+                'path': path,
+                'bytes_in': bytes_in,
+                'bytes_out': len(body),
+                'error': error.message if error else None,
+                'seconds': time.perf_counter() - t0,
+            })
+        return
+
+    # ---- The REST API ----
+
+    def handle(self, method: str, path: str, params: dict, files: dict) -> dict:
+        """ Route a request, returns the JSON response as a dict. """
+        prefix = '/portal/sharing/rest/'
+        if not path.startswith(prefix):
+            raise FakePortalError(404, 'Not found: %s' % path)
+        parts = path[len(prefix):].strip('/').split('/')
+
+        if parts == ['generateToken']:
+            return self._generateToken(params)
+        if params.get('token') not in self.tokens:
+            raise FakePortalError(498, 'Invalid token.')
+
+        with self._lock:
+            if parts == ['portals', 'self']:
+                return {'id': self.orgid, 'isPortal': True, 'name': 'Fake Portal',
+                        'user': {'username': self.username, 'fullName': 'Test User'}}
+            if parts == ['search']:
+                return self._page(params, [i for i in self.items.values() if parse_filter(params.get('filter'))(i)])
+            if parts == ['community', 'groups']:
+                return self._page(params, sorted(self.groups.values(), key=lambda g: g['title']))
+            if parts[:2] == ['content', 'items']:
+                item = self._getItem(parts[2])
+                if len(parts) == 3:
+                    return item
+                if parts[3] == 'addComment':
+                    self.comments.append((item['id'], params.get('comment')))
+                    return {'success': True, 'commentId': uuid.uuid4().hex}
+            if parts[:2] == ['content', 'users']:
+                return self._userContent(parts[2:], params, files)
+
+        raise FakePortalError(400, 'Unsupported request: %s' % path)
+
+    def _generateToken(self, params: dict) -> dict:
+        if params.get('username') != self.username or params.get('password') != self.password:
+            raise FakePortalError(400, 'Unable to generate token.')
+        token = uuid.uuid4().hex
+        minutes = int(params.get('expiration') or 60)
+        with self._lock:
+            self.tokens.add(token)
+        return {'token': token, 'expires': int((time.time() + minutes * 60) * 1000), 'ssl': False}
+
+    def _page(self, params: dict, results: list) -> dict:
+        start = int(params.get('start') or 1)
+        num = min(int(params.get('num') or 10), self.MAX_PAGE_SIZE)
+        page = results[start - 1:start - 1 + num]
+        next_start = start + num if start - 1 + num < len(results) else -1
+        return {'total': len(results), 'start': start, 'num': len(page), 'nextStart': next_start, 'results': page}
+
+    def _getItem(self, id: str) -> dict:
+        try:
+            return self.items[id]
+        except KeyError:
+            raise FakePortalError(400, 'Item does not exist or is inaccessible.')
+
+    def _userContent(self, parts: list, params: dict, files: dict) -> dict:
+        """ Everything under content/users/<username>/ """
+        user = parts[0]
+        parts = parts[1:]
+        folder = None
+        if parts and parts[0] in self.folders:
+            folder = parts[0]
+            parts = parts[1:]
+
+        if not parts:
+            return {
+                'username': user,
+                'folders': list(self.folders.values()),
+                'items': [i for i in self.items.values() if i['owner'] == user and i['ownerFolder'] == folder],
+            }
+
+        operation = parts[0]
+        if operation == 'addItem':
+            return self._addItem(params, files, folder)
+        if operation == 'publish':
+            return self._publish(params)
+        if operation == 'replaceService':
+            return self._replaceService(params)
+        if operation == 'items' and len(parts) == 3:
+            return self._itemOperation(self._getItem(parts[1]), parts[2], params, files)
+        raise FakePortalError(400, 'Unsupported operation: %s' % '/'.join(parts))
+
+    def _addItem(self, params: dict, files: dict, folder: str) -> dict:
+        fields = {k: v for (k, v) in params.items() if k not in ('f', 'token')}
+        if 'tags' in fields:
+            fields['tags'] = fields['tags'].split(',')
+        size = 0
+        data = None
+        if fields.pop('multipart', None) == 'true':
+            # The file comes later, in parts, see addPart and commit.
+            fields.setdefault('name', fields.pop('filename', '').rsplit('.', 1)[0])
+            item = self.addItem(ownerFolder=folder, status='partial', **fields)
+            self.parts[item['id']] = {}
+            return {'success': True, 'id': item['id'], 'folder': folder}
+        if 'file' in files:
+            (filename, data) = files['file']
+            size = len(data)
+            fields.setdefault('name', filename.rsplit('.', 1)[0])
+        item = self.addItem(ownerFolder=folder, size=size, **fields)
+        if data is not None:
+            self.data[item['id']] = data
+        return {'success': True, 'id': item['id'], 'folder': folder}
+
+    def _itemOperation(self, item: dict, operation: str, params: dict, files: dict) -> dict:
+        if operation == 'update':
+            for (key, value) in params.items():
+                if key in ('f', 'token', 'clearEmptyFields'):
+                    continue
+                item[key] = value.split(',') if key == 'tags' else value
+            if 'thumbnail' in files:
+                item['thumbnail'] = 'thumbnail/' + files['thumbnail'][0]
+            if 'file' in files:
+                item['size'] = len(files['file'][1])
+            item['modified'] = int(time.time() * 1000)
+            return {'success': True, 'id': item['id']}
+        if operation == 'share':
+            if params.get('everyone') == 'true':
+                item['access'] = 'public'
+            elif params.get('org') == 'true':
+                item['access'] = 'org'
+            groups = [g for g in (params.get('groups') or '').split(',') if g]
+            return {'notSharedWith': [g for g in groups if g not in self.groups], 'itemId': item['id']}
+        if operation in ('protect', 'unprotect'):
+            item['protected'] = operation == 'protect'
+            return {'success': True}
+        if operation == 'setContentStatus':
+            item['contentStatus'] = params.get('status', '')
+            return {'success': True}
+        if operation == 'delete':
+            if item['protected']:
+                raise FakePortalError(400, 'Unable to delete item. Delete protection is turned on.')
+            del self.items[item['id']]
+            self.parts.pop(item['id'], None)
+            self.data.pop(item['id'], None)
+            return {'success': True, 'itemId': item['id']}
+        if operation == 'addPart':
+            if item['id'] not in self.parts:
+                raise FakePortalError(400, 'Item is not a multipart upload.')
+            num = int(params.get('partNum') or 0)
+            if not 1 <= num <= 10000 or 'file' not in files:
+                raise FakePortalError(400, 'Invalid part.')
+            self.parts[item['id']][num] = files['file'][1]
+            return {'success': True}
+        if operation == 'parts':
+            return {'parts': sorted(self.parts.get(item['id'], {}))}
+        if operation == 'commit':
+            parts = self.parts.pop(item['id'], None)
+            if parts is None:
+                raise FakePortalError(400, 'Item is not a multipart upload.')
+            data = b''.join(parts[n] for n in sorted(parts))
+            self.data[item['id']] = data
+            for (key, value) in params.items():
+                if key not in ('f', 'token', 'id'):
+                    item[key] = value.split(',') if key == 'tags' else value
+            item.update(size=len(data), status='completed')
+            return {'success': True, 'id': item['id']}
+        if operation == 'status':
+            return {'status': item.get('status', 'completed'), 'itemId': item['id']}
+        raise FakePortalError(400, 'Unsupported item operation: %s' % operation)
+
+    def _publish(self, params: dict) -> dict:
+        source = self._getItem(params.get('itemID') or params.get('itemId'))
+        publish_parameters = json.loads(params.get('publishParameters') or '{}')
+        name = publish_parameters.get('name') or source['name']
+        service_type = self.PUBLISHED_TYPES.get(params.get('filetype'), 'Map Service')
+        for item in self.items.values():
+            if item['type'] == service_type and (item['name'] or '').casefold() == (name or '').casefold():
+                return {'services': [{'error': {'code': 400, 'message': "Service name '%s' already exists for '%s'" % (name, self.orgid)}}]}
+        service = self.addItem(title=publish_parameters.get('title') or source['title'], name=name,
+            type=service_type, url='%s/server/rest/services/Hosted/%s/VectorTileServer' % (self.url, name))
+        return {'services': [{'serviceItemId': service['id'], 'jobId': uuid.uuid4().hex, 'type': service_type}]}
+
+    def _replaceService(self, params: dict) -> dict:
+        """ The target keeps its id and gets the new service, the old one is archived under a new name. """
+        target = self._getItem(params.get('toReplaceItemId'))
+        staged = self._getItem(params.get('replacingItemId'))
+        archived = dict(target)
+        archived.update(id=uuid.uuid4().hex, name=params.get('replacedServiceName') or target['name'] + '_archived',
+            title=params.get('replacedServiceName') or target['title'], protected=False)
+        self.items[archived['id']] = archived
+        for key in ('url', 'size'):
+            target[key] = staged.get(key)
+        if params.get('replaceMetadata') == 'true':
+            for key in ('snippet', 'description', 'tags', 'thumbnail'):
+                target[key] = staged.get(key)
+        del self.items[staged['id']]
+        return {'success': True}
+
+
+if __name__ == "__main__":
+    # A quick check that it answers. See benchmark_portal.py for the real workout.
+    import requests
+    with FakePortal() as fake:
+        fake.addItem(title='Roads', name='Roads', type='Map Service')
+        token = requests.post(fake.url + '/sharing/rest/generateToken',
+            data={'username': fake.username, 'password': fake.password, 'f': 'json'}).json()['token']
+        res = requests.post(fake.url + '/sharing/rest/search',
+            data={'q': '', 'filter': 'title:"roads" AND type:"Map Service"', 'token': token, 'f': 'json'}).json()
+        assert res['total'] == 1
+        print(fake.stats())
+    print("Unit tests passed.")
@@ -0,0 +1,316 @@
+"""
+incremental_refresh.py
+
+Brings the Web Mercator copies in Basemap.gdb up to date with the enterprise
+geodatabase by only moving the features that changed, instead of copying,
+unsplitting and reprojecting the whole county like ProcessBasemapData does.
+
+For each source layer, a state file (next to the geodatabase,
+Basemap.gdb.refresh.json) remembers what we saw last time:
+
+    * layers with editor tracking: each OBJECTID's Config.EDITED_FIELD value,
+      so we can tell what was inserted (a new id), updated (its value is
+      different) and deleted (an id that is gone). Comparing every feature's
+      value, instead of looking for values after the newest one we saw,
+      still catches an edit that was committed late, or posted from a
+      version, with a time from before our last run,
+    * layers without it: a hash of each feature's geometry and attributes.
+
+Plain layers (the split roads, trails, parks...) get a SRC_OID field that
+points back at the source feature, so an update is "delete the old copy,
+insert the new one, reprojected".
+
+The unsplit layers (roads_unsplit, water_lines) are made by dissolving groups
+of features that share the same dissolve attributes. When a feature changes,
+its old and new groups get dissolved again, from the source, and only those
+groups are replaced; the rest of the layer is left alone.
+
+The first run for a layer (no state, or a copy made by ProcessBasemapData
+without SRC_OID) rebuilds it completely and saves the state.
+
+    python incremental_refresh.py [Basemap.gdb]
+"""
+import os, sys
+import json
+import time
+import hashlib
+import arcpy
+from config import Config
+from process_basemap_data import (find_my_layers, unsplit_lines, add_miles, project, layer_source, open_source,
+                                  ROAD_DISSOLVE, ROAD_ATTRIBUTES, WATER_DISSOLVE, WATER_WHERE)
+
+SRC_OID = "SRC_OID"
+STATE_EXT = ".refresh.json"
+# Longer IN (...) lists than this get split up, databases have limits.
+IN_CHUNK = 1000
+
+# The layers in Basemap.gdb that are copies of one source layer.
+PLAIN = {
+    'roads': 'roads',
+    'trails': 'trails',
+    'water_polygons': 'water_polygons',
+    'parks': 'parks',
+    'county_boundary': 'county_boundary',
+}
+
+# The layers that are unsplit (dissolved) from a source layer.
+UNSPLIT = {
+    'roads_unsplit': {'source': 'roads', 'dissolve': ROAD_DISSOLVE, 'attributes': ROAD_ATTRIBUTES,
+                      'where': None, 'miles': True},
+    'water_lines': {'source': 'water_lines', 'dissolve': WATER_DISSOLVE, 'attributes': [],
+                    'where': WATER_WHERE, 'miles': False},
+}
+
+
+def read_state(workspace: str) -> dict:
+    try:
+        with open(workspace + STATE_EXT) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        pass
+    return {}
+
+
+def write_state(workspace: str, state: dict) -> None:
+    filename = workspace + STATE_EXT
+    with open(filename + '.tmp', 'w') as fp:
+        json.dump(state, fp)
+    os.replace(filename + '.tmp', filename)
+    return
+
+
+def copy_fields(layer) -> list:
+    """ The fields we copy from a source, everything but the ones the geodatabase fills in. """
+    return [f.name for f in arcpy.ListFields(layer)
+            if f.editable and f.type not in ('OID', 'Geometry', 'GlobalID', 'Blob', 'Raster')
+            and f.name.lower() not in ('shape_length', 'shape_area', 'shape.stlength()', 'shape.starea()')]
+
+
+def in_clauses(field: str, ids: list) -> list:
+    """ "field IN (...)" where clauses, IN_CHUNK ids at a time. """
+    ids = sorted(int(i) for i in ids)
+    return ["%s IN (%s)" % (field, ','.join(str(i) for i in ids[n:n + IN_CHUNK])) for n in range(0, len(ids), IN_CHUNK)]
+
+
+def find_changes(layer, previous: dict, group_fields: list) -> tuple:
+    """
+    Compare a source layer with what we saw last time.
+    Returns (inserted or updated ids, deleted ids, the new state for the layer).
+    The state has each feature's group (the values of 'group_fields') so the
+    groups of deleted features can be found later.
+    """
+    previous = previous or {}
+    before = previous.get('rows', {})
+    fields = [f.name for f in arcpy.ListFields(layer)]
+    rows = {}
+    changed = []
+
+    if Config.EDITED_FIELD.lower() in (f.lower() for f in fields):
+        with arcpy.da.SearchCursor(layer, ['OID@', Config.EDITED_FIELD] + group_fields) as cursor:
+            for row in cursor:
+                oid = str(row[0])
+                edited = row[1].isoformat() if row[1] else None
+                rows[oid] = {'g': list(row[2:]), 'e': edited}
+                if oid not in before or before[oid].get('e') != edited:
+                    changed.append(oid)
+        state = {'mode': 'edited', 'rows': rows}
+    else:
+        attributes = copy_fields(layer)
+        with arcpy.da.SearchCursor(layer, ['OID@', 'SHAPE@WKB'] + attributes) as cursor:
+            for row in cursor:
+                oid = str(row[0])
+                h = hashlib.blake2b(digest_size=16)
+                for value in row[1:]:
+                    h.update(bytes(value) if isinstance(value, (bytes, bytearray, memoryview)) else repr(value).encode('utf-8'))
+                rows[oid] = {'g': [row[2 + attributes.index(g)] for g in group_fields], 'h': h.hexdigest()}
+                if oid not in before or before[oid].get('h') != rows[oid]['h']:
+                    changed.append(oid)
+        state = {'mode': 'hash', 'rows': rows}
+
+    deleted = [oid for oid in before if oid not in rows]
+    return (changed, deleted, state)
+
+
+def create_copy(layer, dest: str) -> None:
+    """ An empty Web Mercator feature class with the source's fields and SRC_OID. """
+    if arcpy.Exists(dest):
+        arcpy.management.Delete(dest)
+    (path, name) = os.path.split(dest)
+    arcpy.management.CreateFeatureclass(path, name, arcpy.Describe(layer).shapeType.upper(), template=layer,
+                                        spatial_reference=arcpy.SpatialReference(text=Config.WM_SRS))
+    arcpy.management.AddField(dest, SRC_OID, "LONG")
+    return
+
+
+def apply_changes(layer, dest: str, changed: list, deleted: list) -> int:
+    """ Replace the changed features in a plain copy, and drop the deleted ones. Returns features written. """
+    wm = arcpy.SpatialReference(text=Config.WM_SRS)
+    for where in in_clauses(SRC_OID, changed + deleted):
+        with arcpy.da.UpdateCursor(dest, [SRC_OID], where_clause=where) as cursor:
+            for row in cursor:
+                cursor.deleteRow()
+
+    fields = copy_fields(layer)
+    written = 0
+    oid_field = arcpy.Describe(layer).OIDFieldName
+    with arcpy.da.InsertCursor(dest, ['SHAPE@', SRC_OID] + fields) as out:
+        for where in in_clauses(oid_field, changed):
+            with arcpy.da.SearchCursor(layer, ['SHAPE@', 'OID@'] + fields, where_clause=where) as cursor:
+                for row in cursor:
+                    shape = row[0].projectAs(wm, Config.TRANSFORMS[0]) if row[0] else None
+                    out.insertRow([shape] + list(row[1:]))
+                    written += 1
+    return written
+
+
+def group_where(datasource: str, fields: list, groups) -> str:
+    """ A where clause for the features in these groups of 'fields' values, (a = 1 AND b = 'x') OR (...) """
+    names = [arcpy.AddFieldDelimiters(datasource, f) for f in fields]
+    clauses = []
+    for group in sorted(groups, key=repr):
+        terms = []
+        for (name, value) in zip(names, group):
+            if value is None:
+                terms.append("%s IS NULL" % name)
+            elif isinstance(value, str):
+                terms.append("%s = '%s'" % (name, value.replace("'", "''")))
+            else:
+                terms.append("%s = %s" % (name, value))
+        clauses.append("(%s)" % " AND ".join(terms))
+    return " OR ".join(clauses)
+
+
+def redissolve(layer, dest: str, spec: dict, groups: set, everything: bool, remaining: set = None) -> int:
+    """
+    Dissolve the source features in 'remaining' (the affected groups that
+    still have features) again and put them in place of 'groups' in 'dest'.
+    'everything' means rebuild the whole layer. Returns features written.
+    """
+    if not everything and arcpy.Exists(dest):
+        with arcpy.da.UpdateCursor(dest, spec['dissolve']) as cursor:
+            for row in cursor:
+                if tuple(row) in groups:
+                    cursor.deleteRow()
+    if not everything and not remaining:
+        return 0
+
+    (datasource, where, version) = layer_source(layer)
+    if not everything:
+        subset = group_where(datasource, spec['dissolve'], remaining)
+        where = "(%s) AND (%s)" % (where, subset) if where else subset
+    name = os.path.basename(dest) + "_changed"
+    source = arcpy.management.MakeFeatureLayer(open_source(name + "_source", datasource, '', version), name,
+                                               where_clause=where or None)[0]
+
+    (scratch, dissolved) = unsplit_lines(source, spec['dissolve'], spec['attributes'])
+    if spec['miles']:
+        add_miles(dissolved)
+    if spec['where']:
+        dissolved = arcpy.management.MakeFeatureLayer(dissolved, name + "_layer", where_clause=spec['where'])[0]
+    projected = os.path.join(arcpy.env.scratchGDB, name + "_wm")
+    project(dissolved, projected)
+    written = int(arcpy.management.GetCount(projected)[0])
+    if everything or not arcpy.Exists(dest):
+        if arcpy.Exists(dest):
+            arcpy.management.Delete(dest)
+        arcpy.management.Copy(projected, dest)
+    else:
+        arcpy.management.Append(projected, dest, "NO_TEST")
+    for fc in (scratch, projected):
+        arcpy.management.Delete(fc)
+    return written
+
+
+def refresh(m, workspace: str) -> int:
+    """ Bring the copies in 'workspace' up to date with the layers in map 'm'. Returns the number of errors. """
+    arcpy.env.overwriteOutput = True
+    arcpy.env.workspace = arcpy.env.scratchGDB
+    layers = find_my_layers(m, workspace)
+    state = read_state(workspace)
+    errors = 0
+
+    for source in sorted(set(PLAIN.values()) | {spec['source'] for spec in UNSPLIT.values()}):
+        t0 = time.perf_counter()
+        layer = layers[source]['layer']
+        unsplit = {dest: spec for (dest, spec) in UNSPLIT.items() if spec['source'] == source}
+        group_fields = []
+        for spec in unsplit.values():
+            group_fields += [f for f in spec['dissolve'] if f not in group_fields]
+        previous = state.get(source)
+        if previous and previous.get('group_fields') != group_fields:
+            previous = None
+        if previous and previous.get('mode') == 'edited' and not all('e' in row for row in previous['rows'].values()):
+            # Without every feature's edited value there's nothing to compare with, start over.
+            previous = None
+        try:
+            (changed, deleted, current) = find_changes(layer, previous, group_fields)
+        except Exception as e:
+            print("Could not read \"%s\"." % source, e)
+            errors += 1
+            continue
+        current['group_fields'] = group_fields
+        print("%s: %d inserted or updated, %d deleted" % (source, len(changed), len(deleted)))
+
+        ok = True
+        for (dest, src) in PLAIN.items():
+            if src != source:
+                continue
+            destpath = os.path.join(workspace, dest)
+            try:
+                if not previous or not arcpy.Exists(destpath) or SRC_OID not in [f.name for f in arcpy.ListFields(destpath)]:
+                    print("    Rebuilding %s" % dest)
+                    create_copy(layer, destpath)
+                    n = apply_changes(layer, destpath, list(current['rows']), [])
+                elif changed or deleted:
+                    n = apply_changes(layer, destpath, changed, deleted)
+                else:
+                    n = 0
+                print("    %s: %d features written" % (dest, n))
+            except Exception as e:
+                print("    %s failed!" % dest, e)
+                ok = False
+
+        for (dest, spec) in unsplit.items():
+            destpath = os.path.join(workspace, dest)
+            n_fields = [group_fields.index(f) for f in spec['dissolve']]
+            def group(row):
+                return tuple(row['g'][i] for i in n_fields)
+            try:
+                everything = not previous or not arcpy.Exists(destpath)
+                old = previous['rows'] if previous else {}
+                groups = {group(old[oid]) for oid in changed + deleted if oid in old}
+                groups |= {group(current['rows'][oid]) for oid in changed}
+                remaining = groups & {group(row) for row in current['rows'].values()}
+                if everything:
+                    print("    Rebuilding %s" % dest)
+                    n = redissolve(layer, destpath, spec, set(), True)
+                elif groups:
+                    n = redissolve(layer, destpath, spec, groups, False, remaining)
+                else:
+                    n = 0
+                print("    %s: %d groups dissolved again, %d features written" % (dest, len(groups), n))
+            except Exception as e:
+                print("    %s failed!" % dest, e)
+                ok = False
+
+        if ok:
+            # Only save the state when everything made it, so a failure gets retried next time.
+            state[source] = current
+            write_state(workspace, state)
+        else:
+            errors += 1
+        print("    %.1fs" % (time.perf_counter() - t0))
+
+    return errors
+
+
+if __name__ == "__main__":
+    basemap_aprx = arcpy.mp.ArcGISProject(Config.BASEMAP_APRX)
+    workspace = os.path.abspath(sys.argv[1]) if len(sys.argv) > 1 else basemap_aprx.defaultGeodatabase
+    m = basemap_aprx.listMaps(Config.DATASOURCE_MAP)[0]
+    print(f"Project: {Config.BASEMAP_APRX} Map: \"{m.name}\" => {workspace}")
+    errors = refresh(m, workspace)
+    if errors:
+        print("There were errors (%d anyway), run me again when they're fixed." % errors)
+        exit(1)
+    print("All done!!")
@@ -0,0 +1,340 @@
+"""
+line_merge.py
+
+Does what arcpy.management.UnsplitLine does for our roads and water lines,
+in one pass over the vertices.
+
+    * Every line's two ends go in a hash table, keyed on the dissolve
+      attributes (StreetName, FunClassM...) and the point.
+    * Where exactly two lines with the same attributes meet, they get joined.
+      Where three or more meet (a Y or a cross street with the same name),
+      they don't, same as UnsplitLine.
+    * Each chain of joined lines is walked once, flipping lines that point
+      the wrong way, and its vertices are copied once.
+    * The other attributes get FIRST (or LAST, MIN, MAX, SUM, COUNT) as we go,
+      and keep their own names, so there is no "FIRST_Alias" to rename.
+
+There's one pass over the vertices and a few dict lookups per line end, but
+it doesn't scale quite linearly: once the dicts are bigger than the CPU cache
+the lookups slow down. On my machine the benchmark goes from about 600k
+vertices/s at 100k vertices to about 400k vertices/s at 1.6M, and with the
+0.001 m tolerance unsplit uses, from about 350k to 300k. Z and M values are
+dropped, our lines don't have any.
+
+With a tolerance, ends closer than that are the same point. Snapping to a
+grid isn't enough for that (two ends either side of a cell boundary would
+land in different cells), so each end is also checked against the ends in
+the cells next to it, see close_ends.
+
+    python line_merge.py          unit tests and a benchmark on a made up county
+"""
+import os, sys
+import time
+import struct
+import numpy as np
+
+STATISTICS = ('FIRST', 'LAST', 'MIN', 'MAX', 'SUM', 'COUNT')
+
+# AddField wants different names than ListFields gives.
+FIELD_TYPES = {'String': 'TEXT', 'Integer': 'LONG', 'SmallInteger': 'SHORT', 'BigInteger': 'BIGINTEGER',
+               'Double': 'DOUBLE', 'Single': 'FLOAT', 'Date': 'DATE', 'GUID': 'GUID'}
+
+
+def close_ends(ends: np.ndarray, groups: list, tolerance: float) -> list:
+    """
+    Number the ends so that ends in the same group closer than 'tolerance'
+    (or joined by steps that are) get the same number.
+
+    The grid cells are 2 * tolerance wide, so an end only has to be checked
+    against its own cell and the neighbours on the side of the cell it's in.
+    """
+    # Most ends sit exactly on another one, only look at each point once.
+    numbers = {}
+    end_groups = np.repeat([numbers.setdefault(g, len(numbers)) for g in groups], 2)
+    order = np.lexsort((ends[:, 1], ends[:, 0], end_groups))
+    new = np.ones(len(order), dtype=bool)
+    new[1:] = ((end_groups[order][1:] != end_groups[order][:-1]) |
+               np.any(ends[order][1:] != ends[order][:-1], axis=1))
+    inverse = np.empty(len(order), dtype=np.int64)
+    inverse[order] = np.cumsum(new) - 1
+    groups = end_groups[order][new].tolist()
+    ends = ends[order][new]
+
+    size = 2 * tolerance
+    cells = np.floor(ends / size)
+    sides = np.where(ends / size - cells < 0.5, -1, 1).tolist()
+    cells = cells.astype(np.int64).tolist()
+    points = ends.tolist()
+    limit = tolerance * tolerance
+
+    parent = list(range(len(points)))
+    def find(e):
+        while parent[e] != e:
+            parent[e] = parent[parent[e]]
+            e = parent[e]
+        return e
+
+    grid = {}
+    for e in range(len(points)):
+        ((cx, cy), (sx, sy), (x, y)) = (cells[e], sides[e], points[e])
+        group = groups[e]
+        for cell in ((cx, cy), (cx + sx, cy), (cx, cy + sy), (cx + sx, cy + sy)):
+            for f in grid.get((group, cell[0], cell[1]), ()):
+                if (points[f][0] - x) ** 2 + (points[f][1] - y) ** 2 <= limit:
+                    parent[find(f)] = find(e)
+        grid.setdefault((group, cx, cy), []).append(e)
+    labels = [find(e) for e in range(len(points))]
+    return [labels[u] for u in inverse.tolist()]
+
+
+def chains(xy: np.ndarray, parts: np.ndarray, groups: list, tolerance: float = 0.0) -> list:
+    """
+    Work out which lines join up.
+
+    'xy' and 'parts' are flat lines, like reproject.Geometries: line i is
+    xy[parts[i]:parts[i+1]]. 'groups' has a hashable key (the dissolve values)
+    for each line. Endpoints closer than 'tolerance' count as the same point.
+
+    Returns a list of chains, each a list of (line, reversed), in order.
+    """
+    n = len(parts) - 1
+    ends = np.empty((2 * n, 2))
+    ends[0::2] = xy[parts[:-1]]
+    ends[1::2] = xy[parts[1:] - 1]
+    if tolerance:
+        labels = close_ends(ends, groups, tolerance)
+        keys = [(groups[e // 2], labels[e]) for e in range(2 * n)]
+    else:
+        ends = ends.tolist()
+        keys = [(groups[e // 2], ends[e][0], ends[e][1]) for e in range(2 * n)]
+
+    # End 2i is where line i starts, 2i+1 is where it ends.
+    nodes = {}
+    for e in range(2 * n):
+        key = keys[e]
+        found = nodes.get(key)
+        if found is None:
+            nodes[key] = [e]
+        else:
+            found.append(e)
+
+    # Where exactly two ends meet, each one is the other's partner.
+    partner = [-1] * (2 * n)
+    for found in nodes.values():
+        if len(found) == 2 and found[0] // 2 != found[1] // 2:
+            (a, b) = found
+            partner[a] = b
+            partner[b] = a
+
+    visited = bytearray(n)
+    result = []
+    for i in range(n):
+        if visited[i]:
+            continue
+        # Back up to the first line of the chain (or all the way round, if it's a loop).
+        head = (i, False)
+        entry = 2 * i
+        while partner[entry] >= 0:
+            e = partner[entry]
+            line = e // 2
+            if line == i:
+                break
+            head = (line, e % 2 == 0)
+            entry = e ^ 1
+
+        chain = []
+        (line, rev) = head
+        while True:
+            visited[line] = 1
+            chain.append((line, rev))
+            e = partner[2 * line + (0 if rev else 1)]
+            if e < 0 or visited[e // 2]:
+                break
+            (line, rev) = (e // 2, e % 2 == 1)
+        result.append(chain)
+    return result
+
+
+def chain_xy(xy: np.ndarray, parts: np.ndarray, chain: list) -> np.ndarray:
+    """ The points of a chain of lines, without repeating the shared ends. """
+    pieces = []
+    for (k, (line, rev)) in enumerate(chain):
+        points = xy[parts[line]:parts[line + 1]]
+        if rev:
+            points = points[::-1]
+        pieces.append(points if k == 0 else points[1:])
+    return np.concatenate(pieces)
+
+
+def aggregate(values: list, statistic: str):
+    """ One statistic of the values of the lines in a chain, in the order they were read. """
+    if statistic == 'FIRST':
+        return values[0]
+    if statistic == 'LAST':
+        return values[-1]
+    if statistic == 'COUNT':
+        return len(values)
+    present = [v for v in values if v is not None]
+    if not present:
+        return None
+    if statistic == 'MIN':
+        return min(present)
+    if statistic == 'MAX':
+        return max(present)
+    if statistic == 'SUM':
+        return sum(present)
+    raise ValueError("Unknown statistic \"%s\"." % statistic)
+
+
+def merge(xy: np.ndarray, parts: np.ndarray, line_feature: np.ndarray, groups: list, rows: list,
+          statistics: list, tolerance: float = 0.0) -> list:
+    """
+    Merge lines. 'line_feature' says which feature each line (part) came
+    from, 'groups' and 'rows' are the dissolve values and the other values
+    of each feature, 'statistics' has one statistic per value in a row.
+    Returns a list of (points, group, values).
+    """
+    line_groups = [groups[f] for f in line_feature.tolist()]
+    merged = []
+    for chain in chains(xy, parts, line_groups, tolerance):
+        # FIRST means the first feature we read, not the first one along the line.
+        features = sorted({int(line_feature[line]) for (line, rev) in chain})
+        values = [aggregate([rows[f][k] for f in features], s) for (k, s) in enumerate(statistics)]
+        merged.append((chain_xy(xy, parts, chain), line_groups[chain[0][0]], values))
+    return merged
+
+
+def linestring_wkb(points: np.ndarray) -> bytes:
+    return struct.pack('<BII', 1, 2, len(points)) + np.ascontiguousarray(points, dtype='<f8').tobytes()
+
+
+def unsplit(src, dst: str, dissolve_fields: list, attributes: list = None, tolerance: float = None) -> int:
+    """
+    Like arcpy.management.UnsplitLine(src, dst, dissolve_fields, attributes)
+    but the statistics fields keep their names. 'attributes' is a list of
+    [field, statistic]. Returns the number of lines written.
+    """
+    import arcpy
+    from reproject import Geometries
+    attributes = attributes or []
+    desc = arcpy.Describe(src)
+    sr = desc.spatialReference
+    if tolerance is None:
+        tolerance = getattr(sr, 'XYTolerance', None) or 0.0
+    names = dissolve_fields + [field for (field, statistic) in attributes]
+    statistics = [statistic.upper() for (field, statistic) in attributes]
+    for s in statistics:
+        if s not in STATISTICS:
+            raise ValueError("Unknown statistic \"%s\"." % s)
+
+    blobs = []
+    groups = []
+    rows = []
+    with arcpy.da.SearchCursor(src, ['SHAPE@WKB'] + names, sql_clause=(None, 'ORDER BY %s' % desc.OIDFieldName)) as cursor:
+        for row in cursor:
+            if not row[0]:
+                continue
+            blobs.append(bytes(row[0]))
+            groups.append(tuple(row[1:1 + len(dissolve_fields)]))
+            rows.append(row[1 + len(dissolve_fields):])
+    g = Geometries(blobs)
+    line_feature = np.repeat(np.arange(len(blobs)), np.diff(g.features))
+    merged = merge(g.xy, g.parts, line_feature, groups, rows, statistics, tolerance)
+
+    fields = {f.name.lower(): f for f in arcpy.ListFields(src)}
+    if arcpy.Exists(dst):
+        arcpy.management.Delete(dst)
+    (path, name) = os.path.split(dst)
+    arcpy.management.CreateFeatureclass(path or arcpy.env.workspace, name, "POLYLINE", spatial_reference=sr)
+    for (field, statistic) in [(f, None) for f in dissolve_fields] + [(f, s) for (f, s) in attributes]:
+        f = fields[field.lower()]
+        kind = 'LONG' if statistic and statistic.upper() == 'COUNT' else FIELD_TYPES.get(f.type, 'TEXT')
+        arcpy.management.AddField(dst, f.name, kind, field_length=f.length if kind == 'TEXT' else None,
+                                  field_alias=f.aliasName)
+
+    with arcpy.da.InsertCursor(dst, ['SHAPE@'] + names) as cursor:
+        for (points, group, values) in merged:
+            cursor.insertRow([arcpy.FromWKB(bytearray(linestring_wkb(points)), sr)] + list(group) + values)
+    return len(merged)
+
+
+def synthetic_county(streets: int = 200, blocks: int = 200, splits: int = 3, seed: int = 1) -> tuple:
+    """
+    A grid of east-west and north-south streets, cut at every intersection
+    and a few more times in between, like road centerlines from the county.
+    Some segments point backwards. Returns (xy, parts, line_feature, groups, rows).
+    """
+    rng = np.random.default_rng(seed)
+    block = 100.0
+    points_per_segment = splits + 2
+    lines = []
+    groups = []
+    for direction in (0, 1):
+        for s in range(streets):
+            for b in range(blocks):
+                # Each block is split into 'splits' + 1 pieces with a few vertices each.
+                t = np.linspace(b * block, (b + 1) * block, points_per_segment * (splits + 1) - splits)
+                for piece in np.array_split(np.arange(len(t)), splits + 1):
+                    lo, hi = piece[0], min(piece[-1] + 1, len(t) - 1)
+                    u = t[lo:hi + 1]
+                    v = np.full(len(u), s * block) + rng.normal(0, 0.5, len(u)) * (np.arange(len(u)) % (len(u) - 1) != 0)
+                    pts = np.column_stack([u, v] if direction == 0 else [v, u])
+                    lines.append(pts[::-1] if rng.random() < 0.3 else pts)
+                    groups.append(("%s %d" % ("ST" if direction == 0 else "AVE", s), "Local"))
+    order = rng.permutation(len(lines))
+    lines = [lines[i] for i in order]
+    groups = [groups[i] for i in order]
+    sizes = np.array([len(l) for l in lines])
+    parts = np.concatenate([[0], np.cumsum(sizes)])
+    rows = [("PAVED", i) for i in range(len(lines))]
+    return (np.concatenate(lines), parts, np.arange(len(lines)), groups, rows)
+
+
+if __name__ == "__main__":
+    # Three pieces of Main St, one backwards, a side street, and a loop.
+    def flat(lines):
+        parts = np.concatenate([[0], np.cumsum([len(l) for l in lines])])
+        return (np.array([p for l in lines for p in l], dtype=float), parts)
+    (xy, parts) = flat([
+        [(0, 0), (1, 0)], [(2, 0), (1, 0)], [(2, 0), (3, 0)],  # Main St
+        [(1, 0), (1, 1)],                                      # Side St, meets Main St
+        [(5, 5), (6, 5), (6, 6), (5, 5)],                      # a loop by itself
+        [(3, 0), (3, 1)], [(3, 0), (4, 0)],                    # Main St forks at (3, 0)
+    ])
+    groups = ['Main', 'Main', 'Main', 'Side', 'Loop', 'Main', 'Main']
+    rows = [('A', 1), ('B', 2), ('C', 3), ('D', 4), ('E', 5), ('F', 6), ('G', 7)]
+    merged = merge(xy, parts, np.arange(7), groups, rows, ['FIRST', 'SUM'])
+    result = sorted((len(p), g, v) for (p, g, v) in merged)
+    # Main St's first three pieces join (the side street is another group), the fork doesn't.
+    assert result == [(2, 'Main', ['F', 6]), (2, 'Main', ['G', 7]), (2, 'Side', ['D', 4]),
+                      (4, 'Loop', ['E', 5]), (4, 'Main', ['A', 6])], result
+    main = [p for (p, g, v) in merged if g == 'Main' and len(p) == 4][0]
+    assert main[:, 0].tolist() in ([0, 1, 2, 3], [3, 2, 1, 0]), main
+    # A ring of pieces all in one group comes out as one line.
+    (xy, parts) = flat([[(0, 0), (1, 0)], [(1, 0), (1, 1)], [(0, 1), (1, 1)], [(0, 1), (0, 0)]])
+    ring = merge(xy, parts, np.arange(4), ['R'] * 4, [()] * 4, [])
+    assert len(ring) == 1 and len(ring[0][0]) == 5, ring
+    # Ends that are almost the same point join when there is a tolerance.
+    (xy, parts) = flat([[(0, 0), (1, 0)], [(1.0000001, 0), (2, 0)]])
+    assert len(merge(xy, parts, np.arange(2), ['X'] * 2, [()] * 2, [])) == 2
+    assert len(merge(xy, parts, np.arange(2), ['X'] * 2, [()] * 2, [], tolerance=0.001)) == 1
+    # Even when they'd snap to different grid cells, or are in different groups.
+    (xy, parts) = flat([[(0, 0), (1.0004999, 0)], [(1.0005001, 0), (2, 0)]])
+    assert len(merge(xy, parts, np.arange(2), ['X'] * 2, [()] * 2, [], tolerance=0.001)) == 1
+    assert len(merge(xy, parts, np.arange(2), ['X', 'Y'], [()] * 2, [], tolerance=0.001)) == 2
+    (xy, parts) = flat([[(0, 0), (1, 0)], [(1.002, 0), (2, 0)]])
+    assert len(merge(xy, parts, np.arange(2), ['X'] * 2, [()] * 2, [], tolerance=0.001)) == 2
+    print("Unit tests passed.")
+
+    # unsplit uses the feature class's XY tolerance, 0.001 m is the usual one.
+    for tolerance in (0.0, 0.001):
+        for (streets, blocks) in ((50, 50), (100, 100), (200, 200)):
+            (xy, parts, line_feature, groups, rows) = synthetic_county(streets, blocks)
+            t0 = time.perf_counter()
+            merged = merge(xy, parts, line_feature, groups, rows, ['FIRST', 'MIN'], tolerance)
+            seconds = time.perf_counter() - t0
+            # Every street comes out as one line, with every vertex but the shared ones.
+            assert len(merged) == 2 * streets, len(merged)
+            assert sum(len(p) for (p, g, v) in merged) == len(xy) - (len(parts) - 1 - len(merged))
+            print("tolerance %g: %7d lines, %8d vertices => %4d lines in %.2fs (%.0f vertices/s)" % (
+                tolerance, len(parts) - 1, len(xy), len(merged), seconds, len(xy) / seconds))
@@ -0,0 +1,307 @@
+"""
+multipart_upload.py
+
+Uploads a big file (like a .vtpk) to Portal in parts.
+
+content.add(data=pkgfile) sends the whole thing in one request, so if the
+connection drops halfway through a 500 MB package you start over.
+This uses the multipart upload in the sharing REST API instead:
+
+    addItem (multipart=true)  creates an empty item
+    addPart (partNum=1..N)    sends each piece, several at a time
+    commit                    puts the pieces together into the item
+
+Which parts are done gets saved in a manifest next to the file
+(Vector_Tiles.vtpk => Vector_Tiles.vtpk.upload.json), so if the upload
+gets interrupted, running it again only sends the parts that are missing.
+Before the commit, the file is read again and every part's checksum is
+compared with the one recorded when it was sent, so a file that changed
+during the upload never gets committed.
+
+    from multipart_upload import upload
+    itemid = upload(pkgfile, {'title': 'Vector Tiles'}, folder='Basemaps')
+    pkg_item = gis.content.get(itemid)
+"""
+import os, sys
+import json
+import time
+import hashlib
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from config import Config
+
+# Portal won't take more parts than this.
+MAX_PARTS = 10000
+MANIFEST_EXT = '.upload.json'
+
+ITEM_TYPES = {'.vtpk': 'Vector Tile Package', '.tpkx': 'Tile Package', '.sd': 'Service Definition'}
+
+
+class Manifest(object):
+    """ What we know about an upload, kept on disk so it can be resumed. """
+
+    def __init__(self, pkgfile: str) -> None:
+        self.filename = pkgfile + MANIFEST_EXT
+        self.data = {}
+        self._lock = threading.Lock()
+        try:
+            with open(self.filename) as fp:
+                self.data = json.load(fp)
+        except (OSError, ValueError):
+            pass
+        return
+
+    def matches(self, stat, part_size: int) -> bool:
+        """ Is this manifest for the same file, cut up the same way? """
+        return (self.data.get('itemid') and self.data.get('size') == stat.st_size
+                and self.data.get('mtime') == stat.st_mtime and self.data.get('part_size') == part_size)
+
+    def start(self, itemid: str, stat, part_size: int) -> None:
+        self.data = {'itemid': itemid, 'size': stat.st_size, 'mtime': stat.st_mtime,
+                     'part_size': part_size, 'started': datetime.now().isoformat(), 'parts': {}}
+        self.save()
+        return
+
+    def done(self, num: int, checksum: str) -> None:
+        with self._lock:
+            self.data['parts'][str(num)] = checksum
+            self.save()
+        return
+
+    def save(self) -> None:
+        # Write it to the side then swap it in, so an interruption can't leave half a manifest.
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump(self.data, fp, indent=2)
+        os.replace(tmp, self.filename)
+        return
+
+    def remove(self) -> None:
+        if os.path.exists(self.filename):
+            os.unlink(self.filename)
+        return
+
+
+def pending(pkgfile: str) -> str:
+    """ The id of the unfinished upload of this file, if there is one. """
+    return Manifest(pkgfile).data.get('itemid')
+
+
+def read_part(pkgfile: str, num: int, part_size: int) -> bytes:
+    """ Part numbers start at 1. """
+    with open(pkgfile, 'rb') as fp:
+        fp.seek((num - 1) * part_size)
+        return fp.read(part_size)
+
+
+def part_checksums(pkgfile: str, part_size: int) -> tuple:
+    """ sha256 of each part of the file as it is on disk now, and of the whole file. """
+    checksums = {}
+    whole = hashlib.sha256()
+    with open(pkgfile, 'rb') as fp:
+        num = 1
+        while True:
+            data = fp.read(part_size)
+            if not data and num > 1:
+                break
+            checksums[str(num)] = hashlib.sha256(data).hexdigest()
+            whole.update(data)
+            if len(data) < part_size:
+                break
+            num += 1
+    return (checksums, whole.hexdigest())
+
+
+def upload(pkgfile: str, item_properties: dict, folder: str = None,
+           part_size: int = Config.UPLOAD_PART_SIZE, max_workers: int = Config.UPLOAD_WORKERS,
+           rest=None) -> str:
+    """
+    Upload 'pkgfile' in parts and create an item from it.
+
+    'item_properties' are the usual item fields (title, tags, snippet...),
+        'type' is worked out from the file extension if it's not there.
+    'folder' is the name of a folder in my content.
+    'rest' is the RestGIS to use, the one from get_session() by default.
+
+    Returns the new item's id. Raises an exception if any part could not
+    be sent; run it again with the same file to pick up where it left off.
+    """
+    if rest is None:
+        from portal import get_session
+        rest = get_session().rest
+    con = rest._con
+    userurl = rest.content._userUrl(folder)
+    filename = os.path.basename(pkgfile)
+    properties = dict(item_properties)
+    properties.setdefault('type', ITEM_TYPES.get(os.path.splitext(pkgfile)[1].lower(), 'File'))
+
+    stat = os.stat(pkgfile)
+    nparts = max(1, -(-stat.st_size // part_size))
+    if nparts > MAX_PARTS:
+        raise Exception("%s needs %d parts, Portal only takes %d. Use bigger parts." % (filename, nparts, MAX_PARTS))
+
+    def discard(itemid: str) -> None:
+        """ Delete an unfinished upload so it isn't left behind in my content. """
+        try:
+            con.post(userurl + '/items/%s/delete' % itemid)
+        except Exception as e:
+            print("Could not delete the unfinished upload %s." % itemid, e)
+        return
+
+    manifest = Manifest(pkgfile)
+    itemid = manifest.data.get('itemid')
+    server_parts = set()
+    if manifest.matches(stat, part_size):
+        try:
+            server_parts = set(con.get(userurl + '/items/%s/parts' % itemid).get('parts', []))
+            print("Resuming upload of %s, %d of %d parts already sent." % (filename, len(server_parts), nparts))
+        except Exception as e:
+            print("Can't resume the upload of %s, starting over." % filename, e)
+            discard(itemid)
+            itemid = None
+    elif itemid:
+        # The file changed since that upload started, so throw the old one away.
+        discard(itemid)
+        itemid = None
+
+    if not server_parts:
+        if itemid is None:
+            res = con.post(userurl + '/addItem', dict(properties, multipart='true', filename=filename))
+            itemid = res['id']
+        manifest.start(itemid, stat, part_size)
+    itemurl = userurl + '/items/%s' % itemid
+
+    # A part counts as done only if Portal has it too.
+    todo = [num for num in range(1, nparts + 1)
+            if num not in server_parts or str(num) not in manifest.data['parts']]
+
+    def send(num: int) -> None:
+        data = read_part(pkgfile, num, part_size)
+        checksum = hashlib.sha256(data).hexdigest()
+        for attempt in range(Config.UPLOAD_RETRIES):
+            try:
+                con.post(itemurl + '/addPart', {'partNum': num}, files={'file': ('%s.part%d' % (filename, num), data)})
+                break
+            except Exception as e:
+                if attempt + 1 == Config.UPLOAD_RETRIES:
+                    raise
+                print("Part %d of %s failed, trying again." % (num, filename), e)
+                time.sleep(2 ** attempt)
+        manifest.done(num, checksum)
+        return
+
+    t0 = time.perf_counter()
+    failed = 0
+    sent = 0
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='upload') as executor:
+        futures = {executor.submit(send, num): num for num in todo}
+        for future in as_completed(futures):
+            try:
+                future.result()
+                sent += 1
+                print("    %d/%d parts of %s" % (nparts - len(todo) + sent, nparts, filename))
+            except Exception as e:
+                failed += 1
+                print("Could not send part %d of %s." % (futures[future], filename), e)
+    if failed:
+        raise Exception("%d parts of %s were not sent. Run it again to resume." % (failed, filename))
+    seconds = time.perf_counter() - t0
+    if todo:
+        mb = sum(min(part_size, stat.st_size - (num - 1) * part_size) for num in todo) / 1024**2
+        print("Sent %.1f MB in %.1fs (%.1f MB/s)." % (mb, seconds, mb / max(seconds, 0.001)))
+
+    # Make sure what got sent is what's in the file now, and that Portal has all of it.
+    (checksums, sha256) = part_checksums(pkgfile, part_size)
+    if checksums != manifest.data['parts']:
+        discard(itemid)
+        manifest.remove()
+        raise Exception("%s changed during the upload, the checksums don't match. Start over." % filename)
+    missing = set(range(1, nparts + 1)) - set(con.get(itemurl + '/parts').get('parts', []))
+    if missing:
+        raise Exception("Portal is missing parts %s of %s. Run it again to resume." % (sorted(missing), filename))
+
+    params = dict(properties)
+    for (key, value) in params.items():
+        if isinstance(value, (list, tuple)):
+            params[key] = ','.join(value)
+    con.post(itemurl + '/commit', params)
+    while True:
+        res = con.get(itemurl + '/status')
+        if res.get('status') == 'completed':
+            break
+        if res.get('status') == 'failed':
+            raise Exception("Commit failed for %s. %s" % (filename, res.get('statusMessage')))
+        time.sleep(1)
+    manifest.remove()
+    print("Uploaded %s (sha256 %s)" % (filename, sha256))
+    return itemid
+
+
+if __name__ == "__main__":
+    # Try it against the fake portal, including an interrupted upload.
+    import tempfile
+    from fake_portal import FakePortal
+    from portal import PortalSession
+
+    workdir = tempfile.mkdtemp()
+    Config.TOKEN_CACHE_FILE = os.path.join(workdir, 'token.json')
+    pkgfile = os.path.join(workdir, 'Test_Tiles.vtpk')
+    content = os.urandom(5 * 1024 * 1024 + 123)
+    with open(pkgfile, 'wb') as fp:
+        fp.write(content)
+
+    with FakePortal(latency=0.01) as fake:
+        fake.addFolder('Basemaps')
+        rest = PortalSession(fake.url, fake.username, fake.password).rest
+
+        # Break it after a few parts.
+        real_post = rest._con.post
+        calls = 0
+        def flaky_post(url, params=None, files=None):
+            global calls
+            if url.endswith('/addPart'):
+                calls += 1
+                if calls > 4:
+                    raise Exception("Connection reset")
+            return real_post(url, params, files=files)
+        rest._con.post = flaky_post
+        Config.UPLOAD_RETRIES = 1
+        try:
+            upload(pkgfile, {'title': 'Test Tiles'}, folder='Basemaps', part_size=512 * 1024, rest=rest)
+        except Exception as e:
+            print(e)
+        else:
+            raise AssertionError("It should have failed.")
+        assert os.path.exists(pkgfile + MANIFEST_EXT)
+
+        rest._con.post = real_post
+        since = len(fake.log)
+        itemid = upload(pkgfile, {'title': 'Test Tiles'}, folder='Basemaps', part_size=512 * 1024, rest=rest)
+        assert fake.data[itemid] == content
+        assert fake.items[itemid]['type'] == 'Vector Tile Package'
+        assert not os.path.exists(pkgfile + MANIFEST_EXT)
+        print("Resumed with", fake.stats(since))
+
+        # If it can't be resumed, the unfinished item gets deleted, not orphaned.
+        rest._con.post = flaky_post
+        calls = 0
+        try:
+            upload(pkgfile, {'title': 'Test Tiles'}, folder='Basemaps', part_size=512 * 1024, rest=rest)
+        except Exception as e:
+            print(e)
+        else:
+            raise AssertionError("It should have failed.")
+        rest._con.post = real_post
+        orphan = Manifest(pkgfile).data['itemid']
+        real_get = rest._con.get
+        def broken_get(url, params=None):
+            if url.endswith('/%s/parts' % orphan):
+                raise Exception("Item does not exist or is inaccessible.")
+            return real_get(url, params)
+        rest._con.get = broken_get
+        itemid = upload(pkgfile, {'title': 'Test Tiles'}, folder='Basemaps', part_size=512 * 1024, rest=rest)
+        rest._con.get = real_get
+        assert itemid != orphan and orphan not in fake.items
+        assert fake.data[itemid] == content
+    print("Unit tests passed.")
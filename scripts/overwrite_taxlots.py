@@ -7,9 +7,8 @@
 import os, sys
 from datetime import datetime
 import arcpy
-from arcgis.gis import GIS
 from scripts.config import Config
-from scripts.portal import PortalContent
+from scripts.portal import PortalContent, get_session
 sys.path.insert(0,'')
 
 cwd = os.getcwd()
@@ -31,66 +30,83 @@ def listLayers(m):
     return
 
 
+# The fields we publish, everything else in the taxlots is left behind.
+keepers = [
+    'OBJECTID',
+
+    'ACCOUNT_ID',
+    'Taxlot',
+    'X_COORD', 'Y_COORD', ## Needed for street view
+    'TAXMAPNUM',
+    'TAXLOTKEY',
+
+    # Mailing address
+    'OWNER_LINE',
+    'OWNER_LL_1',
+    'OWNER_LL_2',
+    'STREET_ADD',
+    'CITY', 
+    'STATE', 
+    'ZIP_CODE',
+    
+    # Situs address
+    'SITUS_ADDR',
+    'SITUS_CITY',
+    
+    'TAXCODE', # Probably never used
+
+    # These are used in Sales Search in A&T
+    # "MA", "NH",
+
+    'PROPERTY_C', ## Needed for 'unimproved' layer
+
+    'Shape_Length', 'Shape_Area'
+]
+
+
+def keeper_field_mappings(src: str) -> object:
+    """ A field map with only the keepers in it. (The geodatabase makes OBJECTID and Shape_* itself.) """
+    fms = arcpy.FieldMappings()
+    wanted = {name.lower() for name in keepers}
+    for f in arcpy.ListFields(src):
+        if f.name.lower() in wanted and f.type not in ('OID', 'Geometry') and f.editable:
+            fm = arcpy.FieldMap()
+            fm.addInputField(src, f.name)
+            fms.addFieldMap(fm)
+    return fms
+
+
 def import_taxlots(src : str, dst: str) -> None:
     errors = 0
 
-    # Ancient of Days takes so LONG to delete one field at a time
-    # even when working from a local FGDB in SSD. Oh well. Normally I don't sit and watch.
-    # I tried deleting a list of fields but that failed.
-    # I tried using a field map in the Project step but that failed too.
-
+    # Ancient of Days took so LONG to delete one field at a time after Project,
+    # even when working from a local FGDB in SSD.
+    # Project can't take a field map, but every tool projects on the way out
+    # when outputCoordinateSystem is set, so this is one copy: only the keepers
+    # get read, and the features are reprojected as they are written.
+    # Project had in_coor_system for a source with no coordinate system,
+    # an environment can't do that. The taxlots are in LOCAL_SRS, so if the
+    # source doesn't say so, copy it to memory and say so there first.
+    # Otherwise nothing gets projected and the taxlots land off the coast of Africa.
+    unknown = None
     try:
+        if arcpy.Describe(src).spatialReference.name == "Unknown":
+            print("%s has no coordinate system, assuming it's LOCAL_SRS." % src)
+            unknown = "memory\\taxlots_unknown_srs"
+            arcpy.conversion.ExportFeatures(src, unknown, field_mapping=keeper_field_mappings(src))
+            arcpy.management.DefineProjection(unknown, Config.LOCAL_SRS)
+            src = unknown
+
         print("Reprojecting %s to %s" % (src, dst)) # dst cannot be in memory!!
-        arcpy.management.Project(in_dataset=src, out_dataset=dst, 
-            out_coor_system = Config.WM_SRS, transform_method = Config.TRANSFORMS,
-            in_coor_system = Config.LOCAL_SRS,
-            preserve_shape="NO_PRESERVE_SHAPE", max_deviation="", vertical="NO_VERTICAL")
+        with arcpy.EnvManager(outputCoordinateSystem=Config.WM_SRS,
+                              geographicTransformations=";".join(Config.TRANSFORMS)):
+            arcpy.conversion.ExportFeatures(src, dst, field_mapping=keeper_field_mappings(src))
     except Exception as e:
         print("Failed!", e)
         errors += 1
-
-    keepers = [
-        'OBJECTID',
-
-        'ACCOUNT_ID',
-        'Taxlot',
-        'X_COORD', 'Y_COORD', ## Needed for street view
-        'TAXMAPNUM',
-        'TAXLOTKEY',
-
-        # Mailing address
-        'OWNER_LINE',
-        'OWNER_LL_1',
-        'OWNER_LL_2',
-        'STREET_ADD',
-        'CITY', 
-        'STATE', 
-        'ZIP_CODE',
-        
-        # Situs address
-        'SITUS_ADDR',
-        'SITUS_CITY',
-        
-        'TAXCODE', # Probably never used
-
-        # These are used in Sales Search in A&T
-        # "MA", "NH",
-
-        'PROPERTY_C', ## Needed for 'unimproved' layer
-
-        'Shape_Length', 'Shape_Area'
-    ]
-    actual_fields = arcpy.ListFields(dst, '*')
-    deletethese = []
-    for f in actual_fields:
-        if not f.name in keepers and f.type != 'Geometry':
-            deletethese.append(f.name)
-    try:
-        for field in deletethese:
-            print("Deleting", field)
-            arcpy.management.DeleteField(dst, field)
-    except Exception as e:
-        print(f"WARNING, field delete failed for {field}.", e)
+    finally:
+        if unknown and arcpy.Exists(unknown):
+            arcpy.management.Delete(unknown)
 
     return errors
 
@@ -187,7 +203,7 @@ if __name__ == "__main__":
     # You can override permissions, ownership, groups here too.
     try:
         # in_startupType HAS TO BE "STARTED" else no service is started on the SERVER.
-        rval = arcpy.SignInToPortal(Config.PORTAL_URL, Config.PORTAL_USER, Config.PORTAL_PASSWORD)
+        get_session().signInToArcpy()
         rval = arcpy.server.UploadServiceDefinition(sd_file, Config.SERVER_AGS, in_startupType="STARTED")
 
     except Exception as e:
@@ -197,7 +213,7 @@ if __name__ == "__main__":
         exit(1)
 
     # Add a comment to the service, so we know who did what
-    portal = GIS(Config.PORTAL_URL, username=Config.PORTAL_USER, password=Config.PORTAL_PASSWORD)            
+    portal = get_session().gis
     print("%s Logged in as %s" % (textmark, str(portal.properties.user.username)))
     pcm = PortalContent(portal)
     target_item = pcm.getServiceItem(item["pkgname"])
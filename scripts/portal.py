@@ -21,8 +21,19 @@ find* method comments
     and now the poor thing is stranded in there.
 
 """
-import os
-from arcgis.gis import GIS
+import os, sys
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+# overwrite_taxlots.py imports us as "scripts.portal", everything else as "portal".
+# Get config.py the same way we were found so there is only ever one Config.
+try:
+    from .config import Config
+except ImportError:
+    from config import Config
+# Don't import arcgis here, it takes forever. PortalSession.gis does it when it's needed.
 
 class PortalContent(object):
 
@@ -31,8 +42,23 @@ class PortalContent(object):
     MapImageLayer = 'Map Service'
     FeatureService = 'Feature Service'
 
-    def __init__(self, gis) -> None:
+    # Search results are cached here, shared by every PortalContent in this process,
+    # because the scripts tend to make a new PortalContent in each function.
+    # The key is (portal url, name, title, type), the value is (expiration time, results).
+    # finalize_items forgets things from its worker threads, so hold the lock to touch it.
+    _cache = {}
+    _cache_lock = threading.Lock()
+
+    def __init__(self, gis, cache_ttl=Config.PORTAL_CACHE_TTL) -> None:
+        """
+        'cache_ttl' is how many seconds a search result can be reused; 0 turns off caching.
+        """
         self.gis = gis
+        self.cache_ttl = cache_ttl
+        # Running totals so you can see what all the lookups cost.
+        self.search_pages = 0
+        self.search_time = 0.0
+        self.cache_hits = 0
         return
 
     def getItemUrl(self, item: str) -> None:
@@ -40,15 +66,15 @@ class PortalContent(object):
         return f"{self.gis.url}/home/item.html?id={item['id']}"
 
 
-    def findItems(self, title=None, name=None, type=None) -> list:
-        """ 
-        Search the Portal using any combination of name, title, and type.
-        Return the list of items, which might be empty.
-        """
-        connection = self.gis._con
+    # The largest page size the sharing API will hand back in one request.
+    MAX_PAGE_SIZE = 100
 
-        # https://developers.arcgis.com/rest/users-groups-and-items/search-reference.htm
-        url = connection.baseurl + 'search'
+    @staticmethod
+    def makeFilter(title=None, name=None, type=None) -> str:
+        """
+        Build the exact-match 'filter' string for a search
+        from any combination of name, title, and type.
+        """
         q = ''
         if name:
             q += 'name:"%s"' % name
@@ -58,12 +84,152 @@ class PortalContent(object):
         if type:
             if q: q += ' AND '
             q += 'type:"%s"' % type
+        return q
+
+
+    def pages(self, url: str, params: dict):
+        """
+        Post a paged REST request and yield each page of results as it arrives,
+        following 'nextStart' until the server says there is no more.
+        (The results key is 'results' for searches, sometimes it's something else.)
+
+        When it took more than one page (or PORTAL_TRACE is on), the number of
+        pages and the wall time get printed, even if the caller stops reading early.
+        """
+        connection = self.gis._con
+        params = dict(params)
+        params['num'] = self.MAX_PAGE_SIZE
+        params['start'] = 1
+        pages = 0
+        t0 = time.perf_counter()
+        try:
+            while True:
+                res = connection.post(url, params)
+                pages += 1
+                yield res
+                # nextStart is -1 on the last page.
+                next_start = res.get('nextStart', -1)
+                if next_start is None or next_start < 1:
+                    break
+                params['start'] = next_start
+        finally:
+            self.search_pages += pages
+            self.search_time += time.perf_counter() - t0
+            if pages > 1 or Config.PORTAL_TRACE:
+                print("Search \"%s\" fetched %d page(s) in %.2fs." % (
+                    params.get('filter') or params.get('q'), pages, time.perf_counter() - t0))
+        return
+
+
+    def searchItems(self, title=None, name=None, type=None):
+        """
+        Search the Portal using any combination of name, title, and type.
+        This is a generator; it yields item dictionaries one at a time,
+        fetching the next page only when the caller asks for more.
+        """
+        return self.searchFilter(self.makeFilter(title, name, type))
+
+
+    def searchFilter(self, filter: str):
+        """
+        Search the Portal with a 'filter' string you built yourself.
+        This is a generator, see searchItems.
+        """
+        # https://developers.arcgis.com/rest/users-groups-and-items/search-reference.htm
+        url = self.gis._con.baseurl + 'search'
         params = {
             'q': '',     # This is required. This is the fuzzy match operation.
-            'filter': q  # This is the exact match operation.
+            'filter': filter  # This is the exact match operation.
         }
-        res = connection.post(url, params)
-        return res['results']
+        for res in self.pages(url, params):
+            for item in res['results']:
+                yield item
+        return
+
+
+    @staticmethod
+    def _normalize(value) -> str:
+        """ Filters are not case sensitive, so neither is the cache. """
+        if not value:
+            return None
+        return value.strip().casefold()
+
+
+    def _cacheKey(self, title=None, name=None, type=None) -> tuple:
+        return (self.gis.url, self._normalize(name), self._normalize(title), self._normalize(type))
+
+
+    def _cacheGet(self, key: tuple) -> list:
+        """ Return a copy of the cached results or None if there's nothing fresh. """
+        if not self.cache_ttl:
+            return None
+        with self._cache_lock:
+            entry = self._cache.get(key)
+            if not entry:
+                return None
+            (expires, results) = entry
+            if time.monotonic() > expires:
+                del self._cache[key]
+                return None
+        self.cache_hits += 1
+        return list(results)
+
+
+    def _cachePut(self, key: tuple, results: list) -> None:
+        if self.cache_ttl:
+            with self._cache_lock:
+                self._cache[key] = (time.monotonic() + self.cache_ttl, list(results))
+        return
+
+
+    @classmethod
+    def forget(cls, item=None, title=None, name=None, type=None) -> None:
+        """
+        Drop cached searches that could be out of date because 'item' was deleted,
+        published, renamed, or replaced. 'item' can be an arcgis "item" or a search result.
+        You can also (or instead) pass the title, name, or type of something
+        that was just created or renamed.
+
+        This errs on the side of throwing away too much.
+        """
+        item_id = None
+        if item is not None:
+            if isinstance(item, dict):
+                item_id = item.get('id')
+                title = title or item.get('title')
+                name = name or item.get('name')
+                type = type or item.get('type')
+            else:
+                item_id = getattr(item, 'id', None)
+                title = title or getattr(item, 'title', None)
+                name = name or getattr(item, 'name', None)
+                type = type or getattr(item, 'type', None)
+        known = (cls._normalize(name), cls._normalize(title), cls._normalize(type))
+
+        with cls._cache_lock:
+            for (key, (expires, results)) in list(cls._cache.items()):
+                if item_id and any(found.get('id') == item_id for found in results):
+                    del cls._cache[key]
+                    continue
+                # If every field the search filtered on is either unknown or equal,
+                # the search could have matched this item.
+                if all(not wanted or not value or wanted == value for (wanted, value) in zip(key[1:], known)):
+                    del cls._cache[key]
+        return
+
+
+    def findItems(self, title=None, name=None, type=None) -> list:
+        """ 
+        Search the Portal using any combination of name, title, and type.
+        Return the list of ALL matching items (every page), which might be empty.
+        Results are cached for "cache_ttl" seconds.
+        """
+        key = self._cacheKey(title, name, type)
+        items = self._cacheGet(key)
+        if items is None:
+            items = list(self.searchItems(title, name, type))
+            self._cachePut(key, items)
+        return items
 
 
     def findItem(self, title=None, name=None, type=None) -> object:
@@ -96,17 +262,19 @@ class PortalContent(object):
         Services can have identical names, so use a type setting (eg portalcontentmanager.MapImageLayer) to specify one.
         """
         item = None
-        items = self.findItems(title=title, type=type)
-        if len(items) != 1:
-            # If there are multiple services with the same name, you need to delete the extra(s) yourself!
-            print(f"ERROR: {len(items)} matches for \"{title}\" found.")
-            if len(items):
-                # I print all the service names as URLs so you can 
-                # use Ctl-Click to open them in a browser.
-                print("Service IDs:")
-                for item in items:
-                    print(self.getItemUrl(item))
-        else:
+        key = self._cacheKey(title=title, type=type)
+        items = self._cacheGet(key)
+        if items is None:
+            # Two matches is already too many, so don't read any further pages.
+            items = []
+            for found in self.searchItems(title=title, type=type):
+                items.append(found)
+                if len(items) > 1:
+                    break
+            else:
+                # Only a complete list goes in the cache.
+                self._cachePut(key, items)
+        if self.isUnique(title, items):
             # Load the metadata from the existing layer.
             d = items[0] # This is a dictionary
             item = self.gis.content.get(d['id']) # this is an "item".
@@ -114,22 +282,131 @@ class PortalContent(object):
         return item
 
 
+    def isUnique(self, title: str, items: list) -> bool:
+        """
+        Return True if there is exactly one item in the list,
+        otherwise complain about it and return False.
+        """
+        if len(items) == 1:
+            return True
+        # If there are multiple services with the same name, you need to delete the extra(s) yourself!
+        if len(items) > 1:
+            print(f"ERROR: more than one match for \"{title}\" found.")
+        else:
+            print(f"ERROR: no matches for \"{title}\" found.")
+        if len(items):
+            # I print the service names as URLs so you can 
+            # use Ctl-Click to open them in a browser.
+            print("Service IDs:")
+            for found in items:
+                print(self.getItemUrl(found))
+        return False
+
+
+    # Keep the OR'd filter down to a reasonable length.
+    MAX_FILTER_TERMS = 50
+
+    def findMany(self, pairs: list) -> dict:
+        """
+        Look up a whole table of services at once.
+        'pairs' is a list of (title, type) tuples, type can be None to match any type.
+
+        Does one search with all the pairs OR'd together (instead of one search per title)
+        and returns a dict keyed by (title, type). Each value is the "item" object
+        if exactly one service matched, else None, the same as getServiceItem.
+        """
+        pairs = list(dict.fromkeys(pairs)) # Drop duplicates but keep the order.
+        matches = {pair: [] for pair in pairs}
+
+        for i in range(0, len(pairs), self.MAX_FILTER_TERMS):
+            chunk = pairs[i:i + self.MAX_FILTER_TERMS]
+            q = ' OR '.join('(%s)' % self.makeFilter(title=title, type=type) for (title, type) in chunk)
+            for found in self.searchFilter(q):
+                # Sort each result into every pair it matches.
+                found_title = self._normalize(found.get('title'))
+                found_type = self._normalize(found.get('type'))
+                for (title, type) in chunk:
+                    if self._normalize(title) == found_title and (not type or self._normalize(type) == found_type):
+                        matches[(title, type)].append(found)
+
+        index = {}
+        for ((title, type), items) in matches.items():
+            self._cachePut(self._cacheKey(title=title, type=type), items)
+            index[(title, type)] = None
+            if self.isUnique(title, items):
+                index[(title, type)] = self.gis.content.get(items[0]['id'])
+        return index
+
+
+    # The title -> id map for each portal, once we've loaded it.
+    _groups = {}
+    # Groups that weren't there even after a refresh, so we don't keep asking.
+    _missingGroups = set()
+
+    def getGroupMap(self, refresh=False) -> dict:
+        """
+        Return a dict that maps every group title in our org to its id.
+
+        The map is saved in Config.GROUP_CACHE_FILE and reused for
+        Config.GROUP_CACHE_TTL seconds; after that, or if refresh=True,
+        all the groups are fetched again in one paged search.
+        """
+        url = self.gis.url
+        if not refresh and url in self._groups:
+            return self._groups[url]
+
+        cached = {}
+        try:
+            with open(Config.GROUP_CACHE_FILE, 'r') as fp:
+                cached = json.load(fp)
+        except Exception:
+            pass # Missing or damaged, we'll write a new one.
+
+        entry = cached.get(url)
+        if refresh or not entry or time.time() - entry['fetched'] > Config.GROUP_CACHE_TTL:
+            # https://developers.arcgis.com/rest/users-groups-and-items/group-search.htm
+            params = {
+                'q': 'orgid:%s' % self.gis.properties['id'],
+                'sortField': 'title',
+            }
+            groups = {}
+            for res in self.pages(self.gis._con.baseurl + 'community/groups', params):
+                for g in res['results']:
+                    groups[g['title']] = g['id']
+            entry = {'fetched': time.time(), 'groups': groups}
+            cached[url] = entry
+            try:
+                with open(Config.GROUP_CACHE_FILE, 'w') as fp:
+                    json.dump(cached, fp, indent=2)
+            except Exception as e:
+                print("Could not save group cache.", e)
+
+        self._groups[url] = entry['groups']
+        return entry['groups']
+
+
     def getGroups(self, groups) -> list:
         """
-            Search the groups on the portal using a string or list of strings.
+            Look up the groups on the portal using a string or list of strings.
             Return a list of IDs that can be used to set groups on items.
         """
         # Validate the list of groups by looking them up.
         group_ids = []
         if isinstance(groups,str):
             groups = [groups]
+        # Titles are not case sensitive in searches so don't be fussy here either.
+        ids = {title.casefold(): id for (title, id) in self.getGroupMap().items()}
         for g in groups: 
-            try:
-                group_ids.append(
-                    self.gis.groups.search('title:\"%s\"' % g, outside_org=False)[0]
-                )
-            except Exception as e:
-                print("Group '%s' not found." % g, e)
+            found = ids.get(g.casefold())
+            if not found and g not in self._missingGroups:
+                # Maybe the group is newer than the cache.
+                self._missingGroups.add(g)
+                ids = {title.casefold(): id for (title, id) in self.getGroupMap(refresh=True).items()}
+                found = ids.get(g.casefold())
+            if found:
+                group_ids.append(found)
+            else:
+                print("Group '%s' not found." % g)
         return group_ids
 
     """
@@ -178,17 +455,233 @@ class PortalContent(object):
         return
     
 
+def _sibling(name: str) -> object:
+    """ Import another module from scripts/ the same way this one was imported. """
+    import importlib
+    if __package__:
+        return importlib.import_module('.' + name, __package__)
+    return importlib.import_module(name)
+
+
+class PortalSession(object):
+    """
+    One Portal login for the whole run, shared by every script and module.
+    Use get_session() instead of making one of these yourself.
+
+    "session" is a keep-alive requests session (the connections are pooled),
+    "token" is a Portal token that is cached on disk in Config.TOKEN_CACHE_FILE
+    and regenerated shortly before it expires, "gis" is an arcgis GIS
+    object that only gets built the first time somebody asks for it
+    (it keeps its own token but shares the connection pool),
+    and "rest" is a lightweight stand-in for "gis" that skips importing arcgis
+    and asks for "token" on every request, so it never goes stale.
+    """
+
+    # Get a new token when the old one has less than this many seconds left.
+    REFRESH_MARGIN = 5 * 60
+
+    def __init__(self, url=Config.PORTAL_URL, username=Config.PORTAL_USER, password=Config.PORTAL_PASSWORD) -> None:
+        self.url = url.rstrip('/')
+        self.username = username
+        self.password = password
+
+        self.session = requests.Session()
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=Config.HTTP_POOL_SIZE)
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+
+        self._token = None
+        self._expires = 0
+        self._gis = None
+        self._rest = None
+        self._signedInToArcpy = False
+        self._lock = threading.RLock()
+        return
+
+
+    @property
+    def token(self) -> str:
+        """ Return a token that's good for at least REFRESH_MARGIN seconds. """
+        with self._lock:
+            if not self._token:
+                self._loadToken()
+            if time.time() > self._expires - self.REFRESH_MARGIN:
+                self._generateToken()
+            return self._token
+
+
+    def _cacheKey(self) -> str:
+        return f"{self.username}@{self.url}"
+
+
+    def _loadToken(self) -> None:
+        try:
+            with open(Config.TOKEN_CACHE_FILE, 'r') as fp:
+                cached = json.load(fp)[self._cacheKey()]
+            self._token = cached['token']
+            self._expires = cached['expires']
+        except Exception:
+            pass # No token saved yet, or it's unreadable.
+        return
+
+
+    def _generateToken(self) -> None:
+        # https://developers.arcgis.com/rest/users-groups-and-items/generate-token.htm
+        # "requestip" ties the token to this computer, so it can be reused by the next script.
+        res = self.session.post(self.url + '/sharing/rest/generateToken', data={
+            'username': self.username,
+            'password': self.password,
+            'client': 'requestip',
+            'expiration': Config.TOKEN_EXPIRATION,
+            'f': 'json',
+        }).json()
+        if 'error' in res:
+            raise Exception("Could not get a token. %s" % res['error'])
+        self._token = res['token']
+        self._expires = res['expires'] / 1000 # It's in milliseconds.
+
+        cached = {}
+        try:
+            with open(Config.TOKEN_CACHE_FILE, 'r') as fp:
+                cached = json.load(fp)
+        except Exception:
+            pass
+        cached[self._cacheKey()] = {'token': self._token, 'expires': self._expires}
+        try:
+            # Keep the token file private, it's as good as a password until it expires.
+            fd = os.open(Config.TOKEN_CACHE_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(cached, fp)
+        except Exception as e:
+            print("Could not save token.", e)
+        return
+
+
+    @property
+    def gis(self) -> object:
+        """
+        The arcgis GIS object, logged in once per run.
+
+        It logs in with the username and password rather than with our token.
+        A GIS that was handed a token can't get a new one, so a long staging
+        run would lose its login partway through; this way arcgis renews its
+        own token. Its requests still go through our connection pool.
+        """
+        with self._lock:
+            if not self._gis:
+                from arcgis.gis import GIS
+                gis = GIS(self.url, self.username, self.password)
+                self._sharePool(gis)
+                if Config.PORTAL_TRACE:
+                    _sibling('portal_trace').trace_gis(gis)
+                self._gis = gis
+            return self._gis
+
+
+    def _sharePool(self, gis) -> None:
+        """ Mount our pooled adapter on the GIS object's requests session. """
+        try:
+            session = gis._con._session
+            # arcgis 2.x wraps its requests.Session in an EsriSession.
+            if not isinstance(session, requests.Session):
+                session = getattr(session, '_session', None) or getattr(session, 'session', None)
+            # Leave it alone if arcgis put in an adapter of its own (PKI, no cert check...)
+            if isinstance(session, requests.Session) and type(session.get_adapter(self.url)) is requests.adapters.HTTPAdapter:
+                session.mount('https://', self.adapter)
+                session.mount('http://', self.adapter)
+                return
+        except Exception as e:
+            print("Could not share the connection pool with arcgis.", e)
+            return
+        print("arcgis is using its own connections.")
+        return
+
+
+    @property
+    def rest(self) -> object:
+        """
+        A RestGIS, which PortalContent can use in place of "gis"
+        for searching and updating items without loading arcgis.
+        """
+        with self._lock:
+            if not self._rest:
+                self._rest = _sibling('portal_rest').RestGIS(self)
+                if Config.PORTAL_TRACE:
+                    _sibling('portal_trace').trace_gis(self._rest)
+            return self._rest
+
+
+    def signInToArcpy(self) -> None:
+        """ arcpy keeps its own login, this makes sure we only do it once per run. """
+        with self._lock:
+            if not self._signedInToArcpy:
+                import arcpy
+                # "IWA" DOES NOT WORK HERE, It JUST DEMANDS USERNAME AND PASSWORD NO MATTER WHAT
+                arcpy.SignInToPortal(portal_url=self.url, username=self.username, password=self.password)
+                self._signedInToArcpy = True
+        return
+
+
+def finalize_items(jobs: list, max_workers: int = Config.FINALIZE_WORKERS) -> list:
+    """
+    Run Portal operations on a small thread pool.
+
+    'jobs' is a list of chains, each chain is a list of (label, function) tuples.
+    The chains run at the same time, but the steps in a chain run in order;
+    a step that fails does not stop the rest of its chain.
+
+    Returns a report, a list of (label, seconds, exception or None), one per step,
+    in the same order as the jobs.
+    """
+    def run_chain(chain):
+        results = []
+        for (label, function) in chain:
+            t0 = time.perf_counter()
+            error = None
+            try:
+                function()
+            except Exception as e:
+                error = e
+            results.append((label, time.perf_counter() - t0, error))
+        return results
+
+    t0 = time.perf_counter()
+    # The threads are named after our caller so portal_trace can tell who they're working for.
+    caller = sys._getframe(1).f_code.co_name
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=caller) as executor:
+        futures = [executor.submit(run_chain, chain) for chain in jobs]
+    report = []
+    for future in futures:
+        report += future.result()
+    print(f"Finished {len(report)} Portal updates in {time.perf_counter() - t0:.1f}s.")
+    return report
+
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session() -> PortalSession:
+    """ Return the PortalSession for this run, creating it the first time. """
+    global _session
+    with _session_lock:
+        if not _session:
+            _session = PortalSession()
+    return _session
+
+
 ##################################################################################
 if __name__ == '__main__':
 
     # TODO make all tests assertions.
 
-    from config import Config
-    import json
-    gis = GIS(Config.PORTAL_URL, Config.PORTAL_USER, Config.PORTAL_PASSWORD)
-    assert gis
-    # FIXME SOMEDAY
-    #gis = GIS(url=Config.PORTAL_URL, profile=Config.PORTAL_PROFILE)
+    # Use "python portal.py --rest" to test without arcgis.
+    session = get_session()
+    assert session.token
+    if '--rest' in sys.argv:
+        gis = session.rest
+    else:
+        gis = session.gis
+        assert gis is get_session().gis # Only one login.
     assert gis
     print("Logged in as " + str(gis.properties.user.username))
     pcm = PortalContent(gis)
@@ -230,6 +723,12 @@ if __name__ == '__main__':
     assert(not svc)
     PortalContent.show(svc)
 
+    found = pcm.findMany([('Vector Tiles', pcm.VectorTileService), ('Roads', None), ('DELETEME_Roads', None)])
+    assert found[('Vector Tiles', pcm.VectorTileService)]
+    assert found[('Roads', None)]
+    assert not found[('DELETEME_Roads', None)]
+    print(found)
+
     groups = pcm.getGroups(Config.STAGING_GROUP_LIST)
     assert groups
     print(groups)
@@ -262,5 +761,11 @@ if __name__ == '__main__':
         title='Unlabeled Vector Tiles',
         type=pcm.VectorTileService))
 
+    # Every page gets fetched now, not just the first 10 results.
+    items = pcm.findItems(type=pcm.MapImageLayer)
+    print("%d map image layers." % len(items))
+
+    print("Searches fetched %d pages in %.2fs." % (pcm.search_pages, pcm.search_time))
+
     exit(0)
     
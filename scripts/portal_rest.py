@@ -0,0 +1,266 @@
+"""
+portal_rest.py
+
+A stand-in for the little bit of arcgis.gis.GIS that PortalContent uses,
+built on a plain pooled requests session that talks to the sharing REST API.
+
+Importing the arcgis package takes many seconds before you can do anything,
+so read-only tools can use this instead and start up right away.
+Publishing from an SD file still needs arcgis and arcpy.
+
+    from portal import PortalContent, get_session
+    pc = PortalContent(get_session().rest)
+
+It covers search (via PortalContent), item get, add, update, share, protect,
+comments, delete, publishing a package and replacing a service.
+Items are "RestItem" objects that look enough like arcgis "items"
+for the scripts here: the fields are attributes, and the methods
+have the same names and arguments.
+"""
+import os
+import json
+import time
+
+# https://developers.arcgis.com/rest/users-groups-and-items/working-with-users-groups-and-items.htm
+
+
+class PropertyMap(dict):
+    """ A dict that also lets you use attributes, like gis.properties.user.username """
+
+    def __getattr__(self, name):
+        try:
+            value = self[name]
+        except KeyError:
+            raise AttributeError(name)
+        if isinstance(value, dict) and not isinstance(value, PropertyMap):
+            value = PropertyMap(value)
+        return value
+
+
+class RestConnection(object):
+    """ Plays the part of GIS._con """
+
+    def __init__(self, session) -> None:
+        self.portal = session
+        self.baseurl = session.url + '/sharing/rest/'
+        return
+
+    def _check(self, res) -> dict:
+        res.raise_for_status()
+        d = res.json()
+        if isinstance(d, dict) and 'error' in d:
+            raise Exception("Portal error: %s" % d['error'])
+        return d
+
+    def post(self, url: str, params: dict = None, files: dict = None) -> dict:
+        data = dict(params or {})
+        data['f'] = 'json'
+        data['token'] = self.portal.token
+        return self._check(self.portal.session.post(url, data=data, files=files))
+
+    def get(self, url: str, params: dict = None) -> dict:
+        data = dict(params or {})
+        data['f'] = 'json'
+        data['token'] = self.portal.token
+        return self._check(self.portal.session.get(url, params=data))
+
+
+class RestItem(object):
+    """ Plays the part of arcgis.gis.Item """
+
+    def __init__(self, gis, itemdict: dict) -> None:
+        # Use __dict__ directly so that __getattr__ doesn't get confused.
+        self.__dict__['_gis'] = gis
+        self.__dict__['_data'] = dict(itemdict)
+        return
+
+    def __getattr__(self, name):
+        try:
+            return self._data[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __getitem__(self, name):
+        return self._data[name]
+
+    def __repr__(self) -> str:
+        return '<Item title:"%s" type:%s owner:%s>' % (self._data.get('title'), self._data.get('type'), self._data.get('owner'))
+
+    def _userUrl(self, operation: str) -> str:
+        return self._gis._con.baseurl + 'content/users/%s/items/%s/%s' % (self._data['owner'], self._data['id'], operation)
+
+    @property
+    def homepage(self) -> str:
+        return f"{self._gis.url}/home/item.html?id={self._data['id']}"
+
+    @property
+    def content_status(self) -> str:
+        return self._data.get('contentStatus')
+
+    @content_status.setter
+    def content_status(self, value: str) -> None:
+        # Same spellings as arcgis; Portal calls "authoritative" "org_authoritative".
+        status = {'authoritative': 'org_authoritative', 'deprecated': 'deprecated'}.get(value, '')
+        self._gis._con.post(self._userUrl('setContentStatus'), {'status': status, 'clearEmptyFields': 'true'})
+        self._data['contentStatus'] = status
+        return
+
+    def update(self, item_properties: dict = None, data: str = None, thumbnail: str = None) -> bool:
+        params = {}
+        for (key, value) in (item_properties or {}).items():
+            if key == 'text' and not isinstance(value, str):
+                value = json.dumps(value)
+            elif key == 'extent' and isinstance(value, (list, tuple)):
+                # [[xmin, ymin], [xmax, ymax]] -> "xmin,ymin,xmax,ymax"
+                value = ','.join(str(v) for corner in value for v in corner)
+            elif isinstance(value, (list, tuple)):
+                value = ','.join(value)
+            params[key] = value
+
+        files = {}
+        try:
+            if thumbnail:
+                files['thumbnail'] = (os.path.basename(thumbnail), open(thumbnail, 'rb'))
+            if data:
+                files['file'] = (os.path.basename(data), open(data, 'rb'))
+            res = self._gis._con.post(self._userUrl('update'), params, files=files or None)
+        finally:
+            for (name, fp) in files.values():
+                fp.close()
+
+        if res.get('success'):
+            self._data.update(item_properties or {})
+        return res.get('success', False)
+
+    def share(self, everyone: bool = False, org: bool = False, groups=None, allow_members_to_edit: bool = False) -> dict:
+        if groups and not isinstance(groups, str):
+            groups = ','.join(g if isinstance(g, str) else g.id for g in groups)
+        return self._gis._con.post(self._userUrl('share'), {
+            'everyone': str(everyone).lower(),
+            'org': str(org).lower(),
+            'groups': groups or '',
+            'confirmItemControl': str(allow_members_to_edit).lower(),
+        })
+
+    def protect(self, enable: bool = True) -> dict:
+        res = self._gis._con.post(self._userUrl('protect' if enable else 'unprotect'))
+        self._data['protected'] = enable
+        return res
+
+    def add_comment(self, comment: str) -> str:
+        url = self._gis._con.baseurl + 'content/items/%s/addComment' % self._data['id']
+        return self._gis._con.post(url, {'comment': comment}).get('commentId')
+
+    def delete(self) -> bool:
+        return self._gis._con.post(self._userUrl('delete')).get('success', False)
+
+    # Which "fileType" the publish operation wants for each kind of item.
+    FILE_TYPES = {
+        'Vector Tile Package': 'vectortilepackage',
+        'Tile Package': 'tilepackage',
+        'Service Definition': 'serviceDefinition',
+    }
+
+    def publish(self, publish_parameters: dict = None, output_type: str = None, file_type: str = None) -> 'RestItem':
+        """ Publish a package as a hosted service and wait for it to finish. Returns the service item. """
+        con = self._gis._con
+        params = {
+            'itemID': self._data['id'],
+            'filetype': file_type or self.FILE_TYPES.get(self._data['type'], ''),
+            'publishParameters': json.dumps(publish_parameters or {}),
+        }
+        if output_type:
+            params['outputType'] = output_type
+        url = con.baseurl + 'content/users/%s/publish' % self._data['owner']
+        service = con.post(url, params)['services'][0]
+        if 'error' in service:
+            raise Exception("Publish failed. %s" % service['error'])
+
+        # Publishing runs as a job, so keep asking until it's done.
+        status_url = con.baseurl + 'content/users/%s/items/%s/status' % (self._data['owner'], service['serviceItemId'])
+        while service.get('jobId'):
+            res = con.get(status_url, {'jobId': service['jobId'], 'jobType': 'publish'})
+            if res.get('status') == 'completed':
+                break
+            if res.get('status') == 'failed':
+                raise Exception("Publish failed. %s" % res.get('statusMessage'))
+            time.sleep(1)
+        return self._gis.content.get(service['serviceItemId'])
+
+
+class RestContentManager(object):
+    """ Plays the part of GIS.content """
+
+    def __init__(self, gis) -> None:
+        self._gis = gis
+        return
+
+    def get(self, itemid: str) -> RestItem:
+        url = self._gis._con.baseurl + 'content/items/%s' % itemid
+        try:
+            return RestItem(self._gis, self._gis._con.get(url))
+        except Exception as e:
+            print("Could not get item %s." % itemid, e)
+        return None
+
+    def _userUrl(self, folder: str = None) -> str:
+        """ The URL for my content, optionally in a folder given by name. """
+        con = self._gis._con
+        url = con.baseurl + 'content/users/%s' % con.portal.username
+        if folder:
+            folders = con.get(url).get('folders', [])
+            for f in folders:
+                if f['title'] == folder:
+                    return url + '/' + f['id']
+            print("WARNING: Folder \"%s\" not found, using the root folder." % folder)
+        return url
+
+    def add(self, item_properties: dict, data: str = None, thumbnail: str = None, folder: str = None) -> RestItem:
+        """ Upload a file (or just create an item) in one request. Returns the new item. """
+        params = dict(item_properties)
+        if data and 'type' not in params:
+            params['type'] = {'.vtpk': 'Vector Tile Package', '.tpkx': 'Tile Package', '.sd': 'Service Definition'}.get(
+                os.path.splitext(data)[1].lower(), 'File')
+        files = {}
+        try:
+            if data:
+                files['file'] = (os.path.basename(data), open(data, 'rb'))
+            if thumbnail:
+                files['thumbnail'] = (os.path.basename(thumbnail), open(thumbnail, 'rb'))
+            res = self._gis._con.post(self._userUrl(folder) + '/addItem', params, files=files or None)
+        finally:
+            for (name, fp) in files.values():
+                fp.close()
+        return self.get(res['id'])
+
+    def replace_service(self, replace_item: RestItem, new_item: RestItem, replaced_service_name: str = None, replace_metadata: bool = False) -> bool:
+        """ Swap new_item in for replace_item, the old service gets archived as replaced_service_name. """
+        params = {
+            'toReplaceItemId': replace_item.id,
+            'replacingItemId': new_item.id,
+            'replacedServiceName': replaced_service_name or '',
+            'replaceMetadata': str(replace_metadata).lower(),
+        }
+        return self._gis._con.post(self._userUrl() + '/replaceService', params).get('success', False)
+
+
+class RestGIS(object):
+    """
+    Plays the part of arcgis.gis.GIS using the session from portal.get_session().
+    """
+
+    def __init__(self, session) -> None:
+        self.url = session.url
+        self._con = RestConnection(session)
+        self.content = RestContentManager(self)
+        self._properties = None
+        return
+
+    @property
+    def properties(self) -> PropertyMap:
+        """ The "portals/self" properties, including the logged in user. """
+        if self._properties is None:
+            self._properties = PropertyMap(self._con.get(self._con.baseurl + 'portals/self'))
+        return self._properties
+
+# That's all!
@@ -0,0 +1,279 @@
+"""
+portal_trace.py
+
+Keeps track of every call we make to Portal, so we can see how many
+there are in a run and which ones are slow.
+
+Set PORTAL_TRACE=1 in the environment (or .env) and get_session() turns it on
+for both the arcgis GIS and the REST backend. You can also do it by hand:
+
+    from portal_trace import trace_gis
+    trace_gis(gis)
+
+Every HTTP request that goes through gis._con (post and get) and every call to
+the item methods the scripts use (update, share, protect, add_comment, delete,
+publish) is written as one line of JSON to a trace file in Config.TRACE_DIR.
+Each record has the endpoint, method, payload size, response size, the HTTP
+status code, whether it failed (an exception, an HTTP error, or a 200 with a
+Portal "error" in the JSON), latency, and the function in our scripts that
+made the call, for example "stage_tile_service" or "PublishFromSD".
+
+When the run ends a summary table grouped by calling function gets printed.
+"""
+import os, sys
+import re
+import json
+import time
+import atexit
+import threading
+from urllib.parse import urlencode
+try:
+    from .config import Config # Imported as "scripts.portal_trace", see portal.py.
+except ImportError:
+    from config import Config
+
+# The item methods that get timed.
+ITEM_METHODS = ('update', 'share', 'protect', 'add_comment', 'delete', 'publish')
+
+# Calls from these files don't count as the "caller", we want the script that used them.
+_SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+_PLUMBING = {os.path.join(_SCRIPTS, f) for f in ('portal.py', 'portal_rest.py', 'portal_trace.py')}
+
+_lock = threading.Lock()
+_records = []
+_trace_file = None
+_fp = None
+
+
+def _caller() -> str:
+    """ The name of the innermost function in our own scripts that led to this call. """
+    frame = sys._getframe(2)
+    while frame:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        # "PublishFromSD.<locals>.share" counts as PublishFromSD (if this Python knows qualnames).
+        name = getattr(frame.f_code, 'co_qualname', frame.f_code.co_name).split('.<locals>')[0]
+        if filename.startswith(_SCRIPTS) and filename not in _PLUMBING and not name.startswith('<'):
+            return name
+        frame = frame.f_back
+    # Worker threads in finalize_items are named after whoever started them.
+    return re.sub(r'_\d+$', '', threading.current_thread().name)
+
+
+def _file_size(value) -> int:
+    """ The size of something passed in files=, a path, an open file, or requests style (filename, file). """
+    if isinstance(value, str) and os.path.isfile(value):
+        return os.path.getsize(value)
+    if hasattr(value, 'fileno'):
+        return os.fstat(value.fileno()).st_size
+    if isinstance(value, tuple):
+        return sum(_file_size(v) for v in value if not isinstance(v, str))
+    return _size(value)
+
+
+def _size(value) -> int:
+    """ About how many bytes something takes on the wire. Files are counted by _file_size. """
+    if value is None:
+        return 0
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, str):
+        return len(value.encode('utf-8'))
+    if isinstance(value, dict):
+        try:
+            return len(urlencode({k: v if isinstance(v, (str, int, float)) else json.dumps(v, default=str)
+                                  for (k, v) in value.items()}))
+        except Exception:
+            pass
+    try:
+        return len(json.dumps(value, default=str))
+    except Exception:
+        return len(str(value))
+
+
+def _endpoint(url: str) -> str:
+    """ Shorten the URL and hide item ids so that the same operation groups together. """
+    url = str(url).split('?')[0]
+    if '/sharing/rest/' in url:
+        url = url.split('/sharing/rest/', 1)[1]
+    return re.sub(r'\b[0-9a-f]{32}\b', '<id>', url)
+
+
+def _record(**fields) -> None:
+    global _fp
+    with _lock:
+        _records.append(fields)
+        if _fp is None:
+            os.makedirs(os.path.dirname(_trace_file), exist_ok=True)
+            _fp = open(_trace_file, 'a')
+        _fp.write(json.dumps(fields, default=str) + '\n')
+        _fp.flush()
+    return
+
+
+# What the response hook saw during the call being timed on this thread.
+_local = threading.local()
+
+
+def _on_response(res, *args, **kwargs):
+    """ A requests response hook. Notes the status code, and whether the body is a Portal error. """
+    error = res.status_code >= 400
+    if not error and res.content[:1] == b'{':
+        try:
+            body = res.json()
+            error = isinstance(body, dict) and 'error' in body
+        except ValueError:
+            pass
+    responses = getattr(_local, 'responses', None)
+    if responses is not None:
+        responses.append((res.status_code, error, len(res.content)))
+    return res
+
+
+def trace_session(session) -> None:
+    """ Add the response hook to a requests session. """
+    if session is not None and _on_response not in session.hooks['response']:
+        session.hooks['response'].append(_on_response)
+    return
+
+
+def _timed(kind: str, method: str, endpoint: str, payload_bytes: int, function, *args, **kwargs):
+    caller = _caller()
+    exception = None
+    response = None
+    # Item methods make http calls of their own, so keep the outer call's list aside.
+    outer = getattr(_local, 'responses', None)
+    _local.responses = []
+    t0 = time.perf_counter()
+    try:
+        response = function(*args, **kwargs)
+        return response
+    except Exception as e:
+        exception = type(e).__name__
+        raise
+    finally:
+        seconds = round(time.perf_counter() - t0, 4)
+        responses = _local.responses
+        _local.responses = outer
+        if outer is not None:
+            outer.extend(responses)
+        # The code of the last response, that's the one the caller got.
+        http_status = responses[-1][0] if responses else None
+        error = bool(exception) or any(e for (_, e, _) in responses) \
+            or (isinstance(response, dict) and 'error' in response)
+        response_bytes = sum(n for (_, _, n) in responses) if responses else _size(response)
+        _record(time=time.time(), kind=kind, caller=caller, method=method, endpoint=endpoint,
+                payload_bytes=payload_bytes, response_bytes=response_bytes,
+                http_status=http_status, error=error, exception=exception, seconds=seconds)
+
+
+def trace_connection(con) -> None:
+    """ Wrap the post and get methods on a connection (GIS._con or RestConnection). """
+    if getattr(con, '_traced', False):
+        return
+    for method in ('post', 'get'):
+        original = getattr(con, method, None)
+        if not original:
+            continue
+        def wrapper(path, params=None, *args, _original=original, _method=method.upper(), **kwargs):
+            payload_bytes = _size(params)
+            files = kwargs.get('files') or (args[0] if args and isinstance(args[0], dict) else None)
+            if files:
+                payload_bytes += sum(_file_size(f) for f in files.values())
+            return _timed('http', _method, _endpoint(path), payload_bytes, _original, path, params, *args, **kwargs)
+        setattr(con, method, wrapper)
+    con._traced = True
+    return
+
+
+def trace_item_class(cls) -> None:
+    """ Wrap the methods we use on an item class (arcgis.gis.Item or RestItem). """
+    if getattr(cls, '_traced', False):
+        return
+    for name in ITEM_METHODS:
+        original = getattr(cls, name, None)
+        if not original:
+            continue
+        def wrapper(self, *args, _original=original, _name=name, **kwargs):
+            return _timed('item', _name, 'item.' + _name, _size([args, kwargs]), _original, self, *args, **kwargs)
+        wrapper.__name__ = name
+        wrapper.__doc__ = original.__doc__
+        setattr(cls, name, wrapper)
+    cls._traced = True
+    return
+
+
+def _requests_session(con) -> object:
+    """ The requests session under a RestConnection or an arcgis connection, or None. """
+    import requests
+    portal = getattr(con, 'portal', None)
+    session = portal.session if portal is not None else getattr(con, '_session', None)
+    # arcgis 2.x wraps its requests.Session in an EsriSession.
+    if session is not None and not isinstance(session, requests.Session):
+        session = getattr(session, '_session', None) or getattr(session, 'session', None)
+    return session if isinstance(session, requests.Session) else None
+
+
+def trace_gis(gis) -> None:
+    """ Start tracing everything that goes through this GIS (or RestGIS) and its items. """
+    global _trace_file
+    if _trace_file is None:
+        _trace_file = os.path.join(Config.TRACE_DIR, time.strftime("portal_trace_%Y%m%d_%H%M%S.jsonl"))
+        atexit.register(show_summary)
+        print("Tracing Portal calls to %s" % _trace_file)
+    trace_connection(gis._con)
+    trace_session(_requests_session(gis._con))
+    try:
+        from .portal_rest import RestGIS, RestItem
+    except ImportError:
+        from portal_rest import RestGIS, RestItem
+    if isinstance(gis, RestGIS):
+        trace_item_class(RestItem)
+        return
+    from arcgis.gis import Item
+    trace_item_class(Item)
+    return
+
+
+def summary(records: list = None) -> list:
+    """
+    Group the records by caller and kind.
+    Returns a list of dicts sorted with the slowest caller first.
+    """
+    if records is None:
+        with _lock:
+            records = list(_records)
+    groups = {}
+    for r in records:
+        key = (r['caller'], r['kind'])
+        g = groups.setdefault(key, {'caller': r['caller'], 'kind': r['kind'], 'calls': 0, 'errors': 0,
+                                    'seconds': 0.0, 'slowest': 0.0, 'payload_bytes': 0, 'response_bytes': 0})
+        g['calls'] += 1
+        g['errors'] += bool(r['error'])
+        g['seconds'] += r['seconds']
+        g['slowest'] = max(g['slowest'], r['seconds'])
+        g['payload_bytes'] += r['payload_bytes']
+        g['response_bytes'] += r['response_bytes']
+    return sorted(groups.values(), key=lambda g: g['seconds'], reverse=True)
+
+
+def show_summary(records: list = None) -> None:
+    rows = summary(records)
+    if not rows:
+        return
+    print()
+    print("Portal calls (trace in %s)" % _trace_file)
+    print("%-28s %-5s %6s %6s %9s %8s %12s %12s" % ("caller", "kind", "calls", "errors", "seconds", "slowest", "sent", "received"))
+    for g in rows:
+        print("%-28s %-5s %6d %6d %9.2f %8.2f %12d %12d" % (g['caller'][:28], g['kind'], g['calls'], g['errors'],
+              g['seconds'], g['slowest'], g['payload_bytes'], g['response_bytes']))
+    return
+
+
+if __name__ == "__main__":
+    # Show the summary from a trace file from an earlier run.
+    if len(sys.argv) < 2:
+        print("Usage: python portal_trace.py portal_trace_YYYYmmdd_HHMMSS.jsonl")
+        exit(1)
+    _trace_file = sys.argv[1]
+    with open(_trace_file) as fp:
+        show_summary([json.loads(line) for line in fp if line.strip()])
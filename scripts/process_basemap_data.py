@@ -9,10 +9,35 @@ Runs fast in VS Code or run from Python Idle or some other IDE.
 DON'T run it in Arc Pro in a Jupyter notebook, because first it will throw errors over and over
 and then when you finally get it to run it will tear out the original layer from the map
 and throw away the symbology you spent 3 days working on. I shed tears.
+
+The layers don't depend on each other once roads and water lines are unsplit,
+so with "Reproject in parallel" checked each one gets reprojected in its own
+process, into its own scratch file geodatabase, and then gets copied into
+Basemap.gdb. (The copies are done one at a time, a file geodatabase
+does not like several processes writing to it at once.)
 """
 import sys, os
+import time
+import shutil
+import tempfile
 import arcpy
 from config import Config
+import line_merge
+import process_pool
+
+# We unsplit on the Owner attribute so that the "Roads by Jurisdiction" feature will work.
+ROAD_DISSOLVE = ["StreetName", "FunClassM", "FunClassD", "Owner"] # dissolve on these -- attributes will be preserved but renamed first_*
+ROAD_ATTRIBUTES = [
+            #["Street", "FIRST"],    # 8TH ST      best for vector maps
+            #["Name", "FIRST"],      # 8th
+            #["Type", "FIRST"],      # St
+            ["Alias", "FIRST"],      # HWY 101 -- used for creating highway shields; sometimes a street has a name like Roosevelt Dr and an alias like HWY 101 
+            ["Surface", "FIRST"], 
+]
+WATER_DISSOLVE = [#"WaterName",
+    "LineType", "MapScale"] # dissolve on these -- the attributes will be preserved
+# Keep only River, Creek, Canal
+WATER_WHERE = '"LineType"=24 OR "LineType"=26 OR "LineType"=28'
 
 class ProcessBasemapData(object):
 
@@ -56,7 +81,25 @@ class ProcessBasemapData(object):
         )
         workspace.value = "Basemap.gdb"
 
-        return [map, workspace]
+        parallel = arcpy.Parameter(
+            name="parallel",
+            displayName="Reproject in parallel",
+            datatype="GPBoolean",
+            parameterType="Optional",
+            direction="Input",
+        )
+        parallel.value = True
+
+        incremental = arcpy.Parameter(
+            name="incremental",
+            displayName="Only copy what changed since the last run",
+            datatype="GPBoolean",
+            parameterType="Optional",
+            direction="Input",
+        )
+        incremental.value = False
+
+        return [map, workspace, parallel, incremental]
 
     def isLicensed(self) -> bool:
         return True
@@ -80,6 +123,8 @@ class ProcessBasemapData(object):
             arcpy.AddError(f"Could not use map. {e}")
 
         workspace = params[1].valueAsText
+        parallel = len(params) > 2 and bool(params[2].value)
+        incremental = len(params) > 3 and bool(params[3].value)
 
         arcpy.AddMessage(f'"{m.name}" is {type(m)} and {workspace} is {type(workspace)}')
 
@@ -92,7 +137,16 @@ class ProcessBasemapData(object):
             arcpy.AddMessage(f'Source "{ds}": {layer["layer"].connectionProperties["dataset"]}')
             arcpy.AddMessage(f'version: {layer["layer"].connectionProperties["connection_info"]["version"]}')
 
-        arcpy.env.workspace = "in_memory"
+        if incremental:
+            # See incremental_refresh.py, it keeps its own state next to the workspace.
+            from incremental_refresh import refresh
+            errors = refresh(m, workspace)
+            if errors:
+                arcpy.AddError("There were errors (%d anyway), this is bad." % errors)
+            return
+
+        # The other processes can't see in_memory, so the unsplit lines have to go on disk.
+        arcpy.env.workspace = arcpy.env.scratchGDB if parallel else "in_memory"
 
         # Roads that are unsplit are better for query operations.
         (roads, roads_unsplit) = unsplit_road_lines(layers['roads']['layer'])
@@ -100,26 +154,159 @@ class ProcessBasemapData(object):
         layers['roads'] = {"layer": roads, "dest": basemap_workspace} # this is used for labels
         layers['water_lines'] = {"layer":unsplit_water_lines(layers['water_lines']['layer']), "dest": basemap_workspace}
 
-        errors = 0
-        for (dst,layer) in layers.items():
-            try:
-                dstpath = os.path.join(layer['dest'], dst)
-                src = layer['layer']    
-                arcpy.AddMessage(f"Reprojecting {src} to {dstpath}")
-                arcpy.management.Project(in_dataset=src, out_dataset=dstpath, 
-                    out_coor_system = Config.WM_SRS, transform_method = Config.TRANSFORMS,
-                    in_coor_system = Config.LOCAL_SRS,
-                    preserve_shape="NO_PRESERVE_SHAPE", max_deviation="", vertical="NO_VERTICAL")
-            except Exception as e:
-                arcpy.AddMessage(f"Failed! {e}")
-                errors += 1
-
+        t0 = time.perf_counter()
+        if parallel:
+            timings = project_in_parallel(layers)
+        else:
+            timings = []
+            for (dst,layer) in layers.items():
+                t1 = time.perf_counter()
+                row = {'layer': dst, 'project': 0, 'copy': 0, 'error': None}
+                try:
+                    dstpath = os.path.join(layer['dest'], dst)
+                    src = layer['layer']    
+                    arcpy.AddMessage(f"Reprojecting {src} to {dstpath}")
+                    project(src, dstpath)
+                except Exception as e:
+                    arcpy.AddMessage(f"Failed! {e}")
+                    row['error'] = str(e)
+                row['project'] = time.perf_counter() - t1
+                timings.append(row)
+        show_timings(timings, time.perf_counter() - t0)
+
+        errors = sum(1 for row in timings if row['error'])
         if errors:
             arcpy.AddError("There were errors (%d anyway), this is bad." % errors)
 
         return
 
 
+def project(src, dstpath: str) -> None:
+    arcpy.management.Project(in_dataset=src, out_dataset=dstpath, 
+        out_coor_system = Config.WM_SRS, transform_method = Config.TRANSFORMS,
+        in_coor_system = Config.LOCAL_SRS,
+        preserve_shape="NO_PRESERVE_SHAPE", max_deviation="", vertical="NO_VERTICAL")
+    return
+
+
+def layer_source(layer) -> tuple:
+    """
+    A layer or feature class as (path, definition query, version), something another process can open.
+    version is None unless it's a layer on an enterprise geodatabase.
+    """
+    desc = arcpy.Describe(layer)
+    version = None
+    try:
+        version = layer.connectionProperties["connection_info"].get("version")
+    except (AttributeError, KeyError, TypeError):
+        pass # Not a layer, or not in a versioned workspace.
+    return (desc.catalogPath, getattr(desc, 'whereClause', '') or '', version)
+
+
+def open_source(name: str, datasource: str, where: str = '', version: str = None):
+    """ What layer_source returned, as a layer called 'name' (or just the path when there's no query or version). """
+    if not (where or version):
+        return datasource
+    layer = arcpy.management.MakeFeatureLayer(datasource, name, where_clause=where or None)[0]
+    if version:
+        # The path opens the version in the .sde file, usually DEFAULT,
+        # not the one the layer in the map is switched to.
+        arcpy.management.ChangeVersion(layer, "TRANSACTIONAL", version)
+    return layer
+
+
+def _project_worker(name: str, datasource: str, where: str, version: str, scratch: str) -> dict:
+    """ Runs in its own process: reproject one layer into a scratch FGDB of its own. """
+    t0 = time.perf_counter()
+    result = {'layer': name, 'output': None, 'error': None}
+    with process_pool.caught(result):
+        arcpy.env.overwriteOutput = True
+        gdb = os.path.join(scratch, name + '.gdb')
+        arcpy.management.CreateFileGDB(scratch, name + '.gdb')
+        arcpy.env.scratchWorkspace = gdb
+        arcpy.env.workspace = gdb
+        src = open_source(name + '_layer', datasource, where, version)
+        result['output'] = os.path.join(gdb, name)
+        project(src, result['output'])
+    result['project'] = time.perf_counter() - t0
+    return result
+
+
+def replace_dataset(src: str, dstpath: str) -> None:
+    """
+    Copy src over dstpath. The copy goes in under a temporary name first,
+    so if it fails the old dstpath is still there.
+    """
+    new = dstpath + "_new"
+    old = dstpath + "_old"
+    for leftover in (new, old):
+        if arcpy.Exists(leftover):
+            arcpy.management.Delete(leftover)
+    arcpy.management.Copy(src, new)
+    if not arcpy.Exists(dstpath):
+        arcpy.management.Rename(new, dstpath)
+        return
+    arcpy.management.Rename(dstpath, old)
+    try:
+        arcpy.management.Rename(new, dstpath)
+    except Exception:
+        arcpy.management.Rename(old, dstpath) # Put it back.
+        raise
+    arcpy.management.Delete(old)
+    return
+
+
+def project_in_parallel(layers: dict, max_workers: int = None) -> list:
+    """
+    Reproject each layer in its own process, then copy the results to their destinations.
+    Returns a row for each layer with "project" and "copy" seconds and "error".
+    """
+    scratch = tempfile.mkdtemp(prefix='basemap_', dir=Config.SCRATCH_WORKSPACE)
+    workers = max(1, min(len(layers), max_workers or os.cpu_count() or 1))
+    arcpy.AddMessage(f"Reprojecting {len(layers)} layers, {workers} at a time.")
+
+    timings = []
+    try:
+        with process_pool.pool(workers) as executor:
+            futures = {}
+            for (dst, layer) in layers.items():
+                try:
+                    (datasource, where, version) = layer_source(layer['layer'])
+                except Exception as e:
+                    arcpy.AddMessage(f"Can't read {dst}! {e}")
+                    timings.append({'layer': dst, 'project': 0, 'copy': 0, 'error': str(e)})
+                    continue
+                futures[executor.submit(_project_worker, dst, datasource, where, version, scratch)] = dst
+
+            for (dst, row, died) in process_pool.completed(futures):
+                row = row or {'layer': dst, 'output': None, 'error': died, 'project': 0}
+                row['copy'] = 0
+                if not row['error']:
+                    t0 = time.perf_counter()
+                    dstpath = os.path.join(layers[dst]['dest'], dst)
+                    try:
+                        arcpy.AddMessage(f"Copying {row['output']} to {dstpath}")
+                        replace_dataset(row['output'], dstpath)
+                    except Exception as e:
+                        row['error'] = str(e)
+                    row['copy'] = time.perf_counter() - t0
+                if row['error']:
+                    arcpy.AddMessage(f"Failed! {dst}: {row['error']}")
+                timings.append(row)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    return timings
+
+
+def show_timings(timings: list, wall: float) -> None:
+    arcpy.AddMessage("%-16s %9s %9s" % ("layer", "project", "copy"))
+    for row in sorted(timings, key=lambda r: r['layer']):
+        arcpy.AddMessage("%-16s %8.1fs %8.1fs %s" % (row['layer'], row['project'], row['copy'],
+                                                    "FAILED" if row['error'] else ""))
+    arcpy.AddMessage("%-16s %8.1fs in all, %.1fs of work." % ("", wall, sum(r['project'] + r['copy'] for r in timings)))
+    return
+
+
 def unsplit_lines(src_layer, dissolve_attribute_list=None, attributes=None) -> tuple:
     """
     Copy then unsplit (like 'dissolve' but for line features)
@@ -140,16 +327,13 @@ def unsplit_lines(src_layer, dissolve_attribute_list=None, attributes=None) -> t
 
     print("Unsplitting %s." % scratch)
     dissolved = scratch + "_unsplit"
-    arcpy.management.UnsplitLine(scratch, dissolved, 
-        dissolve_attribute_list, # dissolve on these -- the attributes will be preserved
+    # UnsplitLine renamed every attribute (FIRST_Alias...) and then we had to AlterField them back,
+    # line_merge does the same merge in one pass and keeps the names.
+    count = line_merge.unsplit(scratch, dissolved, 
+        dissolve_attribute_list or [], # dissolve on these -- the attributes will be preserved
         attributes # list other attributes that you want to preserve here
     )
-    print("Unsplit feature count =", arcpy.management.GetCount(dissolved))
-
-    # Unsplit changed all the attributes, now change them back!
-    for old_name, stat_field in attributes:
-        new_name = stat_field + "_" + old_name
-        results = arcpy.management.AlterField(in_table= dissolved, field= new_name, new_field_name= old_name.lower(), new_field_alias= old_name)
+    print("Unsplit feature count =", count)
 
     return (scratch, dissolved)
 
@@ -164,40 +348,35 @@ def unsplit_road_lines(road_lines_layer):
         print("There is a selection set in roads, this will mess us up.")
         exit(-1)
 
-    # We unsplit on the Owner attribute so that the "Roads by Jurisdiction" feature will work.
-    road_attributes = [
-                #["Street", "FIRST"],    # 8TH ST      best for vector maps
-                #["Name", "FIRST"],      # 8th
-                #["Type", "FIRST"],      # St
-                ["Alias", "FIRST"],      # HWY 101 -- used for creating highway shields; sometimes a street has a name like Roosevelt Dr and an alias like HWY 101 
-                ["Surface", "FIRST"], 
-    ]
     (roads, roads_unsplit) = unsplit_lines(road_lines_layer,
-        dissolve_attribute_list= ["StreetName", "FunClassM", "FunClassD", "Owner"], # dissolve on these -- attributes will be preserved but renamed first_*
-        attributes = road_attributes # list other attributes that you want to preserve here
+        dissolve_attribute_list= ROAD_DISSOLVE,
+        attributes = ROAD_ATTRIBUTES # list other attributes that you want to preserve here
     )
     roads_count= arcpy.management.GetCount(roads)
     print("There are %s roads." % roads_count)
 
-    arcpy.management.CalculateField(roads_unsplit, \
-        "Miles", "Round(Length($feature, \"miles\"),2)", "ARCADE", field_type="DOUBLE")
+    add_miles(roads_unsplit)
 
     return roads, roads_unsplit
 
 
+def add_miles(roads_unsplit) -> None:
+    arcpy.management.CalculateField(roads_unsplit, \
+        "Miles", "Round(Length($feature, \"miles\"),2)", "ARCADE", field_type="DOUBLE")
+    return
+
+
 def unsplit_water_lines(water_lines_layer):
     # Unsplitting water lines have 0 useful names,
     # but doing this does remove unwanted attributes.
     (water_lines, water_unsplit) = unsplit_lines(water_lines_layer,
-        dissolve_attribute_list= [#"WaterName",
-            "LineType", "MapScale"], # dissolve on these -- the attributes will be preserved
+        dissolve_attribute_list= WATER_DISSOLVE,
         attributes = [] # list other attributes that you want to preserve here
     )
     water_layer_name = water_unsplit + '_layer'
-    # Keep only River, Creek, Canal
     water_layer = arcpy.management.MakeFeatureLayer(water_unsplit,
         water_layer_name, 
-        where_clause='"LineType"=24 OR "LineType"=26 OR "LineType"=28')
+        where_clause=WATER_WHERE)
     result = arcpy.management.GetCount(water_layer)
     print("There are %s water line features." % result)
 #    if water_count < 1000:
@@ -0,0 +1,71 @@
+"""
+process_pool.py
+
+The bits every arcpy process pool here needs. tile_packages.py builds
+packages with it and process_basemap_data.py reprojects layers with it.
+
+    with process_pool.pool(workers) as executor:
+        futures = {executor.submit(worker, ...): name for ...}
+        for (name, result, died) in process_pool.completed(futures):
+            ...
+
+and in the worker,
+
+    result = {'error': None}
+    with process_pool.caught(result):
+        ...
+    return result
+"""
+import os, sys
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+def pool(workers: int) -> ProcessPoolExecutor:
+    """ A process pool that works from a script and from inside ArcGIS Pro. """
+    if os.path.basename(sys.executable).lower() == 'arcgispro.exe':
+        # Inside ArcGIS Pro, the workers have to be started with python.exe, not Pro itself.
+        multiprocessing.set_executable(os.path.join(sys.exec_prefix, 'python.exe'))
+    return ProcessPoolExecutor(max_workers=workers)
+
+
+@contextmanager
+def caught(result: dict):
+    """ In a worker: put an exception in result['error'] instead of raising it. """
+    try:
+        yield result
+    except Exception as e:
+        # Send back a string, not every arcpy exception can be pickled.
+        result['error'] = str(e)
+    return
+
+
+def _test_worker(n: int) -> dict:
+    """ For the self-test. It has to be up here, spawned workers can't see anything under __main__. """
+    result = {'n': n, 'error': None}
+    with caught(result):
+        result['root'] = 1 / n
+    return result
+
+
+def completed(futures: dict):
+    """
+    Yields (futures[future], result, died) as each one finishes.
+    'died' is the error when the worker process itself died, then result is None.
+    """
+    for future in as_completed(futures):
+        try:
+            yield (futures[future], future.result(), None)
+        except Exception as e:
+            yield (futures[future], None, str(e))
+    return
+
+
+if __name__ == "__main__":
+    with pool(2) as executor:
+        futures = {executor.submit(_test_worker, n): n for n in range(3)}
+        results = {n: result for (n, result, died) in completed(futures)}
+    assert results[0]['error'] == "division by zero"
+    assert results[2]['root'] == 0.5 and results[2]['error'] is None
+    print("Unit tests passed.")
@@ -8,11 +8,10 @@
 """
 import os, sys
 import arcpy
-from arcgis.gis import GIS
 from arcgis.gis import Item as ITEM
 from datetime import datetime
 from publish_service import BuildSD, PublishFromSD
-from portal import PortalContent
+from portal import PortalContent, get_session
 from config import Config
 
 mapobj = None # hacky stupid hacky hack hack
@@ -93,7 +92,7 @@ class PublishRoads(object):
         assert(os.path.exists(tnfile))
 
         #gis = GIS(url=Config.PORTAL_URL, profile=Config.PORTAL_PROFILE)
-        gis = GIS(Config.PORTAL_URL, Config.PORTAL_USER, Config.PORTAL_PASSWORD)
+        gis = get_session().gis
         print(f"Logged in to {Config.PORTAL_URL} as {str(gis.properties.user.username)}.")
         pcm = PortalContent(gis)
 
@@ -8,7 +8,7 @@ import os, sys
 import datetime
 import arcpy
 from arcgis.gis import GIS
-from portal import PortalContent
+from portal import PortalContent, get_session, finalize_items
 from popups import makePopup
 import xml.dom.minidom as DOM
 from xml_utils import EnableFeatureLayers, ConfigureFeatureserverCapabilities
@@ -59,6 +59,7 @@ def enable_feature_service(sddraft: str, sddraft_new: str) -> None:
 
 def delete_item(item) -> bool:
     item.protect(enable=False)
+    PortalContent.forget(item)
     try:
         return item.delete()
     except Exception as e:
@@ -201,8 +202,8 @@ def PublishFromSD(gis: GIS, map: object, mapd: dict, sd_file: str, thumbnail: st
     # You can override permissions, ownership, groups here too.
     # in_startupType HAS TO BE "STARTED" else no service is started on the SERVER.
 
-    # "IWA" DOES NOT WORK HERE, It JUST DEMANDS USERNAME AND PASSWORD NO MATTER WHAT
-    result = arcpy.SignInToPortal(portal_url=Config.PORTAL_URL, username=Config.PORTAL_USER, password=Config.PORTAL_PASSWORD)
+    # This is a no-op if we already signed in earlier in this run.
+    get_session().signInToArcpy()
 
     arcpy.AddMessage(f'Uploading sd file {sd_file} to "{mapd["folder"]}" folder.')
 
@@ -227,6 +228,10 @@ def PublishFromSD(gis: GIS, map: object, mapd: dict, sd_file: str, thumbnail: st
     except Exception as e:
         arcpy.AddError(e)
 
+    # Whatever we knew about these services before the upload is out of date now.
+    portal.forget(title=mapd["title"], type=portal.MapImageLayer)
+    portal.forget(title=mapd["name"], type=portal.FeatureService)
+
     mil_item = portal.getServiceItem(title=mapd["title"], type=portal.MapImageLayer) # Assuming we published a MIL.
     # should reference 17209289b3f642ebaa545ef3ab5a5f66
 
@@ -260,64 +265,62 @@ def PublishFromSD(gis: GIS, map: object, mapd: dict, sd_file: str, thumbnail: st
     with open(json_file, 'w') as fp:
         json.dump(popupDict, fp, indent=2)
 
-    print("Setting status to authoritative")
-    try:
-        mil_item.content_status = 'authoritative'
-    except Exception as e:
-        arcpy.AddMessage('Could not mark as authoritative.')
-        arcpy.AddMessage(e)
-
-    print("Marking as 'do not delete'.")
-    try:
-        mil_item.protect(enable=True)
-    except Exception as e:
-        arcpy.AddMessage('Could not mark as "no delete".')
-        arcpy.AddMessage(e)
+    # None of these calls depend on each other except that protect has to come after share,
+    # so they all go to the thread pool at once. See portal.finalize_items().
+    def set_status(item):
+        item.content_status = 'authoritative'
 
     # Update sharing. I think when I called this to fix groups without the "everyone" and "org" settings
     # they were defaulting to False, undoing whatever I did in the UploadServiceDefinition call.
     # https://developers.arcgis.com/python/api-reference/arcgis.gis.toc.html#arcgis.gis.Item.share
-    print("Set group members to edit.")
-    try:
-        mil_item.share(everyone=True, org=True, groups=release_groups, allow_members_to_edit=True)
-    except Exception as e:
-        arcpy.AddMessage('Could not set groups.')
-        arcpy.AddMessage(e)
-
-    print("Setting popup and thumbnail") 
-    try:
-        mil_item.update(item_properties = {'text' : popupDict, 'extent': extentProperty}, thumbnail=tn)
-    except Exception as e:
-        arcpy.AddMessage('Could not add popup.')
-        arcpy.AddMessage(e)
-    os.unlink(tn) # Get rid of the marked up thumbnail.
-
-    # Add a comment to the service
-    # Comments will log whoever ran the script and when. Note, they can't contain HTML
-    print("Adding comment.")
-    try:
-        mil_item.add_comment(f"Updated {textmark}.")
-    except Exception as e:
-        arcpy.AddMessage('Could not add comment.')
-        arcpy.AddMessage(e)
-
-    show(mil_item.id)
-
+    def share(item):
+        item.share(everyone=True, org=True, groups=release_groups, allow_members_to_edit=True)
+
+    def protect(item):
+        item.protect(enable=True) # Mark as "do not delete".
+
+    jobs = []
+    if mil_item:
+        jobs += [
+            [('Set status to authoritative', lambda: set_status(mil_item))],
+            [('Set group members to edit', lambda: share(mil_item)),
+             ('Mark as "do not delete"', lambda: protect(mil_item))],
+            [('Set popup and thumbnail', lambda: mil_item.update(
+                item_properties = {'text' : popupDict, 'extent': extentProperty}, thumbnail=tn))],
+            # Comments will log whoever ran the script and when. Note, they can't contain HTML
+            [('Add comment', lambda: mil_item.add_comment(f"Updated {textmark}."))],
+        ]
+
+    fl_item = None
     if mapd['makeFeatures']:
         arcpy.AddMessage("Publishing feature layer.")
         fl_item = portal.getServiceItem(title=mapd["name"], type=portal.FeatureService)
         if fl_item:
-            fl_item.update(item_properties = { 'text' : popupDict, 'extent': extentProperty })
-            fl_item.content_status = 'authoritative'
-            fl_item.protect(enable=True)
-            fl_item.share(everyone=True, org=True,
-                groups=release_groups, allow_members_to_edit=True)
+            jobs += [
+                [('Set feature layer popup', lambda: fl_item.update(
+                    item_properties = { 'text' : popupDict, 'extent': extentProperty }))],
+                [('Set feature layer status to authoritative', lambda: set_status(fl_item))],
+                [('Share feature layer', lambda: share(fl_item)),
+                 ('Protect feature layer', lambda: protect(fl_item))],
+                [('Add feature layer comment', lambda: fl_item.add_comment(f"Updated as {username}."))],
+            ]
+
+    report = finalize_items(jobs)
+    os.unlink(tn) # Get rid of the marked up thumbnail.
+    for (label, seconds, error) in report:
+        if error:
+            arcpy.AddMessage(f'Could not do "{label}" ({seconds:.1f}s). {error}')
+        else:
+            print(f'{label} ({seconds:.1f}s)')
 
-            fl_item.add_comment(f"Updated as {username}.")
-            show(fl_item.id)
+    if mil_item:
+        show(mil_item.id)
+    if fl_item:
+        show(fl_item.id)
 
     return
 
+
 # ==========================================================================
 if __name__ == "__main__":
     print("No unit tests here yet.")
@@ -9,8 +9,7 @@ There is also a layer "Roads by Jurisdiction", it is symbolized by jurisdiction.
 import os, sys
 import datetime
 import arcpy
-from arcgis.gis import GIS
-from portal import PortalContent
+from portal import PortalContent, get_session
 from publish_service import BuildSD, PublishFromSD
 from config import Config
 
@@ -22,7 +21,7 @@ if __name__ == "__main__":
     (scriptpath, scriptname) = os.path.split(__file__)
     arcpy.env.workspace = Config.SCRATCH_WORKSPACE
 
-    gis = GIS(Config.PORTAL_URL, Config.PORTAL_USER, Config.PORTAL_PASSWORD)
+    gis = get_session().gis
     portal = PortalContent(gis)
     print("Logged in as", str(portal.gis.properties.user.username))
 
@@ -20,9 +20,8 @@ so instead I'm doing it all correctly here. Like this.
 """
 import os, sys
 import arcpy
-from arcgis.gis import GIS
 from datetime import datetime
-from portal import PortalContent
+from portal import PortalContent, get_session
 from config import Config
 from watermark import mark
 
@@ -67,6 +66,9 @@ def replace_service(gis: object, staged_item: str, target_item: str, archive_nam
     gis.content.replace_service(replace_item=target_item, new_item=staged_item,
         replaced_service_name=archive_name, replace_metadata=True
     )
+    PortalContent.forget(target_item)
+    PortalContent.forget(staged_item)
+    PortalContent.forget(name=archive_name)
 
     try:
         # Override the rest of the metadata with what we want
@@ -152,27 +154,32 @@ class ReleaseBasemapServices(object):
             }
         ]
 
-        # This code does not belong here. Fix.
-        gis = GIS(Config.PORTAL_URL, Config.PORTAL_USER, Config.PORTAL_PASSWORD)
+        gis = get_session().gis
         portal = PortalContent(gis)
         print("Logged in as " + str(portal.gis.properties.user.username))
         # Validate the group list.
         release_groups = portal.getGroups(Config.RELEASE_GROUP_LIST)
 
+        # Look up everything in the table in one search.
+        found = portal.findMany([(service[title], None) 
+                for service in services for title in ('staged_title', 'target_title')])
+
         for service in services:
             #print(service)
 
             staged_title = service['staged_title']
-            staged_item = portal.getServiceItem(staged_title)
+            staged_item = found[(staged_title, None)]
             if not staged_item:
                 continue
 
             target_title = service['target_title']
-            target_item = portal.getServiceItem(target_title)
+            target_item = found[(target_title, None)]
             if not target_item:
                 # We're doing 'publish the first time', just rename. (This is fast.)
                 publishAs = target_title
                 staged_item.update(item_properties={"title": target_title})
+                PortalContent.forget(staged_item, title=staged_title)
+                PortalContent.forget(title=target_title)
                 staged_item.add_comment("Released into the wild! %s" % textmark)
 
             elif target_item.type == 'Vector Tile Package':
@@ -16,9 +16,8 @@ so instead I'm doing it all correctly here. Like this.
 4. Creates backups of the existing services. Marks the backup as deprecated.
 """
 import os, sys
-from arcgis.gis import GIS
 from datetime import datetime
-from portal import PortalContent
+from portal import PortalContent, get_session
 from config import Config
 sys.path.insert(0,'')
 
@@ -60,6 +59,9 @@ def replace_service(staged_item, target_item, archive_name) -> None:
     gis.content.replace_service(replace_item=target_item, new_item=staged_item,
         replaced_service_name=archive_name, replace_metadata=True
     )
+    PortalContent.forget(target_item)
+    PortalContent.forget(staged_item)
+    PortalContent.forget(name=archive_name)
 
     try:
         # Override the rest of the metadata with what we want
@@ -89,7 +91,7 @@ def update_sharing(gis: object, pc: PortalContent, service_title: str, release_g
 
 
 if __name__ == "__main__":
-    gis = GIS(Config.PORTAL_URL, Config.PORTAL_USER, Config.PORTAL_PASSWORD)
+    gis = get_session().gis
     print("Logged in as " + str(gis.properties.user.username))
     pc = PortalContent(gis)
 
@@ -147,20 +149,26 @@ if __name__ == "__main__":
     datestamp = datetime.now().strftime("%Y%m%d %H%M") # good for filenames
     textmark  = datetime.now().strftime("%m/%d/%y %H:%M") + ' ' + initials # more readable
 
+    # Look up everything in the table in one search.
+    found = pc.findMany([(service[title], None) 
+            for service in services for title in ('staged_title', 'target_title')])
+
     for service in services:
         print(service)
 
         staged_title = service['staged_title']
-        staged_item = pc.getServiceItem(staged_title)
+        staged_item = found[(staged_title, None)]
         if not staged_item:
             continue
 
         target_title = service['target_title']
-        target_item = pc.getServiceItem(target_title)
+        target_item = found[(target_title, None)]
         if not target_item:
             # We're doing 'publish the first time', just rename. (This is fast.)
             publishAs = target_title
             staged_item.update(item_properties={"title": target_title})
+            PortalContent.forget(staged_item, title=staged_title)
+            PortalContent.forget(title=target_title)
             staged_item.add_comment("Released into the wild! %s" % textmark)
         elif target_item.type == 'Vector Tile Package':
             # Well this code fails certainly 
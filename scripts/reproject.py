@@ -0,0 +1,458 @@
+"""
+reproject.py
+
+Reprojects coordinates from our State Plane (Config.LOCAL_SRS, NAD83 HARN
+Oregon North, international feet) to Web Mercator (Config.WM_SRS) with
+numpy, a whole array of points at a time, doing the same three steps as
+arcpy.management.Project with Config.TRANSFORMS:
+
+    1. Lambert Conformal Conic (2 standard parallels) inverse, feet => lon/lat on GRS 1980,
+    2. NAD_1983_HARN_To_WGS_1984_2, a 7 parameter "coordinate frame" shift,
+       done in earth centered XYZ,
+    3. Web Mercator (auxiliary sphere) forward, lon/lat => meters.
+
+The projection parameters are read out of the WKT in config.py, so if those
+change this follows along.
+
+Geometry is kept flat, the way a GPU or a shapefile would: one (n, 2) array
+of all the points, an array of where each part (ring or path) starts, and
+an array of where each feature's parts start. Geometries reads that
+straight out of WKB (what SHAPE@WKB gives you) and writes it back, so
+reprojecting a whole feature class is a cursor read, three numpy
+expressions and a cursor write.
+
+    python reproject.py              checks against published examples, then a benchmark
+    python reproject.py taxlots      benchmark against arcpy on the county taxlots
+"""
+import os, sys
+import re
+import time
+import struct
+import numpy as np
+from config import Config
+
+# NAD_1983_HARN_To_WGS_1984_2 (EPSG 1901), coordinate frame rotation.
+# Meters, arc seconds, parts per million.
+HARN_TO_WGS84 = {'dx': -0.991, 'dy': 1.9072, 'dz': 0.5129,
+                 'rx': -0.02579, 'ry': -0.00965, 'rz': -0.01166, 'ds': 0.0}
+
+# Semi-major axis and inverse flattening.
+WGS84 = (6378137.0, 298.257223563)
+GRS80 = (6378137.0, 298.257222101)
+
+ARCSEC = np.pi / (180 * 3600)
+
+
+def parse_lcc(wkt: str) -> dict:
+    """ The Lambert Conformal Conic parameters from an Esri PROJCS WKT string. """
+    spheroid = re.search(r'SPHEROID\["[^"]*",([\d.eE+-]+),([\d.eE+-]+)\]', wkt)
+    params = {name.lower(): float(value) for (name, value) in re.findall(r'PARAMETER\["([^"]+)",([\d.eE+-]+)\]', wkt)}
+    unit = re.findall(r'UNIT\["[^"]*",([\d.eE+-]+)\]', wkt)[-1]
+    if 'Lambert_Conformal_Conic' not in wkt:
+        raise ValueError("Not a Lambert Conformal Conic projection.")
+    return {
+        'a': float(spheroid.group(1)),
+        'f': 1 / float(spheroid.group(2)),
+        'false_easting': params['false_easting'],
+        'false_northing': params['false_northing'],
+        'central_meridian': params['central_meridian'],
+        'standard_parallel_1': params['standard_parallel_1'],
+        'standard_parallel_2': params['standard_parallel_2'],
+        'latitude_of_origin': params['latitude_of_origin'],
+        'unit': float(unit),
+    }
+
+
+class LambertConformalConic(object):
+    """ Snyder, "Map Projections - A Working Manual", pages 107-109. """
+
+    def __init__(self, p: dict) -> None:
+        self.a = p['a']
+        self.e2 = p['f'] * (2 - p['f'])
+        self.e = np.sqrt(self.e2)
+        self.unit = p['unit']
+        self.x0 = p['false_easting']
+        self.y0 = p['false_northing']
+        self.lon0 = np.radians(p['central_meridian'])
+        (phi1, phi2, phi0) = np.radians([p['standard_parallel_1'], p['standard_parallel_2'], p['latitude_of_origin']])
+        (m1, m2) = (self._m(phi1), self._m(phi2))
+        (t1, t2, t0) = (self._t(phi1), self._t(phi2), self._t(phi0))
+        self.n = np.log(m1 / m2) / np.log(t1 / t2) if phi1 != phi2 else np.sin(phi1)
+        self.aF = self.a * m1 / (self.n * t1 ** self.n)
+        self.rho0 = self.aF * t0 ** self.n
+
+        # Series for latitude from conformal latitude (Snyder 3-5), instead of iterating.
+        e2 = self.e2
+        self.series = (e2 / 2 + 5 * e2**2 / 24 + e2**3 / 12 + 13 * e2**4 / 360,
+                       7 * e2**2 / 48 + 29 * e2**3 / 240 + 811 * e2**4 / 11520,
+                       7 * e2**3 / 120 + 81 * e2**4 / 1120,
+                       4279 * e2**4 / 161280)
+        return
+
+    def _m(self, phi):
+        return np.cos(phi) / np.sqrt(1 - self.e2 * np.sin(phi)**2)
+
+    def _t(self, phi):
+        es = self.e * np.sin(phi)
+        return np.tan(np.pi / 4 - phi / 2) / ((1 - es) / (1 + es)) ** (self.e / 2)
+
+    def forward(self, lon, lat) -> tuple:
+        """ Degrees => projected units. """
+        lon = np.radians(lon)
+        lat = np.radians(lat)
+        rho = self.aF * self._t(lat) ** self.n
+        theta = self.n * (lon - self.lon0)
+        x = rho * np.sin(theta) / self.unit + self.x0
+        y = (self.rho0 - rho * np.cos(theta)) / self.unit + self.y0
+        return (x, y)
+
+    def inverse(self, x, y) -> tuple:
+        """ Projected units => degrees. """
+        x = (np.asarray(x, dtype=float) - self.x0) * self.unit
+        dy = self.rho0 - (np.asarray(y, dtype=float) - self.y0) * self.unit
+        sign = 1.0 if self.n > 0 else -1.0
+        rho = sign * np.hypot(x, dy)
+        theta = np.arctan2(sign * x, sign * dy)
+        t = (rho / self.aF) ** (1 / self.n)
+        chi = np.pi / 2 - 2 * np.arctan(t)
+        (c2, c4, c6, c8) = self.series
+        lat = chi + c2 * np.sin(2 * chi) + c4 * np.sin(4 * chi) + c6 * np.sin(6 * chi) + c8 * np.sin(8 * chi)
+        lon = theta / self.n + self.lon0
+        return (np.degrees(lon), np.degrees(lat))
+
+
+def to_ecef(lon, lat, a: float, rf: float) -> tuple:
+    """ Degrees on the ellipsoid (at height 0) => earth centered X, Y, Z in meters. """
+    (lon, lat) = (np.radians(lon), np.radians(lat))
+    f = 1 / rf
+    e2 = f * (2 - f)
+    sin_lat = np.sin(lat)
+    N = a / np.sqrt(1 - e2 * sin_lat**2)
+    return (N * np.cos(lat) * np.cos(lon), N * np.cos(lat) * np.sin(lon), N * (1 - e2) * sin_lat)
+
+
+def from_ecef(X, Y, Z, a: float, rf: float) -> tuple:
+    """ Earth centered X, Y, Z => degrees. Bowring's formula, sub millimeter near the surface. """
+    f = 1 / rf
+    e2 = f * (2 - f)
+    b = a * (1 - f)
+    ep2 = (a**2 - b**2) / b**2
+    p = np.hypot(X, Y)
+    theta = np.arctan2(Z * a, p * b)
+    lat = np.arctan2(Z + ep2 * b * np.sin(theta)**3, p - e2 * a * np.cos(theta)**3)
+    return (np.degrees(np.arctan2(Y, X)), np.degrees(lat))
+
+
+def helmert(lon, lat, t: dict = HARN_TO_WGS84, src=GRS80, dst=WGS84) -> tuple:
+    """ 7 parameter coordinate frame datum shift, degrees in and out. Heights are taken as 0. """
+    (X, Y, Z) = to_ecef(lon, lat, *src)
+    (rx, ry, rz) = (t['rx'] * ARCSEC, t['ry'] * ARCSEC, t['rz'] * ARCSEC)
+    m = 1 + t['ds'] * 1e-6
+    # Coordinate frame (EPSG 9607), the rotation signs are the opposite of "position vector".
+    X2 = m * (X + rz * Y - ry * Z) + t['dx']
+    Y2 = m * (-rz * X + Y + rx * Z) + t['dy']
+    Z2 = m * (ry * X - rx * Y + Z) + t['dz']
+    return from_ecef(X2, Y2, Z2, *dst)
+
+
+def web_mercator(lon, lat) -> tuple:
+    """ Degrees => Web Mercator meters (the sphere has the WGS84 semi-major axis). """
+    a = WGS84[0]
+    lat = np.clip(lat, -85.0511287798, 85.0511287798)
+    return (a * np.radians(lon), a * np.log(np.tan(np.pi / 4 + np.radians(lat) / 2)))
+
+
+class Reprojector(object):
+    """ Config.LOCAL_SRS => Config.WM_SRS, on an (n, 2) array. """
+
+    def __init__(self, wkt: str = Config.LOCAL_SRS, transform: dict = HARN_TO_WGS84) -> None:
+        p = parse_lcc(wkt)
+        self.lcc = LambertConformalConic(p)
+        self.ellipsoid = (p['a'], 1 / p['f'])
+        self.transform = transform
+        return
+
+    def geographic(self, xy: np.ndarray) -> np.ndarray:
+        """ State plane => WGS84 lon, lat. """
+        (lon, lat) = self.lcc.inverse(xy[:, 0], xy[:, 1])
+        if self.transform:
+            (lon, lat) = helmert(lon, lat, self.transform, src=self.ellipsoid)
+        return np.column_stack([lon, lat])
+
+    def __call__(self, xy) -> np.ndarray:
+        xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+        ll = self.geographic(xy)
+        return np.column_stack(web_mercator(ll[:, 0], ll[:, 1]))
+
+
+# WKB geometry type => (how deep the nesting goes, 0 for a point)
+WKB_DEPTH = {1: 0, 2: 1, 3: 2, 4: 1, 5: 2, 6: 3}
+
+
+class Geometries(object):
+    """
+    A batch of WKB geometries, with all their points in one flat array.
+
+        xy        (n, 2) every point of every feature
+        parts     where each part (ring or path) starts in xy, plus the end
+        features  where each feature starts in parts, plus the end
+
+    Z and M values, if there are any, are carried along untouched.
+    """
+
+    def __init__(self, blobs: list) -> None:
+        self.buffer = bytearray()
+        self.blobs = []       # (start, end) of each feature in buffer
+        runs = []             # (byte offset, points, bytes per point, byte order) for each part
+        features = [0]
+        for blob in blobs:
+            start = len(self.buffer)
+            self.buffer += blob or b''
+            self.blobs.append((start, len(self.buffer)))
+            if blob:
+                self._walk(start, runs)
+            features.append(len(runs))
+        self.features = np.array(features, dtype=np.int64)
+        sizes = np.array([r[1] for r in runs], dtype=np.int64)
+        self.parts = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+
+        # The byte offset of every point's X, so reading and writing them is one gather or scatter.
+        starts = np.array([r[0] for r in runs], dtype=np.int64)
+        strides = np.array([r[2] for r in runs], dtype=np.int64)
+        which = np.repeat(np.arange(len(runs)), sizes)
+        k = np.arange(self.parts[-1]) - np.repeat(self.parts[:-1], sizes)
+        self._x = starts[which] + k * strides[which]
+        self._big = np.array([r[3] for r in runs], dtype=bool)[which] if runs else np.zeros(0, dtype=bool)
+        return
+
+    def _walk(self, pos: int, runs: list) -> int:
+        """ Find the point runs in the WKB starting at pos, returns where it ends. """
+        buf = self.buffer
+        big = buf[pos] == 0
+        order = '>' if big else '<'
+        (kind,) = struct.unpack_from(order + 'I', buf, pos + 1)
+        pos += 5
+        # ISO says 1000 for Z, 2000 for M, 3000 for both. EWKB uses the high bits.
+        dims = 2 + (kind // 1000 in (1, 2)) + 2 * (kind // 1000 == 3)
+        if kind & 0x80000000:
+            dims += 1
+        if kind & 0x40000000:
+            dims += 1
+        base = (kind & 0x0FFFFFFF) % 1000
+        depth = WKB_DEPTH.get(base)
+        if depth is None:
+            raise ValueError("Can't read WKB geometry type %d." % kind)
+        if depth == 0:
+            runs.append((pos, 1, dims * 8, big))
+            return pos + dims * 8
+        if base in (4, 5, 6):
+            # Multi-anything is a count followed by whole WKB geometries.
+            (count,) = struct.unpack_from(order + 'I', buf, pos)
+            pos += 4
+            for i in range(count):
+                pos = self._walk(pos, runs)
+            return pos
+        if depth == 2:
+            (rings,) = struct.unpack_from(order + 'I', buf, pos)
+            pos += 4
+        else:
+            rings = 1
+        for i in range(rings):
+            (n,) = struct.unpack_from(order + 'I', buf, pos)
+            pos += 4
+            runs.append((pos, n, dims * 8, big))
+            pos += n * dims * 8
+        return pos
+
+    def _index(self, offset: int) -> np.ndarray:
+        return (self._x + offset)[:, None] + np.arange(8)
+
+    @property
+    def xy(self) -> np.ndarray:
+        raw = np.frombuffer(self.buffer, dtype=np.uint8)
+        xy = np.empty((len(self._x), 2))
+        for (col, offset) in ((0, 0), (1, 8)):
+            b = raw[self._index(offset)]
+            b[self._big] = b[self._big, ::-1]
+            xy[:, col] = b.copy().view('<f8').ravel()
+        return xy
+
+    @xy.setter
+    def xy(self, xy: np.ndarray) -> None:
+        raw = np.frombuffer(self.buffer, dtype=np.uint8)
+        xy = np.asarray(xy, dtype='<f8').reshape(-1, 2)
+        for (col, offset) in ((0, 0), (1, 8)):
+            b = np.ascontiguousarray(xy[:, col]).view(np.uint8).reshape(-1, 8).copy()
+            b[self._big] = b[self._big, ::-1]
+            raw[self._index(offset)] = b
+        return
+
+    def wkb(self) -> list:
+        """ The WKB of each feature, with whatever xy is now. None stays None. """
+        return [bytes(self.buffer[start:end]) if end > start else None for (start, end) in self.blobs]
+
+
+def project_wkb(blobs: list, reprojector: Reprojector = None) -> list:
+    """ Reproject a list of WKB geometries, returns a list of WKB. """
+    g = Geometries(blobs)
+    g.xy = (reprojector or Reprojector())(g.xy)
+    return g.wkb()
+
+
+# State plane feet => Web Mercator meters through EPSG 2913 and EPSG 1901, worked out once with PROJ 9.
+# If a sign or a parameter above is wrong these move by meters.
+CONTROL_POINTS = [
+    (7400000.0, 900000.0, -13765998.6446, 5795125.9668),
+    (7280000.0, 820000.0, -13817021.8408, 5757804.6714),
+    (7650000.0, 960000.0, -13657063.8527, 5825210.9353),
+]
+
+
+def check() -> list:
+    """
+    Compare with published worked examples. Returns a list of (what, error, allowed)
+    in meters, the examples are only given to the cm or so.
+    """
+    results = []
+
+    # Snyder page 296: Clarke 1866, parallels 33 and 45, origin 23N 96W.
+    lcc = LambertConformalConic({'a': 6378206.4, 'f': 1 / 294.978698214, 'unit': 1.0,
+                                 'false_easting': 0, 'false_northing': 0, 'central_meridian': -96,
+                                 'standard_parallel_1': 33, 'standard_parallel_2': 45, 'latitude_of_origin': 23})
+    (x, y) = lcc.forward(-75.0, 35.0)
+    results.append(("Snyder LCC example", max(abs(x - 1894410.9), abs(y - 1564649.5)), 0.05))
+    (lon, lat) = lcc.inverse(1894410.9, 1564649.5)
+    assert abs(lon + 75) < 1e-6 and abs(lat - 35) < 1e-6, (lon, lat)
+
+    # EPSG Guidance Note 7-2, Lambert 2SP: Texas South Central, NAD27, US survey feet.
+    lcc = LambertConformalConic({'a': 6378206.4, 'f': 1 / 294.978698214, 'unit': 0.3048006096012192,
+                                 'false_easting': 2000000.0, 'false_northing': 0.0,
+                                 'central_meridian': -99.0, 'standard_parallel_1': 28 + 23 / 60,
+                                 'standard_parallel_2': 30 + 17 / 60, 'latitude_of_origin': 27 + 50 / 60})
+    (x, y) = lcc.forward(-96.0, 28.5)
+    results.append(("EPSG LCC 2SP example", max(abs(x - 2963503.91), abs(y - 254759.80)) * 0.3048, 0.005))
+
+    # EPSG Guidance Note 7-2, Popular Visualisation Pseudo Mercator.
+    (x, y) = web_mercator(-(100 + 20 / 60), 24 + 22 / 60 + 54.433 / 3600)
+    results.append(("EPSG Pseudo Mercator example", max(abs(x + 11169055.58), abs(y - 2800000.00)), 0.005))
+
+    # Our projection, there and back.
+    r = Reprojector()
+    rng = np.random.default_rng(1)
+    xy = np.column_stack([rng.uniform(7.0e6, 7.5e6, 1000), rng.uniform(7.5e5, 1.0e6, 1000)])
+    (lon, lat) = r.lcc.inverse(xy[:, 0], xy[:, 1])
+    (x, y) = r.lcc.forward(lon, lat)
+    results.append(("State plane there and back", max(np.abs(x - xy[:, 0]).max(), np.abs(y - xy[:, 1]).max()) * 0.3048, 0.001))
+
+    # The HARN to WGS84 shift is about a meter here, undoing it should land back where we started.
+    (lon2, lat2) = helmert(lon, lat)
+    undo = {k: -v for (k, v) in HARN_TO_WGS84.items()}
+    (lon3, lat3) = helmert(lon2, lat2, undo, src=WGS84, dst=GRS80)
+    shift = np.hypot((lon2 - lon) * 111320 * np.cos(np.radians(lat)), (lat2 - lat) * 110540)
+    assert 0.5 < shift.mean() < 2.0, shift.mean()
+    back = np.hypot((lon3 - lon) * 111320 * np.cos(np.radians(lat)), (lat3 - lat) * 110540).max()
+    results.append(("HARN to WGS84 there and back", back, 0.001))
+
+    # The whole thing, against points that didn't come from this code.
+    control = np.array(CONTROL_POINTS)
+    error = np.abs(r(control[:, :2]) - control[:, 2:]).max()
+    results.append(("Control points (EPSG 1901)", error, 0.005))
+    return results
+
+
+def check_arcpy(points: np.ndarray) -> float:
+    """ The worst difference from arcpy's Project on these state plane points, in meters. """
+    import arcpy
+    local = arcpy.SpatialReference(text=Config.LOCAL_SRS)
+    wm = arcpy.SpatialReference(text=Config.WM_SRS)
+    expected = []
+    for (x, y) in points:
+        p = arcpy.PointGeometry(arcpy.Point(x, y), local).projectAs(wm, Config.TRANSFORMS[0]).firstPoint
+        expected.append((p.X, p.Y))
+    return float(np.abs(Reprojector()(points) - np.array(expected)).max())
+
+
+def benchmark(n: int = 2000000) -> None:
+    r = Reprojector()
+    rng = np.random.default_rng(1)
+    xy = np.column_stack([rng.uniform(7.0e6, 7.5e6, n), rng.uniform(7.5e5, 1.0e6, n)])
+    t0 = time.perf_counter()
+    r(xy)
+    seconds = time.perf_counter() - t0
+    print("%d points in %.3fs, %.1f million points/s" % (n, seconds, n / seconds / 1e6))
+    return
+
+
+def benchmark_featureclass(src: str) -> None:
+    """ Time us against arcpy.management.Project on a feature class, and compare the results. """
+    import arcpy
+    arcpy.env.overwriteOutput = True
+    t0 = time.perf_counter()
+    with arcpy.da.SearchCursor(src, ['OID@', 'SHAPE@WKB']) as cursor:
+        rows = list(cursor)
+    t1 = time.perf_counter()
+    projected = project_wkb([wkb for (oid, wkb) in rows])
+    t2 = time.perf_counter()
+    g = Geometries(projected)
+    print("numpy: read %d features in %.1fs, reprojected %d points in %.2fs" % (
+        len(rows), t1 - t0, len(g.xy), t2 - t1))
+
+    dst = os.path.join(Config.SCRATCH_WORKSPACE, "reproject_benchmark.gdb")
+    if not arcpy.Exists(dst):
+        arcpy.management.CreateFileGDB(*os.path.split(dst))
+    out = os.path.join(dst, "projected")
+    t0 = time.perf_counter()
+    arcpy.management.Project(in_dataset=src, out_dataset=out,
+        out_coor_system = Config.WM_SRS, transform_method = Config.TRANSFORMS,
+        in_coor_system = Config.LOCAL_SRS,
+        preserve_shape="NO_PRESERVE_SHAPE", max_deviation="", vertical="NO_VERTICAL")
+    print("arcpy Project: %.1fs" % (time.perf_counter() - t0))
+
+    # The same features should come out within a few millimeters.
+    theirs = {oid: wkb for (oid, wkb) in arcpy.da.SearchCursor(out, ['OID@', 'SHAPE@WKB'])}
+    ours = dict(zip((oid for (oid, wkb) in rows), projected))
+    common = [oid for oid in ours if ours[oid] and theirs.get(oid)]
+    a = Geometries([ours[oid] for oid in common])
+    b = Geometries([bytes(theirs[oid]) for oid in common])
+    if len(a.xy) == len(b.xy):
+        print("Worst difference from arcpy: %.4f m" % np.abs(a.xy - b.xy).max())
+    else:
+        print("arcpy changed the number of points (%d vs %d), can't compare them one for one." % (len(b.xy), len(a.xy)))
+    return
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'taxlots':
+        src = sys.argv[2] if len(sys.argv) > 2 else os.path.join("cc-thesql_SDE.sde", "Clatsop.DBO.taxlot_accounts")
+        benchmark_featureclass(src)
+        exit(0)
+
+    for (what, error, allowed) in check():
+        print("%-30s %.4f m" % (what, error))
+        assert error <= allowed, what
+
+    # A square with a hole, a line and a point, through WKB and back.
+    square = struct.pack('<BII', 1, 3, 2) + struct.pack('<I', 5) + struct.pack('<10d',
+        7.2e6, 8.0e5, 7.3e6, 8.0e5, 7.3e6, 9.0e5, 7.2e6, 9.0e5, 7.2e6, 8.0e5) + struct.pack('<I', 4) + struct.pack('<8d',
+        7.24e6, 8.4e5, 7.26e6, 8.4e5, 7.25e6, 8.6e5, 7.24e6, 8.4e5)
+    line = struct.pack('>BII', 0, 2, 2) + struct.pack('>4d', 7.1e6, 8.1e5, 7.11e6, 8.2e5)
+    point = struct.pack('<BI3d', 1, 1001, 7.15e6, 8.5e5, 12.5)
+    g = Geometries([square, None, line, point])
+    assert list(g.parts) == [0, 5, 9, 11, 12] and list(g.features) == [0, 2, 2, 3, 4]
+    assert g.xy[9].tolist() == [7.1e6, 8.1e5] and g.xy[11].tolist() == [7.15e6, 8.5e5]
+    r = Reprojector()
+    out = Geometries(project_wkb([square, None, line, point], r))
+    assert np.allclose(out.xy, r(g.xy)) and out.wkb()[1] is None
+    assert struct.unpack_from('<d', out.wkb()[3], 21)[0] == 12.5
+    (x, y) = out.xy[0]
+    # Near Astoria, Web Mercator.
+    assert -13900000 < x < -13700000 and 5700000 < y < 5900000, (x, y)
+    print("Unit tests passed.")
+
+    benchmark()
+    try:
+        import arcpy
+        points = np.array([[7.2e6, 8.0e5], [7.4e6, 9.5e5], [7.0e6, 7.6e5]])
+        print("Worst difference from arcpy: %.4f m" % check_arcpy(points))
+    except ImportError:
+        pass
@@ -1,44 +1,359 @@
-# Republish raster tiles for a basemap
+"""
+republish_raster_tiles.py
 
-import sys, os
-import arcpy
+Updates the raster tile cache of a map image service, but only the tiles
+that could have changed since the last time this ran.
+
+    1. Find the features edited since the last run, using the editor tracking
+       date field (EDITED_FIELD) in each layer of the source map. A feature
+       that moved or changed shape has to be redrawn where it was too, so
+       the extent of every feature is kept in a footprint file, by OID.
+       Features whose OIDs are gone were deleted, their old extents get
+       redrawn as well.
+    2. At each scale, grow each feature's extent by how far its symbols and
+       labels can reach (SYMBOL_PIXELS pixels at that scale's resolution).
+    3. Snap those to tiles and merge the tiles into as few rectangles as
+       we can, one set of rectangles per scale.
+    4. Recreate the tiles in those rectangles, a few rectangles per job.
+
+The jobs are kept in a journal file. If the run gets interrupted (or a job
+fails), running it again picks up at the first job that isn't finished,
+it doesn't start over. The last run's start time is kept in a state file
+and becomes "since" for the next run.
+
+The first run for a layer has no footprints yet, so it reads every
+feature to make them. That run misses a moved feature's old spot and
+any deletes, recreate those areas by hand.
+
+    python republish_raster_tiles.py              update everything edited since the last run
+    python republish_raster_tiles.py 2024-05-01   update everything edited since then
+    python republish_raster_tiles.py create       make a new cache for the service
+    python republish_raster_tiles.py test         unit tests, no arcpy needed
+"""
+import os, sys
+import json
+import time
+from datetime import datetime
+import numpy as np
+from config import Config
+import tiling
 
 map_image_layer = "https://delta.co.clatsop.or.us/server/rest/services/Hosted/Astoria_Base_Map/MapServer"
-area_of_interest = None
+service_cache_directory = "c:\\arcgisserver\\directories\\arcgiscache"
+lods = range(11, 17)
+
+# The map with the layers the service draws, we look for edits in these.
+source_map = Config.DATASOURCE_MAP
+# Editor tracking puts this on every feature.
+EDITED_FIELD = Config.EDITED_FIELD
+# How far past a feature its symbol or label can draw, in pixels. Labels are the wide ones.
+SYMBOL_PIXELS = 64
+# Rectangles sent to the server in one job. Fewer jobs is less overhead, more is a finer journal.
+RECTS_PER_JOB = 25
+
+STATE_FILE = os.path.join(Config.SCRATCH_WORKSPACE, "raster_cache_state.json")
+JOURNAL_FILE = os.path.join(Config.SCRATCH_WORKSPACE, "raster_cache_journal.json")
+# The extent of every feature in the source map at the last run, by layer and OID.
+FOOTPRINT_FILE = os.path.join(Config.SCRATCH_WORKSPACE, "raster_cache_footprints.json")
+
+
+def update_tiles(extents, lod: int, pixels: int = SYMBOL_PIXELS) -> tuple:
+    """
+    The tiles at 'lod' that features with these (n, 4) extents can draw into,
+    given their symbols reach 'pixels' past the feature. Returns unique (rows, cols).
+    """
+    extents = np.asarray(extents, dtype=float).reshape(-1, 4)
+    n = 2 ** lod
+    if not len(extents):
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    pad = pixels * float(tiling.lod_resolutions(lod))
+    width = float(tiling.tile_widths(lod))
+    r0 = np.clip(np.floor((tiling.ORIGIN_Y - extents[:, 3] - pad) / width), 0, n - 1).astype(np.int64)
+    r1 = np.clip(np.floor((tiling.ORIGIN_Y - extents[:, 1] + pad) / width), 0, n - 1).astype(np.int64)
+    c0 = np.clip(np.floor((extents[:, 0] - pad - tiling.ORIGIN_X) / width), 0, n - 1).astype(np.int64)
+    c1 = np.clip(np.floor((extents[:, 2] + pad - tiling.ORIGIN_X) / width), 0, n - 1).astype(np.int64)
+
+    # Every tile in every box, without a loop: repeat each box's first tile, then add offsets.
+    heights = r1 - r0 + 1
+    widths = c1 - c0 + 1
+    sizes = heights * widths
+    box = np.repeat(np.arange(len(extents)), sizes)
+    i = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    rows = r0[box] + i // widths[box]
+    cols = c0[box] + i % widths[box]
+    keys = np.unique(rows * n + cols)
+    return (keys // n, keys % n)
+
+
+def merge_tiles(rows, cols) -> np.ndarray:
+    """
+    Merge tiles into rectangles: runs of tiles along each row, then runs
+    that line up in the rows below. Not always the fewest possible, but
+    close for the blobs that edits make. Returns (n, 4) first row, last row,
+    first col, last col.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    if not len(rows):
+        return np.zeros((0, 4), dtype=np.int64)
+    order = np.lexsort((cols, rows))
+    (rows, cols) = (rows[order], cols[order])
+    # A run starts where the row changes or there's a gap.
+    starts = np.ones(len(rows), dtype=bool)
+    starts[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1] + 1)
+    first = np.flatnonzero(starts)
+    last = np.append(first[1:], len(rows)) - 1
+    runs = np.column_stack([rows[first], cols[first], cols[last]])
+
+    # Stack runs with the same columns in consecutive rows.
+    order = np.lexsort((runs[:, 0], runs[:, 2], runs[:, 1]))
+    runs = runs[order]
+    starts = np.ones(len(runs), dtype=bool)
+    starts[1:] = ((runs[1:, 1] != runs[:-1, 1]) | (runs[1:, 2] != runs[:-1, 2]) | (runs[1:, 0] != runs[:-1, 0] + 1))
+    first = np.flatnonzero(starts)
+    last = np.append(first[1:], len(runs)) - 1
+    return np.column_stack([runs[first, 0], runs[last, 0], runs[first, 1], runs[first, 2]])
+
+
+def rect_extent(lod: int, rect) -> list:
+    """ Web Mercator (xmin, ymin, xmax, ymax) of a rectangle of tiles. """
+    (r0, r1, c0, c1) = (int(v) for v in rect)
+    (xmin, _, _, ymax) = tiling.tile_extent(lod, r0, c0)
+    (_, ymin, xmax, _) = tiling.tile_extent(lod, r1, c1)
+    return [xmin, ymin, xmax, ymax]
+
+
+def plan_jobs(extents, lods, pixels: int = SYMBOL_PIXELS, per_job: int = RECTS_PER_JOB) -> list:
+    """ The jobs to recreate the tiles that edits with these extents touch, for the journal. """
+    jobs = []
+    for lod in lods:
+        rects = merge_tiles(*update_tiles(extents, lod, pixels))
+        scale = round(float(tiling.lod_scales(lod)), 6)
+        for i in range(0, len(rects), per_job):
+            batch = rects[i:i + per_job]
+            jobs.append({
+                'lod': lod,
+                'scale': scale,
+                'tiles': int(((batch[:, 1] - batch[:, 0] + 1) * (batch[:, 3] - batch[:, 2] + 1)).sum()),
+                'extents': [rect_extent(lod, rect) for rect in batch],
+                'done': None,
+            })
+    return jobs
+
 
-def do_work(input_service, area_of_interest) :
-    scales = [11, 12, 13, 14, 15, 16]
+def read_json(filename: str) -> dict:
+    try:
+        with open(filename) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def write_json(filename: str, data: dict) -> None:
+    """ Write a new file then swap it in, so a crash never leaves half a journal. """
+    with open(filename + '.tmp', 'w') as fp:
+        json.dump(data, fp, indent=2)
+    os.replace(filename + '.tmp', filename)
+    return
+
+
+def footprint_changes(known: dict, edited: dict, current) -> list:
+    """
+    The extents to redraw for one layer, and bring 'known' up to date.
+
+    'known' is {oid: extent} from the last run, 'edited' is {oid: extent} for
+    the features edited since then, 'current' is every OID in the layer now.
+    OIDs are strings, JSON keys have to be.
+    Returns the new extents of the edited features, their old extents when
+    they moved, and the old extents of the features that are gone.
+    """
+    extents = []
+    for (oid, extent) in edited.items():
+        extents.append(extent)
+        old = known.get(oid)
+        if old and old != extent:
+            extents.append(old)
+        known[oid] = extent
+    for oid in set(known) - set(current):
+        extents.append(known.pop(oid))
+    return extents
+
+
+def edited_extents(map, since: datetime, footprints: dict) -> np.ndarray:
+    """
+    Web Mercator extents of the features in the map's layers edited after 'since',
+    plus where they were before, see footprint_changes. 'footprints' is from
+    FOOTPRINT_FILE, {layer: {oid: extent}}, it gets updated.
+    """
+    import arcpy
+    web_mercator = arcpy.SpatialReference(3857)
+    extents = []
+
+    def read_extents(layer, where=None) -> dict:
+        found = {}
+        with arcpy.da.SearchCursor(layer, ['OID@', 'SHAPE@'], where_clause=where, spatial_reference=web_mercator) as cursor:
+            for (oid, shape) in cursor:
+                if shape is None:
+                    continue
+                e = shape.extent
+                found[str(oid)] = [round(v, 2) for v in (e.XMin, e.YMin, e.XMax, e.YMax)]
+        return found
 
-    # You should provide one of these
-    aoi_featureset = None
-    update_extent = None
+    for layer in map.listLayers():
+        if not layer.isFeatureLayer:
+            continue
+        fields = [f.name.lower() for f in arcpy.ListFields(layer)]
+        if EDITED_FIELD.lower() not in fields:
+            print("Skipping \"%s\", it has no %s field." % (layer.longName, EDITED_FIELD))
+            continue
+        when = since.strftime('%Y-%m-%d %H:%M:%S')
+        # File geodatabases want a date literal, SQL Server is happy with a string.
+        if '.gdb' in layer.dataSource.lower():
+            where = "%s > timestamp '%s'" % (EDITED_FIELD, when)
+        else:
+            where = "%s > '%s'" % (EDITED_FIELD, when)
+        edited = read_extents(layer, where)
+        known = footprints.get(layer.longName)
+        if known is None:
+            # First time for this layer, all we can do is remember where everything is for next time.
+            print("\"%s\": no footprints yet, reading every feature." % layer.longName)
+            footprints[layer.longName] = read_extents(layer)
+            extents.extend(edited.values())
+            print("\"%s\": %d edited features" % (layer.longName, len(edited)))
+            continue
+        with arcpy.da.SearchCursor(layer, ['OID@']) as cursor:
+            current = [str(oid) for (oid,) in cursor]
+        moved = sum(1 for (oid, extent) in edited.items() if known.get(oid) and known[oid] != extent)
+        deleted = len(set(known) - set(current))
+        extents.extend(footprint_changes(known, edited, current))
+        print("\"%s\": %d edited features, %d moved, %d deleted" % (layer.longName, len(edited), moved, deleted))
+    return np.array(extents, dtype=float).reshape(-1, 4)
 
-    # Does the service already exist?
-    # if blah blah
-    
-    # I could make up a tiling scheme here and save it in an XML file
-    # and then send the XML file into the Create*
 
+def create_cache(input_service: str) -> None:
+    import arcpy
+    scales = [round(s, 6) for s in tiling.lod_scales(lods)]
     try:
-        arcpy.CreateMapServerCache_server(input_service, service_cache_directory,
-                "NEW",  
-                scales_type, 
-                6, 96, tile_size="256x256",
-                tile_origin=
-                scales=[9028,18056,36112,72224,144448,288895])
+        arcpy.server.CreateMapServerCache(input_service, service_cache_directory,
+                "NEW", "CUSTOM",
+                len(scales), tiling.DPI, tile_size="256x256",
+                scales=scales)
     except Exception as e:
         print("Create failed; ", e)
-    
+    return
+
+
+def run_job(input_service: str, job: dict) -> None:
+    """ Recreate the tiles in one job's rectangles. """
+    import arcpy
+    web_mercator = arcpy.SpatialReference(3857)
+    aoi = arcpy.management.CreateFeatureclass("memory", "cache_aoi", "POLYGON", spatial_reference=web_mercator)[0]
     try:
-        out_job_url = arcpy.ManageMapServerCacheTiles_server(input_service, scales, "RECREATE_ALL_TILES", -1, aoi_featureset, update_extent, True)
-        print("Look at this URL for status:", out_job_url)
+        with arcpy.da.InsertCursor(aoi, ['SHAPE@']) as cursor:
+            for (xmin, ymin, xmax, ymax) in job['extents']:
+                ring = arcpy.Array([arcpy.Point(xmin, ymin), arcpy.Point(xmin, ymax),
+                                    arcpy.Point(xmax, ymax), arcpy.Point(xmax, ymin), arcpy.Point(xmin, ymin)])
+                cursor.insertRow([arcpy.Polygon(ring, web_mercator)])
+        arcpy.server.ManageMapServerCacheTiles(input_service, [job['scale']], "RECREATE_ALL_TILES", -1,
+                                               aoi, None, "WAIT")
+    finally:
+        arcpy.management.Delete(aoi)
+    return
 
-    except Exception as e:
-        print("A serious error occurred; ", e)
+
+def do_work(input_service: str, since: datetime = None) -> bool:
+    """ Update the cache for edits since 'since' (default: the last run). Returns True if it all finished. """
+    journal = read_json(JOURNAL_FILE)
+    if journal and journal.get('service') == input_service:
+        print("Picking up the unfinished run from %s." % journal['started'])
+    else:
+        import arcpy
+        state = read_json(STATE_FILE) or {}
+        if since is None:
+            if input_service not in state:
+                print("I don't know when the last run was, give me a date like 2024-05-01.")
+                return False
+            since = datetime.fromisoformat(state[input_service])
+        started = datetime.now()
+        aprx = arcpy.mp.ArcGISProject(Config.BASEMAP_APRX)
+        maps = aprx.listMaps(source_map)
+        if len(maps) != 1:
+            print("Map \"%s\" not found." % source_map)
+            return False
+        print("Looking for edits since %s." % since.isoformat())
+        footprints = read_json(FOOTPRINT_FILE) or {}
+        extents = edited_extents(maps[0], since, footprints.setdefault(input_service, {}))
+        journal = {
+            'service': input_service,
+            'since': since.isoformat(),
+            'started': started.isoformat(),
+            'features': len(extents),
+            'jobs': plan_jobs(extents, lods),
+        }
+        write_json(JOURNAL_FILE, journal)
+        # After the journal, so if we stop in between, the old extents are still in one or the other.
+        write_json(FOOTPRINT_FILE, footprints)
+
+    jobs = journal['jobs']
+    todo = [job for job in jobs if not job['done']]
+    print("%d jobs, %d tiles, %d still to do." % (len(jobs), sum(j['tiles'] for j in jobs), len(todo)))
+    errors = 0
+    for (n, job) in enumerate(todo, 1):
+        t0 = time.perf_counter()
+        try:
+            run_job(input_service, job)
+        except Exception as e:
+            # Leave it in the journal, the next run will try it again.
+            print("%d/%d LOD %d failed; " % (n, len(todo), job['lod']), e)
+            errors += 1
+            continue
+        job['done'] = datetime.now().isoformat()
+        write_json(JOURNAL_FILE, journal)
+        print("%d/%d LOD %d, %d tiles in %.1fs" % (n, len(todo), job['lod'], job['tiles'], time.perf_counter() - t0))
+
+    if errors:
+        print("%d jobs failed, run me again to retry them." % errors)
         return False
+    # All done: the next run looks for edits made after this one started.
+    state = read_json(STATE_FILE) or {}
+    state[input_service] = journal['started']
+    write_json(STATE_FILE, state)
+    os.unlink(JOURNAL_FILE)
     return True
 
+
 if __name__ == '__main__':
-    print("here we are")
-    do_work(map_image_layer, area_of_interest)
+    if len(sys.argv) > 1 and sys.argv[1] == 'test':
+        # Three edits: two close together, one by itself.
+        extents = [(-13775000, 5845000, -13774900, 5845100),
+                   (-13774800, 5845000, -13774700, 5845050),
+                   (-13760000, 5830000, -13759000, 5831000)]
+        for lod in lods:
+            (rows, cols) = update_tiles(extents, lod)
+            rects = merge_tiles(rows, cols)
+            # The rectangles cover exactly the tiles, no more, no less.
+            covered = set()
+            for (r0, r1, c0, c1) in rects.tolist():
+                covered |= {(r, c) for r in range(r0, r1 + 1) for c in range(c0, c1 + 1)}
+            assert covered == set(zip(rows.tolist(), cols.tolist())), lod
+            assert sum((r1 - r0 + 1) * (c1 - c0 + 1) for (r0, r1, c0, c1) in rects.tolist()) == len(rows)
+            print("LOD %d: %d tiles in %d rectangles" % (lod, len(rows), len(rects)))
+        # A full block of tiles is one rectangle.
+        assert len(merge_tiles(*np.divmod(np.arange(100), 10))) == 1
+        assert len(plan_jobs(np.zeros((0, 4)), lods)) == 0
+        # A feature that moved gets both extents, one that's gone gets its old one, an unmoved edit just its own.
+        known = {'1': [0, 0, 1, 1], '2': [5, 5, 6, 6], '3': [8, 8, 9, 9]}
+        changed = footprint_changes(known, {'1': [2, 2, 3, 3], '3': [8, 8, 9, 9], '4': [7, 7, 8, 8]}, ['1', '3', '4'])
+        assert sorted(changed) == [[0, 0, 1, 1], [2, 2, 3, 3], [5, 5, 6, 6], [7, 7, 8, 8], [8, 8, 9, 9]]
+        assert known == {'1': [2, 2, 3, 3], '3': [8, 8, 9, 9], '4': [7, 7, 8, 8]}
+        print("Unit tests passed.")
+        exit(0)
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'create':
+        create_cache(map_image_layer)
+        exit(0)
 
+    since = datetime.fromisoformat(sys.argv[1]) if len(sys.argv) > 1 else None
+    if not do_work(map_image_layer, since):
+        exit(1)
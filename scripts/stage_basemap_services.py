@@ -15,12 +15,15 @@ warning and press on than to crash and leave things in an
 indeterminate state.
 """
 import os, sys
+import time
 from posixpath import splitext
 import arcpy
-from arcgis.gis import GIS
 from datetime import datetime
 from config import Config
-from portal import PortalContent
+from portal import PortalContent, get_session
+import multipart_upload
+import estimate_tiles
+from tile_packages import build_packages, build_workers, pipeline, upload_and_stage
 from watermark import mark
 
 #TEST = True # Generate a test service only.
@@ -62,43 +65,9 @@ def find_map(aprx, mapname):
     return maps[0]
 
 
-def build_tile_package(map, pkgname, min_zoom = Config.MIN_COUNTY_ZOOM, overwrite=False):
-    """ Build a tile package. Does not overwrite by default.
-
-    'map' is a map from an aprx
-    'pkgname' is the name of the package (will be the filename too)
-    'min_zoom' defaults to county level, you might choose tax level
-    'overwrite' is (well you know) True or False, defaults to False
-
-    Returns absolute pathname of package if a package was built or None
-    (We need the path to be absolute when we do the "add" in staging.)
-    """
-    pkgfile = os.path.join(arcpy.env.workspace, pkgname + '.vtpk')
-    if arcpy.Exists(pkgfile): # BTW, this uses the workspace env
-        if overwrite:
-            os.unlink(pkgfile)
-        else:
-            print("Reusing existing file, %s" % pkgfile)
-            return pkgfile
-
-    # I tried to add a description to the map object here but it did not work.
-    # If there is no description, the Esri tool fails. Sorry.
-
-    # Note, we'll update metadata later .
-    # BTW, that 99999 error you're getting could be a definition query problem.
-    # RTM https://pro.arcgis.com/en/pro-app/latest/tool-reference/data-management/create-vector-tile-package.htm
-
-    arcpy.management.CreateVectorTilePackage(map, pkgfile, 
-        service_type="ONLINE", tiling_scheme=None, 
-        tile_structure="FLAT", # or INDEXED
-        min_cached_scale=min_zoom, max_cached_scale=Config.MAX_ZOOM
-    )
-
-    return pkgfile
-
-
 def delete_item(item) -> bool:
     item.protect(enable=False)
+    PortalContent.forget(item)
     try:
         return item.delete()
     except Exception as e:
@@ -121,6 +90,8 @@ def upload_tile_package(portal, pkgname, pkgfile, description, overwrite=True):
 
     # 2021-10-15 I've had this fail, I worked around it by deleting manually. 
     existing_item = pc.findItem(name=pkgname, type=pc.VectorTilePackage)
+    if existing_item and existing_item.id == multipart_upload.pending(pkgfile):
+        existing_item = None # It's our own upload that got interrupted, it will be resumed.
     if existing_item:
         if overwrite:
             delete_item(existing_item)
@@ -129,16 +100,22 @@ def upload_tile_package(portal, pkgname, pkgfile, description, overwrite=True):
             return existing_item
 
     try:
-        # Basically ANY or ALL the metadata can be written with the add() method.
-        pkg_item = portal.content.add({
-                'title': pkgname.replace('_', ' '),
-            },
-            data=pkgfile, # Absolute path or URL
-            folder="Basemaps"
-        )
+        if os.path.getsize(pkgfile) > Config.MULTIPART_THRESHOLD:
+            # Big files go up in parts that can be resumed, see multipart_upload.py.
+            itemid = multipart_upload.upload(pkgfile, {'title': pkgname.replace('_', ' ')}, folder="Basemaps")
+            pkg_item = portal.content.get(itemid)
+        else:
+            # Basically ANY or ALL the metadata can be written with the add() method.
+            pkg_item = portal.content.add({
+                    'title': pkgname.replace('_', ' '),
+                },
+                data=pkgfile, # Absolute path or URL
+                folder="Basemaps"
+            )
     except Exception as e:
         print("Upload did not work for %s!" % pkgname, e)
         return None
+    pc.forget(pkg_item)
 
     thumbnail = PACKAGE_THUMBNAIL
     outname = os.path.join(Config.SCRATCH_WORKSPACE, 'package_thumbnail.png')
@@ -213,10 +190,13 @@ def stage_tile_service(portal, pkg_item, pkgname, description, overwrite=True):
             })
         # I really want this set NOW!
         lyr_item.update(item_properties={"title": lyr_title})
+        pc.forget(lyr_item)
         #print("service item", lyr_item)
 
     except Exception as e:
         print("Staging failed!", e)
+        # Publish might have left something behind, so ask Portal again.
+        pc.forget(title=lyr_title, name=lyr_name)
         # "Service name 'Vector_Tiles' already exists for '0123456789'"
         items = pc.findItems(name=lyr_name) 
         PortalContent.show(items)
@@ -249,6 +229,16 @@ def stage_tile_service(portal, pkg_item, pkgname, description, overwrite=True):
 
     return lyr_item
 
+
+def publish_package(gis, item: dict, staging_groups: list) -> dict:
+    """
+    Upload a package that was just built and stage it as a service, see tile_packages.upload_and_stage.
+    Returns how long each step took, or None if there was nothing to do.
+    """
+    return upload_and_stage(gis, item, staging_groups,
+        lambda gis, item: upload_tile_package(gis, item["pkgname"], item["pkgfile"], item["description"], overwrite=True),
+        lambda gis, pkg_item, item: stage_tile_service(gis, pkg_item, item["pkgname"], item["description"], overwrite=True))
+
 # ==========================================================================
 
 if __name__ == "__main__":
@@ -309,7 +299,7 @@ if __name__ == "__main__":
 
         ]
 
-    gis = GIS(Config.PORTAL_URL, Config.PORTAL_USER, Config.PORTAL_PASSWORD)
+    gis = get_session().gis
     print(f"Logged in to {Config.PORTAL_URL} as {str(gis.properties.user.username)}.")
     pc = PortalContent(gis)
 
@@ -318,14 +308,16 @@ if __name__ == "__main__":
 
     progress = 0
     total = len(mapnames)
+    jobs = []
     for item in mapnames:
         mapname = item["mapname"]
         progress += 1
 
         item["pkgname"] = mapname.replace(' ', '_')
+        item['pkgfile'] = ''
         pkgname = item["pkgname"]
 
-        if item['ignore'] : 
+        if item.get('ignore'):
             print(f"{progress}/{total} Skipping \"{mapname}\". \"ignore\" option is set.")
             continue
         print(f"{progress}/{total} \"{mapname}\" => \"{pkgname}\".")
@@ -334,39 +326,48 @@ if __name__ == "__main__":
         if not map:
             print("    ERROR! Map not found in APRX. Skipping \"%s\"." % mapname)
             continue
-
-        print("    Building package.")
-        try:
-            # When debugging the publish step you can change overwrite to False
-            # so you don't have to wait each iteration for the package build step.
-            # Don't forget to change it back!!!
-            item["pkgfile"] = build_tile_package(map, pkgname, 
-                                                 min_zoom=item["min_zoom"], 
-                                                 overwrite=True)
-        except Exception as e:
-            print("   Could not generate tiles.", e)
-            if e.args[0].startswith("ERROR 001117"):
-                print("   ERROR. You need to open the APRX file in ArcGIS Pro and put a description in \"%s\"." % mapname)
-            item['pkgfile'] = ''
-            print("   Skipping \"%s\"." % mapname)
-            continue
-
-        print("    Uploading tile package to server.")
-        pkg_item = upload_tile_package(gis, pkgname, item['pkgfile'], item["description"], overwrite=True)
-        if not pkg_item: continue
-        # NB if you don't set "allow_members_to_edit" True then groups=groups will fail.
-        res = pkg_item.share(everyone=False, org=False, groups=staging_groups, allow_members_to_edit=True)
-
-        print("    Staging service.")
-        lyr_item = stage_tile_service(gis, pkg_item, pkgname, item["description"], overwrite=True)
-        if not lyr_item: 
-            print("   Service could not be staged.")
-            continue
-
-        # NB if you don't set "allow_members_to_edit" True then groups=groups will fail.
-        res = lyr_item.share(everyone=False, org=False, groups=staging_groups, allow_members_to_edit=True)
-        url = Config.PORTAL_URL + f"/home/item.html?id={lyr_item.id}"
-        print(f"Published at {lyr_item.homepage}")
-        print("")
+        item["map"] = map
+        jobs.append(item)
+
+    # How long each build takes depends on how many run at once, so this waits until we know.
+    if Config.ESTIMATE_BUILDS != 'off':
+        workers = build_workers(len(jobs))
+        for item in jobs:
+            try:
+                item["estimate"] = estimate_tiles.estimate(item["map"], item["min_zoom"], Config.MAX_ZOOM,
+                                                           workers, quick=Config.ESTIMATE_BUILDS == 'quick')
+                print("\"%s\" estimated %s" % (item["mapname"], estimate_tiles.summary(item["estimate"])))
+            except Exception as e:
+                print("Could not estimate \"%s\"." % item["mapname"], e)
+    for item in jobs:
+        # The map object can't go to another process.
+        del item["map"]
+
+    # The builds don't depend on each other, so they run side by side,
+    # and each package gets uploaded and staged while the others are still building.
+    # A package only gets rebuilt when its map or data changed,
+    # see tile_packages.py. Use force=True to rebuild them anyway.
+    total = len(jobs)
+    by_name = {item["pkgname"]: item for item in jobs}
+
+    def built():
+        progress = 0
+        for result in build_packages(Config.BASEMAP_APRX, jobs):
+            progress += 1
+            item = by_name[result["pkgname"]]
+            if result["error"]:
+                print(f"{progress}/{total} Could not generate tiles for \"{item['mapname']}\".", result["error"])
+                if result["error"].startswith("ERROR 001117"):
+                    print("   ERROR. You need to open the APRX file in ArcGIS Pro and put a description in \"%s\"." % item['mapname'])
+                print("   Skipping \"%s\"." % item['mapname'])
+            else:
+                item["pkgfile"] = result["pkgfile"]
+                print(f"{progress}/{total} Built \"{item['pkgfile']}\" in {result['seconds']:.0f}s.")
+            yield result
+
+    def publish(result) -> dict:
+        return publish_package(gis, by_name[result["pkgname"]], staging_groups)
+
+    pipeline(built(), publish)
 
     print("All done.")
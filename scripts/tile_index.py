@@ -0,0 +1,183 @@
+"""
+tile_index.py
+
+Makes the tile index for building vector tile packages with the INDEXED
+tile structure, so I don't have to run "Create Vector Tile Index" by hand.
+
+It's a quadtree. It starts with the tiles covering the data at the
+smallest cached level, and any tile with more than VERTEX_BUDGET vertices
+in it gets split into its 4 children, and so on down, until every tile
+is under the budget (or we get to the deepest level we allow). Town
+ends up cut into little tiles that each build in reasonable time, and
+the ocean and the woods stay a few big cheap ones.
+
+The vertices come from every feature class in the processed Basemap.gdb,
+in Web Mercator, and the splitting is done with numpy on the whole lot at
+once, so it takes seconds, not the minutes the Esri tool takes.
+
+The output is a polygon feature class with one polygon per tile and
+LEVEL, TILE_ROW, TILE_COL and VERTICES fields. Set TILE_INDEX in .env to
+it and build_tile_package uses it.
+
+    python tile_index.py [Basemap.gdb [output feature class]]
+    python tile_index.py test         runs the unit test, no arcpy needed
+"""
+import os, sys
+import time
+import numpy as np
+from config import Config
+import tiling
+
+# Esri's Create Vector Tile Index uses 10000 too.
+VERTEX_BUDGET = 10000
+
+
+def quadtree(x, y, extent, min_level: int, max_level: int, budget: int = VERTEX_BUDGET) -> tuple:
+    """
+    Split the tiles covering 'extent' at 'min_level' until each one has
+    no more than 'budget' of the vertices (x, y), or is at 'max_level'.
+    Returns arrays of the level, row, column and vertex count of each tile.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = 2 ** max_level
+    width = float(tiling.tile_widths(max_level))
+    rows = np.clip(np.floor((tiling.ORIGIN_Y - y) / width).astype(np.int64), 0, n - 1)
+    cols = np.clip(np.floor((x - tiling.ORIGIN_X) / width).astype(np.int64), 0, n - 1)
+    # One entry per tile at the deepest level, with its count, is a lot less to carry around.
+    (keys, counts) = np.unique(rows * n + cols, return_counts=True)
+    (rows, cols) = np.divmod(keys, n)
+
+    (r0, r1, c0, c1) = tiling.tile_range(extent, min_level)
+    (tile_rows, tile_cols) = (a.ravel() for a in np.mgrid[r0:r1 + 1, c0:c1 + 1])
+    found = []
+    for level in range(min_level, max_level + 1):
+        shift = max_level - level
+        m = 2 ** level
+        parents = (rows >> shift) * m + (cols >> shift)
+        (parent_keys, inverse) = np.unique(parents, return_inverse=True)
+        parent_counts = np.bincount(inverse, weights=counts).astype(np.int64)
+
+        tile_keys = tile_rows * m + tile_cols
+        where = np.clip(np.searchsorted(parent_keys, tile_keys), 0, max(len(parent_keys) - 1, 0))
+        if len(parent_keys):
+            vertices = np.where(parent_keys[where] == tile_keys, parent_counts[where], 0)
+        else:
+            vertices = np.zeros(len(tile_keys), dtype=np.int64)
+
+        split = vertices > budget if level < max_level else np.zeros(len(tile_keys), dtype=bool)
+        keep = ~split
+        found.append((np.full(keep.sum(), level), tile_rows[keep], tile_cols[keep], vertices[keep]))
+        if not split.any():
+            break
+
+        # The 4 children of each tile that was split, and only the vertices in them.
+        inside = np.isin(parents, tile_keys[split])
+        (rows, cols, counts) = (rows[inside], cols[inside], counts[inside])
+        tile_rows = (tile_rows[split][:, None] * 2 + np.array([0, 0, 1, 1])).ravel()
+        tile_cols = (tile_cols[split][:, None] * 2 + np.array([0, 1, 0, 1])).ravel()
+
+    return tuple(np.concatenate(a) for a in zip(*found))
+
+
+def read_vertices(workspace: str, skip: str = None) -> tuple:
+    """ Every vertex of every feature class in a geodatabase, in Web Mercator, as (x, y, extent). """
+    import arcpy # Here, so the quadtree can be tested without it.
+    web_mercator = arcpy.SpatialReference(3857)
+    saved = arcpy.env.workspace
+    arcpy.env.workspace = workspace
+    xs = []
+    ys = []
+    try:
+        featureclasses = list(arcpy.ListFeatureClasses() or [])
+        for dataset in arcpy.ListDatasets(feature_type='Feature') or []:
+            featureclasses += [os.path.join(dataset, fc) for fc in arcpy.ListFeatureClasses(feature_dataset=dataset) or []]
+        for fc in featureclasses:
+            if skip and os.path.basename(fc).lower() == os.path.basename(skip).lower():
+                continue
+            try:
+                a = arcpy.da.FeatureClassToNumPyArray(os.path.join(workspace, fc), ['SHAPE@X', 'SHAPE@Y'],
+                    explode_to_points=True, skip_nulls=True, spatial_reference=web_mercator)
+            except Exception as e:
+                print("Could not read \"%s\"." % fc, e)
+                continue
+            print("%s: %d vertices" % (fc, len(a)))
+            xs.append(a['SHAPE@X'])
+            ys.append(a['SHAPE@Y'])
+    finally:
+        arcpy.env.workspace = saved
+    if not xs:
+        raise Exception("There are no features in %s." % workspace)
+    x = np.concatenate(xs)
+    y = np.concatenate(ys)
+    return (x, y, (x.min(), y.min(), x.max(), y.max()))
+
+
+def write_index(tiles: tuple, output: str) -> str:
+    """ Write the tiles from quadtree() as polygons, replacing 'output' if it's there. """
+    import arcpy
+    web_mercator = arcpy.SpatialReference(3857)
+    if arcpy.Exists(output):
+        arcpy.management.Delete(output)
+    (path, name) = os.path.split(output)
+    arcpy.management.CreateFeatureclass(path, name, "POLYGON", spatial_reference=web_mercator)
+    for field in ('LEVEL', 'TILE_ROW', 'TILE_COL', 'VERTICES'):
+        arcpy.management.AddField(output, field, "LONG")
+
+    with arcpy.da.InsertCursor(output, ['SHAPE@', 'LEVEL', 'TILE_ROW', 'TILE_COL', 'VERTICES']) as cursor:
+        for (level, row, col, vertices) in zip(*(a.tolist() for a in tiles)):
+            (xmin, ymin, xmax, ymax) = tiling.tile_extent(level, row, col)
+            ring = arcpy.Array([arcpy.Point(xmin, ymin), arcpy.Point(xmin, ymax),
+                                arcpy.Point(xmax, ymax), arcpy.Point(xmax, ymin), arcpy.Point(xmin, ymin)])
+            cursor.insertRow([arcpy.Polygon(ring, web_mercator), level, row, col, vertices])
+    return output
+
+
+def make_index(workspace: str, output: str, budget: int = VERTEX_BUDGET,
+               min_scale: float = Config.MIN_COUNTY_ZOOM, max_level: int = Config.TILE_INDEX_MAX_LEVEL) -> str:
+    """ Read the data in 'workspace' and write its tile index to 'output'. """
+    t0 = time.perf_counter()
+    (x, y, extent) = read_vertices(workspace, skip=output)
+    min_level = tiling.scale_to_lod(min_scale, tiling.VECTOR_TILE_SIZE)
+    tiles = quadtree(x, y, extent, min_level, max(min_level, max_level), budget)
+    write_index(tiles, output)
+    show(tiles)
+    print("Wrote %d tiles to %s in %.1fs" % (len(tiles[0]), output, time.perf_counter() - t0))
+    return output
+
+
+def show(tiles: tuple) -> None:
+    (levels, rows, cols, vertices) = tiles
+    print("%5s %8s %12s %12s" % ("level", "tiles", "vertices", "most/tile"))
+    for level in np.unique(levels):
+        v = vertices[levels == level]
+        print("%5d %8d %12d %12d" % (level, len(v), v.sum(), v.max()))
+    return
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'test':
+        # A town of 200000 vertices in one corner of a county of sparse roads.
+        rng = np.random.default_rng(1)
+        county = (-13830000, 5720000, -13730000, 5860000)
+        x = np.concatenate([rng.uniform(county[0], county[2], 50000), rng.normal(-13790000, 1500, 200000)])
+        y = np.concatenate([rng.uniform(county[1], county[3], 50000), rng.normal(5830000, 1500, 200000)])
+        t0 = time.perf_counter()
+        tiles = quadtree(x, y, county, 8, 16, budget=10000)
+        print("Split in %.3fs" % (time.perf_counter() - t0))
+        show(tiles)
+        (levels, rows, cols, vertices) = tiles
+        # Every vertex is in exactly one tile, and the tiles cover the county without overlapping.
+        assert vertices.sum() == len(x)
+        assert ((vertices <= 10000) | (levels == 16)).all()
+        top = tiling.count_tiles(county, 8)
+        assert np.isclose((0.25 ** (levels - 8)).sum(), top)
+        assert len(np.unique(levels)) > 2 and levels.min() >= 8
+        # Nothing to split, nothing changes.
+        assert len(quadtree(x[:10], y[:10], county, 8, 16)[0]) == top
+        print("Unit tests passed.")
+        exit(0)
+
+    workspace = os.path.abspath(sys.argv[1] if len(sys.argv) > 1 else "Basemap.gdb")
+    output = sys.argv[2] if len(sys.argv) > 2 else (Config.TILE_INDEX or os.path.join(workspace, "vector_tile_index"))
+    make_index(workspace, output)
@@ -0,0 +1,490 @@
+"""
+tile_packages.py
+
+Builds vector tile packages for the stage scripts.
+
+Building a package can take hours, so each package gets a "fingerprint"
+file saved next to it (Vector_Tiles.vtpk => Vector_Tiles.vtpk.fingerprint.json).
+The fingerprint covers everything that goes into the tiles:
+
+    * the map itself (its CIM JSON, exported as a MAPX),
+    * the min and max scales,
+    * each feature layer's data source, definition query,
+      row count, extent and a checksum of its rows.
+
+If the package is already there and the fingerprint still matches,
+build_tile_package reuses it instead of building it again, so you don't
+have to edit "overwrite" by hand when debugging the publish step any more.
+
+build_packages() builds several packages at the same time. Each build
+gets its own process (CreateVectorTilePackage mostly uses one core) and
+its own scratch folder; the number running at once is limited by the
+number of cores and by how much memory is free (see BUILD_WORKERS and
+BUILD_WORKER_MEMORY_GB in config.py).
+
+pipeline() uploads and publishes each package on a worker thread as soon
+as it is built, so the network is busy while the next build runs, and
+prints how long each stage took at the end.
+
+When a package gets rebuilt, the old one is kept as name.previous.vtpk and
+the two are compared tile by tile (see vtpk_diff.py); the change set is
+saved as name.vtpk.changes.json.
+
+When a package gets staged, name.vtpk.staged.json records its digest and
+the id of the STAGED service. The stage step compares the next package
+with that, not with the last build (which might never have made it to
+Portal), and only skips staging when the tiles are the same as what's
+staged and that service is still there. See staged_match().
+"""
+import os, sys
+import json
+import time
+import queue
+import shutil
+import threading
+import hashlib
+import zipfile
+import tempfile
+from datetime import datetime
+import arcpy
+from config import Config
+from portal import PortalContent
+import vtpk_diff
+import estimate_tiles
+import process_pool
+
+FINGERPRINT_EXT = '.fingerprint.json'
+CHANGES_EXT = '.changes.json'
+STAGED_EXT = '.staged.json'
+
+
+def _hash_rows(datasource: str, where: str = None) -> str:
+    """ Checksum every row (geometry and attributes) in a feature class. """
+    h = hashlib.sha256()
+    fields = [f.name for f in arcpy.ListFields(datasource)
+              if f.type not in ('Geometry', 'OID', 'Blob', 'Raster', 'GlobalID')]
+    # File geodatabase cursors come back in OBJECTID order.
+    with arcpy.da.SearchCursor(datasource, ['OID@', 'SHAPE@WKB'] + fields, where_clause=where) as cursor:
+        for row in cursor:
+            for value in row:
+                h.update(value if isinstance(value, (bytes, bytearray)) else repr(value).encode('utf-8'))
+    return h.hexdigest()
+
+
+def describe_sources(map) -> list:
+    """ What we know about each feature layer in the map, sorted so the order is stable. """
+    sources = []
+    for layer in map.listLayers():
+        if not layer.isFeatureLayer or not layer.supports('DATASOURCE'):
+            continue
+        datasource = layer.dataSource
+        where = layer.definitionQuery if layer.supports('DEFINITIONQUERY') else ''
+        try:
+            desc = arcpy.Describe(datasource)
+            e = desc.extent
+            sources.append({
+                'layer': layer.longName,
+                'datasource': datasource,
+                'definitionQuery': where,
+                'rows': int(arcpy.management.GetCount(layer)[0]),
+                'extent': [round(v, 3) for v in (e.XMin, e.YMin, e.XMax, e.YMax)],
+                'checksum': _hash_rows(datasource, where or None),
+            })
+        except Exception as e:
+            # Something we can't read will never match, so the package gets rebuilt.
+            print("    Can't fingerprint \"%s\"," % layer.longName, e)
+            sources.append({'layer': layer.longName, 'datasource': datasource,
+                            'error': str(e), 'time': datetime.now().isoformat()})
+    return sorted(sources, key=lambda s: (s['layer'], s['datasource']))
+
+
+def map_checksum(map) -> str:
+    """ Checksum of the map's CIM, which covers symbols, labels, layer order and so on. """
+    (fd, mapx) = tempfile.mkstemp(suffix='.mapx', dir=Config.SCRATCH_WORKSPACE)
+    os.close(fd)
+    try:
+        map.exportToMAPX(mapx)
+        with open(mapx, 'rb') as fp:
+            cim = json.load(fp)
+    finally:
+        os.unlink(mapx)
+    # The export stamps itself with a date and build number, those don't change the tiles.
+    for key in ('build', 'version', 'date'):
+        cim.pop(key, None)
+    return hashlib.sha256(json.dumps(cim, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def fingerprint(map, min_zoom: float, max_zoom: float, index_polygons: str = None) -> dict:
+    """ Everything that decides what is in the tiles, plus a digest of all of it. """
+    fp = {
+        'map': map.name,
+        'cim': map_checksum(map),
+        'min_zoom': min_zoom,
+        'max_zoom': max_zoom,
+        'sources': describe_sources(map),
+    }
+    if index_polygons:
+        fp['index'] = {'datasource': index_polygons, 'checksum': _hash_rows(index_polygons)}
+    fp['digest'] = hashlib.sha256(json.dumps(fp, sort_keys=True).encode('utf-8')).hexdigest()
+    return fp
+
+
+def read_fingerprint(pkgfile: str) -> dict:
+    try:
+        with open(pkgfile + FINGERPRINT_EXT) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def write_fingerprint(pkgfile: str, fp: dict) -> None:
+    fp = dict(fp, built=datetime.now().isoformat())
+    with open(pkgfile + FINGERPRINT_EXT, 'w') as f:
+        json.dump(fp, f, indent=2)
+    return
+
+
+def remove_fingerprint(pkgfile: str) -> None:
+    if os.path.exists(pkgfile + FINGERPRINT_EXT):
+        os.unlink(pkgfile + FINGERPRINT_EXT)
+    return
+
+
+def build_tile_package(map, pkgname, min_zoom = Config.MIN_COUNTY_ZOOM, overwrite=False, force=False, estimate=None,
+                       index_polygons=None, workers=1):
+    """ Build a tile package. Does not overwrite by default.
+
+    'map' is a map from an aprx
+    'pkgname' is the name of the package (will be the filename too)
+    'min_zoom' defaults to county level, you might choose tax level
+    'overwrite' True means rebuild an existing package if anything in the map
+        or its data has changed since it was built, False means always reuse it.
+    'force' True means rebuild even when the fingerprint matches.
+    'estimate' is from estimate_tiles.estimate(), it gets saved with the
+        build time in the build history so later estimates get better.
+    'index_polygons' is a tile index from tile_index.py, to build INDEXED
+        instead of FLAT. None means use Config.TILE_INDEX, '' means FLAT.
+    'workers' is how many builds are running at once, for the build history.
+
+    Returns absolute pathname of package if a package was built or None
+    (We need the path to be absolute when we do the "add" in staging.)
+    """
+    pkgfile = os.path.join(arcpy.env.workspace, pkgname + '.vtpk')
+    exists = arcpy.Exists(pkgfile) # BTW, this uses the workspace env
+    if exists and not overwrite:
+        print("Reusing existing file, %s" % pkgfile)
+        return pkgfile
+
+    if index_polygons is None:
+        index_polygons = Config.TILE_INDEX
+    if index_polygons and not arcpy.Exists(index_polygons):
+        print("WARNING! Tile index \"%s\" not found, building FLAT. Run tile_index.py to make it." % index_polygons)
+        index_polygons = None
+
+    current = fingerprint(map, min_zoom, Config.MAX_ZOOM, index_polygons)
+    if exists:
+        previous = read_fingerprint(pkgfile)
+        if not force and previous and previous.get('digest') == current['digest']:
+            print("Nothing has changed since %s, reusing %s" % (previous.get('built'), pkgfile))
+            return pkgfile
+        # Keep the old one around to compare with the new one.
+        os.replace(pkgfile, previous_package(pkgfile))
+    # If the build fails, don't leave a fingerprint that matches a half built package.
+    remove_fingerprint(pkgfile)
+    if os.path.exists(pkgfile + CHANGES_EXT):
+        os.unlink(pkgfile + CHANGES_EXT)
+
+    # I tried to add a description to the map object here but it did not work.
+    # If there is no description, the Esri tool fails. Sorry.
+
+    # Note, we'll update metadata later .
+    # BTW, that 99999 error you're getting could be a definition query problem.
+    # RTM https://pro.arcgis.com/en/pro-app/latest/tool-reference/data-management/create-vector-tile-package.htm
+
+    t0 = time.perf_counter()
+    arcpy.management.CreateVectorTilePackage(map, pkgfile,
+        service_type="ONLINE", tiling_scheme=None,
+        tile_structure="INDEXED" if index_polygons else "FLAT",
+        min_cached_scale=min_zoom, max_cached_scale=Config.MAX_ZOOM,
+        index_polygons=index_polygons or None
+    )
+    write_fingerprint(pkgfile, current)
+    try:
+        estimate_tiles.record_build(map.name, pkgfile, time.perf_counter() - t0, estimate,
+                                    workers=workers, min_scale=min_zoom, max_scale=Config.MAX_ZOOM)
+    except Exception as e:
+        print("Could not record the build time.", e)
+
+    previous = previous_package(pkgfile)
+    if os.path.exists(previous):
+        try:
+            changes = vtpk_diff.diff(previous, pkgfile)
+            vtpk_diff.save(changes, pkgfile + CHANGES_EXT)
+            print("%s: %d tiles added, %d removed, %d changed since the last build." % (
+                pkgname, changes['added'], changes['removed'], changes['changed']))
+        except Exception as e:
+            print("Could not compare %s with the last build." % pkgname, e)
+
+    return pkgfile
+
+
+def previous_package(pkgfile: str) -> str:
+    """ Vector_Tiles.vtpk => Vector_Tiles.previous.vtpk """
+    return os.path.splitext(pkgfile)[0] + '.previous.vtpk'
+
+
+def read_changes(pkgfile: str) -> dict:
+    """ How this package differs from the one built before it, or None if we don't know. """
+    return vtpk_diff.load(pkgfile + CHANGES_EXT)
+
+
+def write_staged(pkgfile: str, itemid: str) -> None:
+    """ Remember that the STAGED service 'itemid' was made from this package. """
+    try:
+        staged = {'digest': vtpk_diff.package_digest(pkgfile), 'itemid': itemid, 'staged': datetime.now().isoformat()}
+        with open(pkgfile + STAGED_EXT, 'w') as fp:
+            json.dump(staged, fp, indent=2)
+    except Exception as e:
+        print("Could not record what was staged from %s." % pkgfile, e)
+    return
+
+
+def staged_match(pkgfile: str) -> dict:
+    """
+    If the last package that got staged has the same tiles as this one,
+    return its record from write_staged, else None. Same tiles means the
+    same digest, or a change set from this build saying nothing changed
+    since a build with the staged digest. The caller still has to check
+    that the service in the record is the one that's staged now.
+    """
+    try:
+        with open(pkgfile + STAGED_EXT) as fp:
+            staged = json.load(fp)
+        digest = vtpk_diff.package_digest(pkgfile)
+    except (OSError, ValueError, zipfile.BadZipFile):
+        return None
+    if staged.get('digest') == digest:
+        return staged
+    changes = read_changes(pkgfile)
+    # The change set is left over from an older build if its "new" isn't this package.
+    if (changes and not changes['republish'] and changes.get('new_digest') == digest
+            and changes.get('old_digest') == staged.get('digest')):
+        return staged
+    return None
+
+
+def upload_and_stage(gis, item: dict, staging_groups: list, upload, stage) -> dict:
+    """
+    Upload a package that was just built and stage it as a service,
+    sharing both with the staging groups. Both stage scripts use this.
+
+    'item' has "pkgname", "pkgfile" and "description".
+    'upload' is called with (gis, item) and returns the package item,
+    'stage' with (gis, pkg_item, item) and returns the service item.
+        Those are each script's own, the thumbnails and snippets differ.
+    Returns how long each step took, or None if there was nothing to do.
+    """
+    pkgname = item["pkgname"]
+
+    # If the STAGED service was made from a package with these same tiles, we're done.
+    staged = staged_match(item["pkgfile"])
+    if staged:
+        lyr_title = (pkgname + ' STAGED').replace('_', ' ')
+        lyr_item = PortalContent(gis).findItem(title=lyr_title, type=PortalContent.VectorTileService)
+        if lyr_item and lyr_item.id == staged['itemid']:
+            print("    \"%s\" was staged %s from the same tiles, skipping." % (lyr_title, staged['staged']))
+            return None
+
+    t0 = time.perf_counter()
+    print(f"    Uploading tile package \"{pkgname}\" to server.")
+    pkg_item = upload(gis, item)
+    if not pkg_item:
+        raise Exception("Upload failed.")
+    # NB if you don't set "allow_members_to_edit" True then groups=groups will fail.
+    res = pkg_item.share(everyone=False, org=False, groups=staging_groups, allow_members_to_edit=True)
+
+    t1 = time.perf_counter()
+    print(f"    Staging service \"{pkgname}\".")
+    lyr_item = stage(gis, pkg_item, item)
+    if not lyr_item:
+        raise Exception("Service could not be staged.")
+
+    # NB if you don't set "allow_members_to_edit" True then groups=groups will fail.
+    res = lyr_item.share(everyone=False, org=False, groups=staging_groups, allow_members_to_edit=True)
+    write_staged(item["pkgfile"], lyr_item.id)
+    print(f"    Published at {lyr_item.homepage}")
+    return {'upload': t1 - t0, 'stage': time.perf_counter() - t1}
+
+
+def available_memory() -> int:
+    """ Bytes of physical memory free right now, or None if we can't tell. """
+    if sys.platform == 'win32':
+        import ctypes
+        class MEMORYSTATUSEX(ctypes.Structure):
+            _fields_ = [('dwLength', ctypes.c_ulong), ('dwMemoryLoad', ctypes.c_ulong),
+                        ('ullTotalPhys', ctypes.c_ulonglong), ('ullAvailPhys', ctypes.c_ulonglong),
+                        ('ullTotalPageFile', ctypes.c_ulonglong), ('ullAvailPageFile', ctypes.c_ulonglong),
+                        ('ullTotalVirtual', ctypes.c_ulonglong), ('ullAvailVirtual', ctypes.c_ulonglong),
+                        ('ullAvailExtendedVirtual', ctypes.c_ulonglong)]
+        status = MEMORYSTATUSEX()
+        status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.ullAvailPhys
+        return None
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def build_workers(jobs: int, max_workers: int = Config.BUILD_WORKERS) -> int:
+    """ How many builds to run at once, given the cores and memory on this machine. """
+    workers = min(jobs, os.cpu_count() or 1)
+    if max_workers:
+        workers = min(workers, max_workers)
+    free = available_memory()
+    if free is not None:
+        workers = min(workers, int(free // (Config.BUILD_WORKER_MEMORY_GB * 1024**3)))
+    return max(workers, 1)
+
+
+def _build_worker(aprx_path: str, mapname: str, pkgname: str, min_zoom: float, outdir: str, force: bool,
+                  estimate: dict = None, index_polygons: str = None, workers: int = 1) -> dict:
+    """ Runs in its own process: open the project, find the map, build its package. """
+    # Give each build its own scratch space, the geoprocessing tools write temp files.
+    scratch = os.path.join(outdir, 'build_' + pkgname)
+    os.makedirs(scratch, exist_ok=True)
+    os.environ['TEMP'] = os.environ['TMP'] = scratch
+    arcpy.env.scratchWorkspace = scratch
+    arcpy.env.workspace = outdir
+
+    t0 = time.perf_counter()
+    result = {'pkgname': pkgname, 'pkgfile': None, 'error': None}
+    try:
+        with process_pool.caught(result):
+            maps = arcpy.mp.ArcGISProject(aprx_path).listMaps(mapname)
+            if len(maps) != 1:
+                raise Exception("Map \"%s\" not found in %s." % (mapname, aprx_path))
+            result['pkgfile'] = build_tile_package(maps[0], pkgname, min_zoom=min_zoom, overwrite=True,
+                                                    force=force, estimate=estimate, index_polygons=index_polygons,
+                                                    workers=workers)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    result['seconds'] = time.perf_counter() - t0
+    return result
+
+
+def build_packages(aprx_path: str, jobs: list, max_workers: int = Config.BUILD_WORKERS, force: bool = False):
+    """
+    Build several tile packages at once, each in its own process.
+
+    'jobs' is a list of dicts with "mapname", "pkgname" and "min_zoom",
+    and optionally an "estimate" from estimate_tiles and "index_polygons"
+    (see build_tile_package).
+    The packages are written to arcpy.env.workspace.
+
+    Yields a dict for each job as it finishes, with "pkgname",
+    "pkgfile" (None if it failed), "error" and "seconds".
+    """
+    if not jobs:
+        return
+    outdir = arcpy.env.workspace
+    workers = build_workers(len(jobs), max_workers)
+    print("Building %d packages, %d at a time." % (len(jobs), workers))
+
+    with process_pool.pool(workers) as executor:
+        futures = {
+            executor.submit(_build_worker, os.path.abspath(aprx_path), job['mapname'], job['pkgname'],
+                            job['min_zoom'], outdir, force,
+                            job.get('estimate'), job.get('index_polygons'), workers): job
+            for job in jobs
+        }
+        for (job, result, died) in process_pool.completed(futures):
+            yield result or {'pkgname': job['pkgname'], 'pkgfile': None, 'error': died, 'seconds': 0}
+    return
+
+
+def pipeline(builds, publish, maxsize: int = Config.PIPELINE_QUEUE_SIZE) -> list:
+    """
+    Publish packages while the next ones are still being built.
+
+    'builds' yields build results, like build_packages does.
+    'publish' is called with each successful result on a worker thread.
+        It can return a dict of {stage: seconds} to show in the report.
+    'maxsize' is how many finished packages can wait for the worker
+        before the builds have to wait for it.
+
+    Returns a list of dicts, one per package, with "pkgname", "error"
+    and the seconds spent in each stage ("build", "queued", "publish" ...).
+    """
+    q = queue.Queue(maxsize=maxsize)
+    rows = []
+
+    def worker():
+        while True:
+            (result, queued_at) = q.get()
+            if result is None:
+                break
+            row = result['row']
+            row['queued'] = time.perf_counter() - queued_at
+            t0 = time.perf_counter()
+            try:
+                stages = publish(result)
+                if stages:
+                    row.update(stages)
+            except Exception as e:
+                print("Could not publish \"%s\"." % result['pkgname'], e)
+                row['error'] = str(e)
+            row['publish'] = time.perf_counter() - t0
+        return
+
+    t_start = time.perf_counter()
+    thread = threading.Thread(target=worker, name='publish')
+    thread.start()
+    try:
+        for result in builds:
+            row = {'pkgname': result['pkgname'], 'error': result.get('error'), 'build': result.get('seconds', 0)}
+            rows.append(row)
+            if result.get('error') or not result.get('pkgfile'):
+                continue
+            q.put((dict(result, row=row), time.perf_counter()))
+    finally:
+        q.put((None, None))
+        thread.join()
+    show_timings(rows, time.perf_counter() - t_start)
+    return rows
+
+
+def show_timings(rows: list, wall: float) -> None:
+    """ Print the seconds for each stage of each package. """
+    stages = ['build', 'queued']
+    for row in rows:
+        stages += [k for k in row if k not in stages and k not in ('pkgname', 'error', 'publish')]
+    stages.append('publish')
+
+    print()
+    print("%-28s" % "package" + "".join("%10s" % stage for stage in stages) + "  status")
+    for row in rows:
+        print("%-28s" % row['pkgname'][:28]
+              + "".join("%10.1f" % row[stage] if stage in row else "%10s" % "-" for stage in stages)
+              + "  " + ("FAILED" if row.get('error') else "ok"))
+    busy = sum(row.get('build', 0) + row.get('publish', 0) for row in rows)
+    print("Total %.1fs, %.1fs of building and publishing." % (wall, busy))
+    return
+
+
+if __name__ == "__main__":
+    # Show the fingerprint for each vector tile map and whether its package is up to date.
+    arcpy.env.workspace = Config.SCRATCH_WORKSPACE
+    aprx = arcpy.mp.ArcGISProject(Config.BASEMAP_APRX)
+    for mapname in (Config.COMBINED_MAP, Config.LABEL_MAP, Config.FEATURE_MAP):
+        maps = aprx.listMaps(mapname)
+        if len(maps) != 1:
+            print("Map \"%s\" not found." % mapname)
+            continue
+        current = fingerprint(maps[0], Config.MIN_COUNTY_ZOOM, Config.MAX_ZOOM)
+        pkgfile = os.path.join(arcpy.env.workspace, mapname.replace(' ', '_') + '.vtpk')
+        previous = read_fingerprint(pkgfile)
+        state = 'up to date' if previous and previous['digest'] == current['digest'] else 'needs a rebuild'
+        print("%s %s, %d sources, %s" % (mapname, current['digest'][:12], len(current['sources']), state))
@@ -0,0 +1,309 @@
+"""
+tiling.py
+
+Arithmetic for the ArcGIS Online / Google / Bing Web Mercator tiling scheme,
+the one all our services use.
+
+    LOD 0 is the whole world in one tile. Each LOD after that halves the
+    resolution, so there are 2**lod rows and 2**lod columns of tiles.
+    Raster tiles are 256 pixels, at 96 dpi. Vector tiles are 512 pixels,
+    so vector LOD n has the same tiles on the ground as raster LOD n but
+    gets drawn at the scale of raster LOD n + 1, which is why root.json in
+    a .vtpk is numbered one less than the scales in config.py. Pass
+    tile_size=VECTOR_TILE_SIZE when you're going from scales to vector LODs.
+
+Scales <-> LODs <-> resolutions, and which tiles cover an extent or a
+polygon at each LOD. The tile math is done with numpy on whole arrays, so
+counting the tiles for the county takes milliseconds up to about LOD 17.
+After that the time doubles with each LOD, since it goes by rows of tiles,
+so the deepest LODs are most of it when you count range(9, 24).
+
+    import tiling
+    tiling.scale_to_lod(Config.MIN_COUNTY_ZOOM)        # 9
+    tiling.count_tiles(extent, range(9, 24))           # tiles per LOD in a box
+    tiling.count_polygon_tiles(rings, range(9, 24))    # tiles per LOD touching a polygon
+    rows, cols = tiling.polygon_tiles(rings, 16)       # the actual tiles
+
+Extents are (xmin, ymin, xmax, ymax) and polygons are lists of rings of
+(x, y) points, all in Web Mercator (EPSG:3857) meters. Holes work
+(it's even-odd, so a ring inside another is a hole).
+"""
+import numpy as np
+
+# Half the width of the world in Web Mercator, the tiles start at the top left corner.
+ORIGIN_SHIFT = 20037508.342787
+ORIGIN_X = -ORIGIN_SHIFT
+ORIGIN_Y = ORIGIN_SHIFT
+
+DPI = 96
+# Esri's scales come from 39.37 inches per meter (the US survey foot), not 1/0.0254.
+METERS_PER_INCH = 1 / 39.37
+
+RASTER_TILE_SIZE = 256
+VECTOR_TILE_SIZE = 512
+
+# The scale at raster LOD 0, what Esri publishes as 591657527.591555
+LOD0_SCALE = 2 * ORIGIN_SHIFT / RASTER_TILE_SIZE * DPI / METERS_PER_INCH
+
+MAX_LOD = 24
+
+
+def lod_resolutions(lods, tile_size: int = RASTER_TILE_SIZE) -> np.ndarray:
+    """ Meters per pixel at each LOD. """
+    return 2 * ORIGIN_SHIFT / (tile_size * np.exp2(np.asarray(lods, dtype=float)))
+
+
+def lod_scales(lods, tile_size: int = RASTER_TILE_SIZE) -> np.ndarray:
+    """ Scale denominators at each LOD, e.g. 1155581.108577 at LOD 9. """
+    return lod_resolutions(lods, tile_size) * DPI / METERS_PER_INCH
+
+
+def tile_widths(lods) -> np.ndarray:
+    """
+    How many meters wide (and high) a tile is at each LOD. This is the same
+    for raster and vector tiles, only the pixels in a tile are different.
+    """
+    return 2 * ORIGIN_SHIFT / np.exp2(np.asarray(lods, dtype=float))
+
+
+def scale_to_lod(scales, tile_size: int = RASTER_TILE_SIZE):
+    """ The nearest LOD to each scale. Takes a number or an array, returns the same. """
+    lods = np.rint(np.log2(lod_scales(0, tile_size) / np.asarray(scales, dtype=float))).astype(int)
+    lods = np.clip(lods, 0, MAX_LOD)
+    return int(lods) if lods.ndim == 0 else lods
+
+
+def lod_range(min_scale: float, max_scale: float, tile_size: int = RASTER_TILE_SIZE) -> range:
+    """
+    The LODs from a small scale (zoomed out, like Config.MIN_COUNTY_ZOOM)
+    to a large one (zoomed in, like Config.MAX_ZOOM), inclusive.
+    """
+    return range(scale_to_lod(min_scale, tile_size), scale_to_lod(max_scale, tile_size) + 1)
+
+
+def tile_range(extent, lods) -> np.ndarray:
+    """
+    The rows and columns of the tiles that cover 'extent' at each LOD,
+    as an array of (first row, last row, first column, last column), one row per LOD.
+    """
+    (xmin, ymin, xmax, ymax) = extent
+    lods = np.asarray(lods, dtype=int)
+    width = tile_widths(lods)
+    last = np.exp2(lods).astype(np.int64) - 1
+    ranges = np.stack([
+        np.floor((ORIGIN_Y - ymax) / width),
+        np.floor((ORIGIN_Y - ymin) / width - 1e-9),
+        np.floor((xmin - ORIGIN_X) / width),
+        np.floor((xmax - ORIGIN_X) / width - 1e-9),
+    ], axis=-1).astype(np.int64)
+    return np.clip(ranges, 0, last[..., None])
+
+
+def count_tiles(extent, lods) -> np.ndarray:
+    """ How many tiles cover 'extent' at each LOD. """
+    r = tile_range(extent, lods)
+    return (r[..., 1] - r[..., 0] + 1) * (r[..., 3] - r[..., 2] + 1)
+
+
+def tile_extent(lod: int, row: int, col: int) -> tuple:
+    """ (xmin, ymin, xmax, ymax) of one tile. """
+    width = float(tile_widths(lod))
+    return (ORIGIN_X + col * width, ORIGIN_Y - (row + 1) * width,
+            ORIGIN_X + (col + 1) * width, ORIGIN_Y - row * width)
+
+
+def rings_extent(rings) -> tuple:
+    points = np.concatenate([np.asarray(r, dtype=float) for r in rings])
+    return (points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max())
+
+
+def rings_from_geometry(geometry) -> list:
+    """ The rings of an arcpy Polygon (or anything with .rings like an arcgis geometry). """
+    if hasattr(geometry, 'rings'):
+        return geometry.rings
+    rings = []
+    for part in geometry:
+        ring = []
+        for point in part:
+            if point is None:
+                # arcpy puts a None between the outside of a part and its holes.
+                if ring:
+                    rings.append(ring)
+                ring = []
+            else:
+                ring.append((point.X, point.Y))
+        if ring:
+            rings.append(ring)
+    return rings
+
+
+def ring_edges(rings, closed: bool = True) -> np.ndarray:
+    """
+    All the edges of all the rings as an (n, 4) array of x1, y1, x2, y2.
+    Use closed=False for the paths of a line.
+    """
+    edges = []
+    for ring in rings:
+        r = np.asarray(ring, dtype=float)
+        if len(r) < 2:
+            continue
+        if closed and not np.array_equal(r[0], r[-1]):
+            r = np.vstack([r, r[:1]])
+        edges.append(np.hstack([r[:-1], r[1:]]))
+    return np.vstack(edges) if edges else np.zeros((0, 4))
+
+
+def _row_spans(edges: np.ndarray, lod: int, chunk: int = 512):
+    """
+    The tiles whose centers are inside the polygon, one row at a time.
+    Yields (row, first columns, last columns) for each row with any.
+    This is a scanline fill: cross each row's center line with every edge,
+    sort the crossings, and every other gap between them is inside.
+    """
+    width = float(tile_widths(lod))
+    last = 2 ** lod - 1
+    (x1, y1, x2, y2) = edges.T
+    (r0, r1) = (int(np.floor((ORIGIN_Y - edges[:, [1, 3]].max()) / width)),
+                int(np.floor((ORIGIN_Y - edges[:, [1, 3]].min()) / width)))
+    r0 = max(r0, 0)
+    r1 = min(r1, last)
+    for start in range(r0, r1 + 1, chunk):
+        rows = np.arange(start, min(start + chunk, r1 + 1))
+        yc = (ORIGIN_Y - (rows + 0.5) * width)[:, None]
+        crosses = (y1 <= yc) != (y2 <= yc)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x = np.where(crosses, x1 + (yc - y1) * (x2 - x1) / (y2 - y1), np.inf)
+        x.sort(axis=1)
+        counts = crosses.sum(axis=1)
+        for (i, row) in enumerate(rows):
+            n = counts[i]
+            if n < 2:
+                continue
+            xs = x[i, :n - n % 2]
+            first = np.ceil((xs[0::2] - ORIGIN_X) / width - 0.5).astype(np.int64)
+            final = np.floor((xs[1::2] - ORIGIN_X) / width - 0.5).astype(np.int64)
+            keep = final >= first
+            if keep.any():
+                yield (int(row), np.clip(first[keep], 0, last), np.clip(final[keep], 0, last))
+    return
+
+
+def edge_tiles(edges: np.ndarray, lod: int) -> tuple:
+    """
+    The tiles the rings pass through, as (rows, cols) with no repeats.
+    Each edge gets sampled at a quarter of a tile, so the only tiles that can
+    be missed are ones an edge barely clips the corner of.
+    """
+    width = float(tile_widths(lod))
+    (x1, y1, x2, y2) = edges.T
+    length = np.hypot(x2 - x1, y2 - y1)
+    steps = np.maximum(np.ceil(length / (width / 4)).astype(np.int64), 1)
+    edge = np.repeat(np.arange(len(edges)), steps + 1)
+    # t goes 0..1 along each edge
+    offsets = np.arange(len(edge)) - np.repeat(np.cumsum(steps + 1) - (steps + 1), steps + 1)
+    t = offsets / steps[edge]
+    x = x1[edge] + t * (x2 - x1)[edge]
+    y = y1[edge] + t * (y2 - y1)[edge]
+    last = 2 ** lod - 1
+    rows = np.clip(np.floor((ORIGIN_Y - y) / width).astype(np.int64), 0, last)
+    cols = np.clip(np.floor((x - ORIGIN_X) / width).astype(np.int64), 0, last)
+    keys = np.unique(rows * (last + 1) + cols)
+    return (keys // (last + 1), keys % (last + 1))
+
+
+def polygon_tiles(rings, lod: int) -> tuple:
+    """
+    The tiles that touch a polygon at one LOD, as arrays (rows, cols), sorted by row then column.
+    Be careful with big areas at high LODs, use count_polygon_tiles if you only need how many.
+    """
+    edges = ring_edges(rings)
+    if not len(edges):
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    n = 2 ** lod
+    keys = [np.concatenate([row * n + np.arange(a, b + 1) for (a, b) in zip(first, final)])
+            for (row, first, final) in _row_spans(edges, lod)]
+    (brows, bcols) = edge_tiles(edges, lod)
+    keys.append(brows * n + bcols)
+    keys = np.unique(np.concatenate(keys))
+    return (keys // n, keys % n)
+
+
+def count_polygon_tiles(rings, lods) -> np.ndarray:
+    """
+    How many tiles touch a polygon at each LOD. This counts the inside of each
+    row as spans instead of listing the tiles, so it's fast even at LOD 23.
+    """
+    edges = ring_edges(rings)
+    counts = []
+    for lod in lods:
+        if not len(edges):
+            counts.append(0)
+            continue
+        spans = {row: (first, final) for (row, first, final) in _row_spans(edges, lod)}
+        total = sum(int((final - first + 1).sum()) for (first, final) in spans.values())
+        # Add the boundary tiles that aren't already inside a span.
+        (brows, bcols) = edge_tiles(edges, lod)
+        # They come back sorted by row, so each row's tiles are one slice.
+        outside = len(brows)
+        (rows, starts) = np.unique(brows, return_index=True)
+        ends = np.append(starts[1:], len(brows))
+        for (row, a, b) in zip(rows.tolist(), starts, ends):
+            if row not in spans:
+                continue
+            (first, final) = spans[row]
+            cols = bcols[a:b]
+            i = np.searchsorted(first, cols, side='right') - 1
+            inside = (i >= 0) & (cols <= final[np.maximum(i, 0)])
+            outside -= int(inside.sum())
+        counts.append(total + outside)
+    return np.array(counts, dtype=np.int64)
+
+
+def cache_size(counts, bytes_per_tile) -> np.ndarray:
+    """ Bytes for a cache with 'counts' tiles per LOD at 'bytes_per_tile' (one number or one per LOD). """
+    return np.asarray(counts, dtype=float) * np.asarray(bytes_per_tile, dtype=float)
+
+
+if __name__ == "__main__":
+    import time
+    from config import Config
+
+    # The scales in config.py are the Esri ones.
+    assert scale_to_lod(Config.MIN_COUNTY_ZOOM) == 9
+    assert scale_to_lod(Config.MIN_TAXLOT_ZOOM) == 12
+    assert scale_to_lod(Config.MAX_ZOOM) == 23
+    assert abs(lod_scales(9) - 1155581.108577) < 1e-3
+    assert abs(LOD0_SCALE - 591657527.591555) < 1e-3
+    assert scale_to_lod(Config.MIN_COUNTY_ZOOM, VECTOR_TILE_SIZE) == 8
+    assert list(lod_range(Config.MIN_COUNTY_ZOOM, Config.MAX_ZOOM)) == list(range(9, 24))
+
+    # One tile at LOD 0 covers the world, 4 at LOD 1.
+    world = (-ORIGIN_SHIFT, -ORIGIN_SHIFT, ORIGIN_SHIFT, ORIGIN_SHIFT)
+    assert list(count_tiles(world, [0, 1, 2])) == [1, 4, 16]
+
+    # A square that lines up exactly with tiles at LOD 10.
+    (x0, y0, x1, y1) = tile_extent(10, 300, 200)
+    (x2, y2, x3, y3) = tile_extent(10, 303, 203)
+    square = [[(x0, y3), (x3, y3), (x3, y1), (x0, y1), (x0, y3)]]
+    # Rings touching the tile edges also pull in the neighbors, that's OK for a cover.
+    (rows, cols) = polygon_tiles(square, 10)
+    assert ((rows >= 299) & (rows <= 304)).all() and len(rows) >= 16
+
+    # Roughly Clatsop County, in Web Mercator.
+    county = [[(-13804000, 5720000), (-13730000, 5720000), (-13730000, 5840000),
+               (-13780000, 5860000), (-13830000, 5830000), (-13804000, 5720000)]]
+    hole = [(-13790000, 5770000), (-13770000, 5770000), (-13770000, 5790000), (-13790000, 5770000)]
+    lods = range(9, 24)
+    t0 = time.perf_counter()
+    counts = count_polygon_tiles(county + [hole], lods)
+    seconds = time.perf_counter() - t0
+    boxes = count_tiles(rings_extent(county), lods)
+    for (lod, n, b) in zip(lods, counts, boxes):
+        print("LOD %2d  scale %14.2f  %12d tiles (%d in the box)" % (lod, lod_scales(lod), n, b))
+    print("Counted in %.3fs" % seconds)
+
+    # The fast count has to agree with listing the tiles.
+    for lod in (9, 12, 15):
+        assert counts[lod - 9] == len(polygon_tiles(county + [hole], lod)[0]), lod
+    assert (counts <= boxes).all()
+    print("Unit tests passed.")
@@ -0,0 +1,276 @@
+"""
+vtpk.py
+
+Looks inside a vector tile package (.vtpk) without publishing it,
+and without unzipping it to disk either.
+
+A .vtpk is a zip file. The parts we care about are
+
+    p12/root.json                    the tiling scheme (levels and scales)
+    p12/tile/L05/R0000C0000.bundle   the tiles, 128 x 128 of them per bundle
+    p12/resources/styles/root.json   the style
+
+The bundles are "compact cache V2": a 64 byte header, then an index of
+128*128 8-byte entries (offset in the low 40 bits, size in the high 24),
+then the tiles, each one a gzipped protobuf with its size in front of it.
+
+    python vtpk.py Vector_Tiles.vtpk [report.json]
+    python vtpk.py old_report.json new_report.json
+
+The first form prints, for each level, how many tiles there are, how many
+bytes they take, the biggest tiles and how well they compress, and flags
+levels between Config.MIN_COUNTY_ZOOM and Config.MAX_ZOOM that take up
+an outsized share of the package. Give it a second filename to save the
+report as JSON. The second form compares two saved reports.
+"""
+import os, sys
+import re
+import json
+import gzip
+import heapq
+import struct
+import zipfile
+from config import Config
+
+# Tiles on each side of a bundle.
+BUNDLE_DIM = 128
+HEADER_SIZE = 64
+INDEX_SIZE = BUNDLE_DIM * BUNDLE_DIM * 8
+
+# A level between MIN_COUNTY_ZOOM and MAX_ZOOM with more than this
+# share of the tile bytes gets flagged.
+DOMINANT_SHARE = 0.25
+
+BUNDLE_RE = re.compile(r'(?:^|/)tile/L(\d+)/R([0-9a-fA-F]+)C([0-9a-fA-F]+)\.bundle$')
+
+
+def bundle_name(level: int, row: int, col: int) -> str:
+    """ The name in the zip of the bundle holding tile (level, row, col). """
+    row0 = row - row % BUNDLE_DIM
+    col0 = col - col % BUNDLE_DIM
+    return 'p12/tile/L%02d/R%04xC%04x.bundle' % (level, row0, col0)
+
+
+def parse_bundle_name(name: str) -> tuple:
+    """ Returns (level, first row, first column) or None if it's not a bundle. """
+    m = BUNDLE_RE.search(name)
+    if not m:
+        return None
+    return (int(m.group(1)), int(m.group(2), 16), int(m.group(3), 16))
+
+
+def read_index(fp) -> list:
+    """
+    Read a bundle's index. Returns a list of (position, offset, size)
+    for the tiles that are there, sorted by offset so reading them
+    goes forward through the file.
+    """
+    header = fp.read(HEADER_SIZE)
+    (version, records) = struct.unpack('<II', header[:8])
+    if version != 3 or records != BUNDLE_DIM * BUNDLE_DIM:
+        raise ValueError("Not a compact cache V2 bundle (version %d, %d records)." % (version, records))
+    index = struct.unpack('<%dQ' % (BUNDLE_DIM * BUNDLE_DIM), fp.read(INDEX_SIZE))
+    entries = [(pos, entry & 0xFFFFFFFFFF, entry >> 40) for (pos, entry) in enumerate(index) if entry >> 40]
+    entries.sort(key=lambda e: e[1])
+    return entries
+
+
+def read_bundle(fp, row0: int = 0, col0: int = 0):
+    """ Yields (row, col, data) for each tile in a bundle, reading straight through it. """
+    where = HEADER_SIZE + INDEX_SIZE
+    for (pos, offset, size) in read_index(fp):
+        # Tiles are usually back to back with a 4 byte size in between,
+        # read past small gaps instead of seeking, seeking in a zip can be slow.
+        if where < offset <= where + 64:
+            fp.read(offset - where)
+        elif offset != where:
+            fp.seek(offset)
+        data = fp.read(size)
+        where = offset + size
+        yield (row0 + pos // BUNDLE_DIM, col0 + pos % BUNDLE_DIM, data)
+    return
+
+
+def write_bundle(fp, tiles: dict) -> None:
+    """ Write a bundle. 'tiles' is {(row, col) within the bundle: data}. """
+    index = [0] * (BUNDLE_DIM * BUNDLE_DIM)
+    body = bytearray()
+    offset = HEADER_SIZE + INDEX_SIZE
+    for ((row, col), data) in sorted(tiles.items()):
+        body += struct.pack('<I', len(data))
+        offset += 4
+        index[row * BUNDLE_DIM + col] = (len(data) << 40) | offset
+        body += data
+        offset += len(data)
+    biggest = max((len(d) for d in tiles.values()), default=0)
+    fp.write(struct.pack('<IIIIQQQIIIIII', 3, BUNDLE_DIM * BUNDLE_DIM, biggest, 5, 0, offset, 40,
+                         20 + INDEX_SIZE, 3, 16, BUNDLE_DIM * BUNDLE_DIM, 5, INDEX_SIZE))
+    fp.write(struct.pack('<%dQ' % len(index), *index))
+    fp.write(body)
+    return
+
+
+def write_package(pkgfile: str, tiles: dict, scales: dict) -> None:
+    """
+    Write a minimal .vtpk, for testing.
+    'tiles' is {(level, row, col): data}, 'scales' is {level: scale}.
+    """
+    grouped = {}
+    for ((level, row, col), data) in tiles.items():
+        grouped.setdefault(bundle_name(level, row, col), {})[(row % BUNDLE_DIM, col % BUNDLE_DIM)] = data
+    # Web Mercator, resolution is meters per pixel at 96 dpi.
+    root = {'tileInfo': {'rows': 512, 'cols': 512, 'dpi': 96,
+                         'origin': {'x': -20037508.342787, 'y': 20037508.342787},
+                         'lods': [{'level': l, 'scale': s, 'resolution': s * 0.0254 / 96}
+                                  for (l, s) in sorted(scales.items())]}}
+    with zipfile.ZipFile(pkgfile, 'w', zipfile.ZIP_STORED) as zf:
+        zf.writestr('p12/root.json', json.dumps(root))
+        zf.writestr('p12/resources/styles/root.json', json.dumps({'version': 8, 'layers': []}))
+        for (name, bundle_tiles) in sorted(grouped.items()):
+            with zf.open(name, 'w') as fp:
+                write_bundle(fp, bundle_tiles)
+    return
+
+
+def read_tile_info(zf: zipfile.ZipFile) -> dict:
+    """ The "tileInfo" from root.json (origin, tile size, levels), or {} if it's not there. """
+    for name in zf.namelist():
+        if name.endswith('p12/root.json'):
+            return json.loads(zf.read(name)).get('tileInfo', {})
+    return {}
+
+
+def read_tiling(zf: zipfile.ZipFile) -> dict:
+    """ The tiling scheme from root.json, as {level: scale}. """
+    return {lod['level']: lod['scale'] for lod in read_tile_info(zf).get('lods', [])}
+
+
+def bundles(zf: zipfile.ZipFile) -> list:
+    """ Returns a list of (level, row0, col0, name) for every bundle in the package. """
+    found = []
+    for name in zf.namelist():
+        parsed = parse_bundle_name(name)
+        if parsed:
+            found.append(parsed + (name,))
+    return sorted(found)
+
+
+def iter_tiles(zf: zipfile.ZipFile, level: int = None):
+    """ Yields (level, row, col, data) for every tile in the package, or just one level. """
+    for (lvl, row0, col0, name) in bundles(zf):
+        if level is not None and lvl != level:
+            continue
+        with zf.open(name) as fp:
+            for (row, col, data) in read_bundle(fp, row0, col0):
+                yield (lvl, row, col, data)
+    return
+
+
+def count_tiles(pkgfile: str) -> dict:
+    """ {level: number of tiles}, from the bundle indexes alone, which is quick. """
+    counts = {}
+    with zipfile.ZipFile(pkgfile) as zf:
+        for (level, row0, col0, name) in bundles(zf):
+            with zf.open(name) as fp:
+                counts[level] = counts.get(level, 0) + len(read_index(fp))
+    return counts
+
+
+def unzipped_size(data: bytes) -> int:
+    """ How big a tile is after un-gzipping it. Tiles that aren't gzipped count as is. """
+    if data[:2] != b'\x1f\x8b':
+        return len(data)
+    try:
+        return len(gzip.decompress(data))
+    except (OSError, EOFError):
+        return len(data)
+
+
+def inspect(pkgfile: str, largest: int = 5) -> dict:
+    """ Gather statistics about each level in a package. """
+    report = {
+        'file': os.path.abspath(pkgfile),
+        'file_bytes': os.path.getsize(pkgfile),
+        'levels': [],
+    }
+    with zipfile.ZipFile(pkgfile) as zf:
+        scales = read_tiling(zf)
+        levels = {}
+        for (level, row, col, data) in iter_tiles(zf):
+            s = levels.get(level)
+            if s is None:
+                s = levels[level] = {'level': level, 'scale': scales.get(level), 'tiles': 0,
+                                     'bytes': 0, 'unzipped_bytes': 0, 'largest': []}
+            s['tiles'] += 1
+            s['bytes'] += len(data)
+            s['unzipped_bytes'] += unzipped_size(data)
+            # Keep the biggest few, smallest on top so it's easy to bump.
+            heapq.heappush(s['largest'], (len(data), row, col))
+            if len(s['largest']) > largest:
+                heapq.heappop(s['largest'])
+        report['other_bytes'] = sum(i.compress_size for i in zf.infolist() if not parse_bundle_name(i.filename))
+
+    total = sum(s['bytes'] for s in levels.values()) or 1
+    for level in sorted(levels):
+        s = levels[level]
+        s['largest'] = [{'row': row, 'col': col, 'bytes': size} for (size, row, col) in sorted(s['largest'], reverse=True)]
+        s['share'] = s['bytes'] / total
+        s['compression'] = s['unzipped_bytes'] / s['bytes'] if s['bytes'] else 0
+        s['average'] = s['bytes'] / s['tiles']
+        # Is this level in the range we build, and is it hogging the package?
+        in_range = s['scale'] is not None and Config.MAX_ZOOM * 0.999 <= s['scale'] <= Config.MIN_COUNTY_ZOOM * 1.001
+        s['dominant'] = in_range and s['share'] > DOMINANT_SHARE
+        report['levels'].append(s)
+    report['tiles'] = sum(s['tiles'] for s in report['levels'])
+    report['tile_bytes'] = sum(s['bytes'] for s in report['levels'])
+    return report
+
+
+def show(report: dict) -> None:
+    print(report['file'])
+    print("%d tiles, %.1f MB of tiles, %.1f MB file" % (report['tiles'], report['tile_bytes'] / 1024**2, report['file_bytes'] / 1024**2))
+    print("%5s %14s %9s %12s %7s %9s %9s %6s  %s" % ("level", "scale", "tiles", "bytes", "share", "average", "biggest", "ratio", ""))
+    for s in report['levels']:
+        biggest = s['largest'][0] if s['largest'] else {'bytes': 0}
+        print("%5d %14.2f %9d %12d %6.1f%% %9.0f %9d %6.2f  %s" % (
+            s['level'], s['scale'] or 0, s['tiles'], s['bytes'], s['share'] * 100, s['average'],
+            biggest['bytes'], s['compression'], "<== %.0f%% of the tiles" % (s['share'] * 100) if s['dominant'] else ""))
+    for s in report['levels']:
+        if s['dominant']:
+            print("Level %d: biggest tiles %s" % (s['level'], ', '.join('R%dC%d %d bytes' % (t['row'], t['col'], t['bytes']) for t in s['largest'])))
+    return
+
+
+def compare(old: dict, new: dict) -> None:
+    """ Show how each level changed between two saved reports. """
+    before = {s['level']: s for s in old['levels']}
+    after = {s['level']: s for s in new['levels']}
+    print("%5s %10s %10s %14s %14s %8s" % ("level", "tiles was", "tiles now", "bytes was", "bytes now", "change"))
+    for level in sorted(set(before) | set(after)):
+        b = before.get(level, {'tiles': 0, 'bytes': 0})
+        a = after.get(level, {'tiles': 0, 'bytes': 0})
+        change = "%+.1f%%" % ((a['bytes'] - b['bytes']) * 100 / b['bytes']) if b['bytes'] else "new"
+        print("%5d %10d %10d %14d %14d %8s" % (level, b['tiles'], a['tiles'], b['bytes'], a['bytes'], change))
+    return
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python vtpk.py package.vtpk [report.json]")
+        print("       python vtpk.py old_report.json new_report.json")
+        exit(1)
+
+    if sys.argv[1].endswith('.json'):
+        with open(sys.argv[1]) as fp:
+            old = json.load(fp)
+        with open(sys.argv[2]) as fp:
+            new = json.load(fp)
+        compare(old, new)
+        exit(0)
+
+    report = inspect(sys.argv[1])
+    show(report)
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], 'w') as fp:
+            json.dump(report, fp, indent=2)
+        print("Saved report in %s" % sys.argv[2])
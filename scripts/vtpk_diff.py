@@ -0,0 +1,214 @@
+"""
+vtpk_diff.py
+
+Compares the tiles in two vector tile packages.
+
+After a small edit (a road gets renamed) most of the tiles in a new
+package are byte for byte the same as in the last one. This finds the
+ones that aren't. It works one bundle at a time, so it never holds
+more than one bundle's worth of tile hashes in memory no matter how
+big the packages are. Bundles that zip says are identical (same CRC
+and size) are not read at all.
+
+The result is a "change set", a dict that can be saved as JSON:
+
+    {
+      "old": ..., "new": ...,
+      "old_digest": ..., "new_digest": ...,   # see package_digest()
+      "republish": true,          # false means the tiles and style are the same
+      "style_changed": false,
+      "added": 3, "removed": 0, "changed": 41, "unchanged": 120377,
+      "extent": [xmin, ymin, xmax, ymax],   # Web Mercator, of everything that changed
+      "levels": [ {"level": 14, "added": 0, "removed": 0, "changed": 12, "unchanged": 9001,
+                   "rows": [first, last], "cols": [first, last], "extent": [...]}, ... ]
+    }
+
+    python vtpk_diff.py old.vtpk new.vtpk [changes.json]
+"""
+import os, sys
+import json
+import hashlib
+import zipfile
+import vtpk
+
+# Besides the tiles, a change in any of these means the service looks different.
+STYLE_PARTS = ('p12/root.json', 'p12/resources/')
+
+
+def _digests(zf: zipfile.ZipFile, name: str) -> dict:
+    """ {position in bundle: hash} for every tile in one bundle. """
+    digests = {}
+    with zf.open(name) as fp:
+        for (row, col, data) in vtpk.read_bundle(fp):
+            digests[row * vtpk.BUNDLE_DIM + col] = hashlib.blake2b(data, digest_size=16).digest()
+    return digests
+
+
+def _positions(zf: zipfile.ZipFile, name: str) -> list:
+    """ Where the tiles are in a bundle, just reading the index. """
+    with zf.open(name) as fp:
+        return [pos for (pos, offset, size) in vtpk.read_index(fp)]
+
+
+def _tile_extent(tile_info: dict, level: int, rows: list, cols: list) -> list:
+    """ The Web Mercator extent covered by a range of rows and columns at a level. """
+    lods = {lod['level']: lod for lod in tile_info.get('lods', [])}
+    if level not in lods or 'origin' not in tile_info:
+        return None
+    lod = lods[level]
+    resolution = lod.get('resolution') or lod['scale'] * 0.0254 / tile_info.get('dpi', 96)
+    width = resolution * tile_info.get('cols', 512)
+    height = resolution * tile_info.get('rows', 512)
+    (x0, y0) = (tile_info['origin']['x'], tile_info['origin']['y'])
+    return [x0 + cols[0] * width, y0 - (rows[1] + 1) * height,
+            x0 + (cols[1] + 1) * width, y0 - rows[0] * height]
+
+
+def _style_members(zf: zipfile.ZipFile) -> dict:
+    return {i.filename: (i.CRC, i.file_size) for i in zf.infolist()
+            if any(part in i.filename for part in STYLE_PARTS) and not vtpk.parse_bundle_name(i.filename)}
+
+
+def package_digest(filename: str) -> str:
+    """
+    A digest of the bundles and style in a package. It's made from the CRCs and
+    sizes in the zip directory, so nothing gets decompressed. Packages with the
+    same digest have the same tiles, but not always the other way around
+    (a bundle can be rewritten with its tiles in a different order), diff() can tell.
+    """
+    h = hashlib.sha256()
+    with zipfile.ZipFile(filename) as zf:
+        for i in sorted(zf.infolist(), key=lambda i: i.filename):
+            if vtpk.parse_bundle_name(i.filename) or any(part in i.filename for part in STYLE_PARTS):
+                h.update(('%s %08x %d\n' % (i.filename, i.CRC, i.file_size)).encode('utf-8'))
+    return h.hexdigest()
+
+
+def diff(old_file: str, new_file: str, tiles: bool = False) -> dict:
+    """
+    Compare two packages. Returns a change set (see above).
+    With tiles=True each level also gets lists of the [row, col] of
+    every added, removed and changed tile.
+    """
+    levels = {}
+
+    def level_stats(level):
+        if level not in levels:
+            levels[level] = {'level': level, 'added': 0, 'removed': 0, 'changed': 0, 'unchanged': 0,
+                             'rows': None, 'cols': None}
+            if tiles:
+                levels[level].update({'added_tiles': [], 'removed_tiles': [], 'changed_tiles': []})
+        return levels[level]
+
+    def count(s, what, row, col, n=1):
+        s[what] += n
+        if what == 'unchanged':
+            return
+        s['rows'] = [min(s['rows'][0], row), max(s['rows'][1], row)] if s['rows'] else [row, row]
+        s['cols'] = [min(s['cols'][0], col), max(s['cols'][1], col)] if s['cols'] else [col, col]
+        if tiles:
+            s[what + '_tiles'].append([row, col])
+        return
+
+    with zipfile.ZipFile(old_file) as old, zipfile.ZipFile(new_file) as new:
+        tile_info = vtpk.read_tile_info(new)
+        old_bundles = {name: (level, row0, col0) for (level, row0, col0, name) in vtpk.bundles(old)}
+        new_bundles = {name: (level, row0, col0) for (level, row0, col0, name) in vtpk.bundles(new)}
+
+        for name in sorted(set(old_bundles) | set(new_bundles)):
+            (level, row0, col0) = new_bundles.get(name) or old_bundles[name]
+            s = level_stats(level)
+            if name not in new_bundles:
+                for pos in _positions(old, name):
+                    count(s, 'removed', row0 + pos // vtpk.BUNDLE_DIM, col0 + pos % vtpk.BUNDLE_DIM)
+                continue
+            if name not in old_bundles:
+                for pos in _positions(new, name):
+                    count(s, 'added', row0 + pos // vtpk.BUNDLE_DIM, col0 + pos % vtpk.BUNDLE_DIM)
+                continue
+
+            (a, b) = (old.getinfo(name), new.getinfo(name))
+            if a.CRC == b.CRC and a.file_size == b.file_size:
+                # The same bundle, no need to look at the tiles.
+                count(s, 'unchanged', 0, 0, len(_positions(new, name)))
+                continue
+
+            before = _digests(old, name)
+            after = _digests(new, name)
+            for pos in sorted(set(before) | set(after)):
+                (row, col) = (row0 + pos // vtpk.BUNDLE_DIM, col0 + pos % vtpk.BUNDLE_DIM)
+                if pos not in after:
+                    count(s, 'removed', row, col)
+                elif pos not in before:
+                    count(s, 'added', row, col)
+                elif before[pos] != after[pos]:
+                    count(s, 'changed', row, col)
+                else:
+                    count(s, 'unchanged', row, col)
+
+        style_changed = _style_members(old) != _style_members(new)
+
+    changes = {
+        'old': os.path.abspath(old_file),
+        'new': os.path.abspath(new_file),
+        'old_digest': package_digest(old_file),
+        'new_digest': package_digest(new_file),
+        'style_changed': style_changed,
+        'levels': [],
+        'extent': None,
+    }
+    for what in ('added', 'removed', 'changed', 'unchanged'):
+        changes[what] = sum(s[what] for s in levels.values())
+    for level in sorted(levels):
+        s = levels[level]
+        s['extent'] = _tile_extent(tile_info, level, s['rows'], s['cols']) if s['rows'] else None
+        if s['extent']:
+            e = changes['extent']
+            changes['extent'] = s['extent'] if not e else [min(e[0], s['extent'][0]), min(e[1], s['extent'][1]),
+                                                          max(e[2], s['extent'][2]), max(e[3], s['extent'][3])]
+        changes['levels'].append(s)
+    changes['republish'] = style_changed or bool(changes['added'] or changes['removed'] or changes['changed'])
+    return changes
+
+
+def save(changes: dict, filename: str) -> None:
+    with open(filename, 'w') as fp:
+        json.dump(changes, fp, indent=2)
+    return
+
+
+def load(filename: str) -> dict:
+    """ A saved change set, or None. """
+    try:
+        with open(filename) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def show(changes: dict) -> None:
+    print("%s => %s" % (changes['old'], changes['new']))
+    print("%5s %9s %9s %9s %11s  %s" % ("level", "added", "removed", "changed", "unchanged", "rows, cols"))
+    for s in changes['levels']:
+        where = "%d-%d, %d-%d" % (s['rows'][0], s['rows'][1], s['cols'][0], s['cols'][1]) if s['rows'] else ""
+        print("%5d %9d %9d %9d %11d  %s" % (s['level'], s['added'], s['removed'], s['changed'], s['unchanged'], where))
+    if changes['style_changed']:
+        print("The style changed.")
+    if changes['republish']:
+        print("%d tiles added, %d removed, %d changed. Extent %s" % (
+            changes['added'], changes['removed'], changes['changed'], changes['extent']))
+    else:
+        print("The packages have the same tiles and style, there is nothing to republish.")
+    return
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: python vtpk_diff.py old.vtpk new.vtpk [changes.json]")
+        exit(1)
+    changes = diff(sys.argv[1], sys.argv[2], tiles=len(sys.argv) > 3)
+    show(changes)
+    if len(sys.argv) > 3:
+        save(changes, sys.argv[3])
+        print("Saved change set in %s" % sys.argv[3])
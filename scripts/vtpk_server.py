@@ -0,0 +1,278 @@
+"""
+vtpk_server.py
+
+Serves the tiles and style in a .vtpk on this machine, so you can QC a
+package from build_tile_package before spending the time to upload it.
+
+    python vtpk_server.py Vector_Tiles.vtpk [port]
+
+then open http://localhost:8088/ in a browser. You can also point ArcGIS
+Pro or anything else that reads vector tiles at
+
+    http://localhost:8088/tile/{z}/{y}/{x}.pbf           like a VectorTileServer
+    http://localhost:8088/tiles/{z}/{x}/{y}.pbf          the usual z/x/y order
+    http://localhost:8088/resources/styles/root.json     the style
+
+The package is memory mapped, not unzipped. The tiles are "stored" (not
+compressed) in the zip, so at startup we work out where each bundle
+starts in the file and keep a view of its index; after that a tile is
+two lookups and a slice of the map that goes straight to the socket.
+Requests are handled on threads, so the browser can pull lots of tiles
+at once.
+"""
+import os, sys
+import json
+import mmap
+import struct
+import zipfile
+import threading
+from urllib.parse import urlparse, unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import vtpk
+
+DEFAULT_PORT = 8088
+
+CONTENT_TYPES = {
+    '.json': 'application/json',
+    '.pbf': 'application/x-protobuf',
+    '.png': 'image/png',
+    '.xml': 'text/xml',
+}
+
+VIEWER = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>%(title)s</title>
+<script src="https://unpkg.com/maplibre-gl@3/dist/maplibre-gl.js"></script>
+<link href="https://unpkg.com/maplibre-gl@3/dist/maplibre-gl.css" rel="stylesheet" />
+<style>body { margin: 0; } #map { position: absolute; top: 0; bottom: 0; width: 100%%; }</style>
+</head><body><div id="map"></div><script>
+var map = new maplibregl.Map({container: 'map', style: '/resources/styles/root.json',
+    center: [-123.7, 46.0], zoom: 9, hash: true});
+map.addControl(new maplibregl.NavigationControl());
+</script></body></html>
+"""
+
+
+class TileStore(object):
+    """ The tiles and resources in one .vtpk, read through a memory map. """
+
+    def __init__(self, pkgfile: str) -> None:
+        self.pkgfile = os.path.abspath(pkgfile)
+        self._file = open(pkgfile, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        self.bundles = {}    # (level, row0, col0) -> (where the bundle starts in the file, its index)
+        self.resources = {}  # path -> (start, size) or bytes
+        self._lock = threading.Lock()
+
+        with zipfile.ZipFile(self._file) as zf:
+            self.tile_info = vtpk.read_tile_info(zf)
+            for info in zf.infolist():
+                if info.is_dir():
+                    continue
+                parsed = vtpk.parse_bundle_name(info.filename)
+                if parsed:
+                    self._addBundle(zf, info, parsed)
+                elif '/resources/' in info.filename or info.filename.endswith('p12/root.json'):
+                    path = info.filename.split('p12/', 1)[-1]
+                    self.resources[path] = self._locate(zf, info)
+        return
+
+    def _dataStart(self, info: zipfile.ZipInfo) -> int:
+        """ Where a member's data starts, after its local header (which can differ from the central one). """
+        (name_len, extra_len) = struct.unpack_from('<HH', self._map, info.header_offset + 26)
+        return info.header_offset + 30 + name_len + extra_len
+
+    def _locate(self, zf: zipfile.ZipFile, info: zipfile.ZipInfo):
+        """ (start, size) of a stored member, or its bytes if it had to be decompressed. """
+        if info.compress_type == zipfile.ZIP_STORED:
+            return (self._dataStart(info), info.file_size)
+        return zf.read(info)
+
+    def _addBundle(self, zf: zipfile.ZipFile, info: zipfile.ZipInfo, parsed: tuple) -> None:
+        where = self._locate(zf, info)
+        if isinstance(where, bytes):
+            # Compressed bundles don't happen in packages from Pro, but just in case.
+            data = memoryview(where)
+            start = 0
+        else:
+            data = self._view
+            start = where[0]
+        # A view of the index, nothing gets copied.
+        index = data[start + vtpk.HEADER_SIZE:start + vtpk.HEADER_SIZE + vtpk.INDEX_SIZE].cast('B').cast('Q')
+        self.bundles[parsed] = (data, start, index)
+        return
+
+    def tile(self, level: int, row: int, col: int) -> memoryview:
+        """ The (gzipped) tile, or None if there isn't one there. """
+        dim = vtpk.BUNDLE_DIM
+        bundle = self.bundles.get((level, row - row % dim, col - col % dim))
+        if not bundle:
+            return None
+        (data, start, index) = bundle
+        entry = index[(row % dim) * dim + col % dim]
+        size = entry >> 40
+        if not size:
+            return None
+        offset = start + (entry & 0xFFFFFFFFFF)
+        return data[offset:offset + size]
+
+    def resource(self, path: str) -> memoryview:
+        where = self.resources.get(path)
+        if where is None:
+            return None
+        if isinstance(where, bytes):
+            return memoryview(where)
+        (start, size) = where
+        return self._view[start:start + size]
+
+    def style(self, base_url: str) -> bytes:
+        """
+        The style, with its relative URLs made absolute, and the source pointing
+        straight at our tiles, because map viewers don't read Esri's root.json.
+        None if the package doesn't have a style.
+        """
+        data = self.resource('resources/styles/root.json')
+        if data is None:
+            return None
+        style = json.loads(bytes(data))
+        if 'sprite' in style:
+            style['sprite'] = base_url + '/resources/sprites/sprite'
+        if 'glyphs' in style:
+            style['glyphs'] = base_url + '/resources/fonts/{fontstack}/{range}.pbf'
+        levels = sorted(self.bundles)
+        for source in style.get('sources', {}).values():
+            if source.get('type') == 'vector':
+                source.pop('url', None)
+                source['tiles'] = [base_url + '/tile/{z}/{y}/{x}.pbf']
+                if levels:
+                    source['minzoom'] = levels[0][0]
+                    source['maxzoom'] = levels[-1][0]
+        return json.dumps(style).encode('utf-8')
+
+    def close(self) -> None:
+        self.bundles.clear()
+        self._view.release()
+        self._map.close()
+        self._file.close()
+        return
+
+
+class TileServer(object):
+
+    def __init__(self, pkgfile: str, port: int = DEFAULT_PORT, host: str = '127.0.0.1') -> None:
+        self.store = TileStore(pkgfile)
+        self.host = host
+        self.port = port
+        self.requests = 0
+        self.misses = 0
+        self._server = None
+        return
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # The headers and the tile go out in two writes, don't let the second one wait.
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                server._respond(self)
+
+            def log_message(self, format, *args):
+                return
+
+        return Handler
+
+    def _send(self, handler, status: int, body, content_type: str, gzipped: bool = False) -> None:
+        handler.send_response(status)
+        handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(len(body)))
+        handler.send_header('Access-Control-Allow-Origin', '*')
+        if gzipped:
+            handler.send_header('Content-Encoding', 'gzip')
+        handler.end_headers()
+        handler.wfile.write(body)
+        return
+
+    def _respond(self, handler) -> None:
+        path = unquote(urlparse(handler.path).path).strip('/')
+        parts = path.split('/')
+        with self.store._lock:
+            self.requests += 1
+        try:
+            if parts[0] in ('tile', 'tiles') and len(parts) == 4:
+                (z, a, b) = (int(parts[1]), int(parts[2]), int(parts[3].split('.')[0]))
+                # Esri's "tile" is z/y/x, "tiles" is the usual z/x/y.
+                (row, col) = (a, b) if parts[0] == 'tile' else (b, a)
+                data = self.store.tile(z, row, col)
+                if data is None:
+                    with self.store._lock:
+                        self.misses += 1
+                    self._send(handler, 204, b'', 'application/x-protobuf')
+                else:
+                    self._send(handler, 200, data, 'application/x-protobuf', gzipped=bytes(data[:2]) == b'\x1f\x8b')
+                return
+            if path == 'resources/styles/root.json':
+                base_url = 'http://%s' % (handler.headers.get('Host') or '%s:%d' % (self.host, self.port))
+                style = self.store.style(base_url)
+                if style is None:
+                    self._send(handler, 404, b'No style in this package', 'text/plain')
+                else:
+                    self._send(handler, 200, style, 'application/json')
+                return
+            if path in ('', 'index.html'):
+                page = VIEWER % {'title': os.path.basename(self.store.pkgfile)}
+                self._send(handler, 200, page.encode('utf-8'), 'text/html')
+                return
+            if path == 'VectorTileServer':
+                path = 'root.json'
+            data = self.store.resource(path)
+            if data is not None:
+                self._send(handler, 200, data, CONTENT_TYPES.get(os.path.splitext(path)[1], 'application/octet-stream'))
+                return
+            self._send(handler, 404, b'Not found', 'text/plain')
+        except (ValueError, IndexError):
+            self._send(handler, 400, b'Bad request', 'text/plain')
+        return
+
+    def start(self) -> 'TileServer':
+        self._server = ThreadingHTTPServer((self.host, self.port), self._handler())
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def serve_forever(self) -> None:
+        self._server = ThreadingHTTPServer((self.host, self.port), self._handler())
+        self._server.daemon_threads = True
+        self._server.serve_forever()
+        return
+
+    def stop(self) -> None:
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        self.store.close()
+        return
+
+    @property
+    def url(self) -> str:
+        return 'http://%s:%d' % (self.host, self.port)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python vtpk_server.py package.vtpk [port]")
+        exit(1)
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_PORT
+    server = TileServer(sys.argv[1], port=port)
+    store = server.store
+    print("%s: %d bundles, levels %s" % (store.pkgfile, len(store.bundles), sorted({b[0] for b in store.bundles})))
+    print("Serving on http://localhost:%d/  (Ctrl-C to stop)" % port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print("%d requests, %d empty tiles." % (server.requests, server.misses))